@@ -1,91 +1,85 @@
 import machine
 import time
-from machine import Timer, Pin, PWM
 from micropython import const
 import gc
+from array import array
 import wlan_wrapper
 import uart_wrapper
-from _thread import allocate_lock, start_new_thread
+import motion
+import cmd_ring
+import motor_frame
+import mic_array
+import control_loop
+import telemetry
+import latency
+import program
+import memory
+import outbox
+import broadcast
+import recorder
+import deadman
+from motor_driver import MotorDriver, load_calibration
+from _thread import allocate_lock
 import json
+import uasyncio as asyncio
+
+# ticks_ms counts from reset, so the boot marks read as time since boot
+_boot_phases = [('imports', time.ticks_ms())]
 
 DEVICE_FREQ = const(240 * 1000000)
 BOOT_TIME = const(3)
 HEARTBEAT_PERIOD = const(5)  # s
 DEFAULT_MOTION_DURATION_MS = const(500)  # ms
 DEFAULT_ROTATE_DURATION_MS = const(200)  # ms
-MOTOR_DUTY_FREQ = const(20)  # Hz
+MOTOR_PWM_FREQ = const(20)  # Hz, robot_set_pwm_freq changes it at runtime
+MOTOR_PWM_BITS = const(10)  # duty resolution, robot_set_pwm_bits
+# per motor deadband, gain, trim and curve, see tools/motor_calibrate.py
+MOTOR_CALIBRATION_FILE = 'motor_cal.json'
+MOTION_BACKSTOP_SLACK_MS = const(5)  # ms, grace before the loop stops a motion
+CONTROL_RATE_HZ = const(100)  # Hz, motor control tick
+CONTROL_SLEW_PER_S = const(5000)  # duty units per second, 0 disables
+# the deadman owns stream staleness: a streamed setpoint is also leased to
+# the control loop for the /motors_ws deadman timeout, as a backstop in the
+# tick, and for this long only while that timeout is off
+STREAM_STALE_MS = const(750)  # ms
+# a /motors_ws client that does not negotiate its own deadman timeout gets
+# this one, the bluetooth app sends a key once so only its link is watched
+DEADMAN_WEBSOCKET_MS = const(750)  # ms
+DEADMAN_BLUETOOTH_MS = const(0)  # ms, deadman.NO_TIMEOUT
 
 import repl_drop
-repl_drop.wait(BOOT_TIME)
 print('app.py')
 
-from MicroWebSrv2 import *
-
 # wifi
 # make sure you have a credentials.py file which defines the below variables
 from credentials import WLAN_SSID, WLAN_KEY  # noqa E402
 DHCP_HOSTNAME = 'alpo'
+WLAN_CONNECT_TIMEOUT_MS = const(10000)
+# also cache the dhcp lease and set it statically on the next boot
+WLAN_REUSE_IP = False
 
 
-# motor control pins
-pin1 = Pin(25, Pin.OUT)
-in1 = PWM(pin1, freq=MOTOR_DUTY_FREQ, duty=0)
-pin2 = Pin(26, Pin.OUT)
-in2 = PWM(pin2, freq=MOTOR_DUTY_FREQ, duty=0)
-pin3 = Pin(27, Pin.OUT)
-in3 = PWM(pin3, freq=MOTOR_DUTY_FREQ, duty=0)
-pin4 = Pin(14, Pin.OUT)
-in4 = PWM(pin4, freq=MOTOR_DUTY_FREQ, duty=0)
-pins = [in1, in2, in3, in4]
+# motor control pins in1..in4 of the h-bridge
+motors = MotorDriver((25, 26, 27, 14), MOTOR_PWM_FREQ, MOTOR_PWM_BITS)
+# setpoint magnitude on each of in1..in4, what the status line shows;
+# motors.duties holds the calibrated pwm duties
+motor_duties = motors.levels
+MOTOR_STATUS_MIN_INTERVAL_MS = const(100)  # ms, uart status throttle
 power_level = 1000  # max is 1023 but we can happily treat this as decipercent
-cmd_queue = []
-
-
-def get_pin_number(pin_instance):
-    return int(str(pin_instance)[4:-1])
-
-
-# microphone pins
-mic1 = Pin(13, Pin.IN)
-mic2 = Pin(34, Pin.IN)
-mic3 = Pin(39, Pin.IN)
-mic4 = Pin(36, Pin.IN)
-
-mics = [mic1, mic2, mic3, mic4]
-mic_timers = {}
-
-
-def init_mic_timers():
-    for idx, mic in enumerate(mics):
-        mic_timer = Timer(-idx)
-        mic_timer.init(period=1000, mode=Timer.ONE_SHOT,
-                       callback=lambda t: re_enable_mic_isr(t, mic))
-        mic_timers[get_pin_number(mic)] = mic_timer
-
-
-def re_enable_mic_isr(tim_instance, pin_instance):
-    pin_instance.irq(mic_isr, Pin.IRQ_FALLING)
-    print('Reenable {}'.format(pin_instance))
-
-
-def mic_isr(pin_instance):
-    pin_instance.irq(None)
-    mic_timer = mic_timers[get_pin_number(pin_instance)]
-    mic_timer.init(period=1000, mode=Timer.ONE_SHOT,
-                   callback=lambda t: re_enable_mic_isr(t, pin_instance))
-    print('Disable {}'.format(pin_instance))
-
-
-def set_mic_isrs():
-    mic1.irq(mic_isr, Pin.IRQ_FALLING)
-    mic2.irq(mic_isr, Pin.IRQ_FALLING)
-    mic3.irq(mic_isr, Pin.IRQ_FALLING)
-    mic4.irq(mic_isr, Pin.IRQ_FALLING)
+CMD_QUEUE_LEN = const(16)
+CMD_QUEUE_POLICY = cmd_ring.DROP_OLDEST
+# drivers, observers and telemetry clients together, each costs a queue
+MAX_WEBSOCKETS = const(8)
+BROADCAST_MIN_PERIOD_MS = const(50)  # ms, observers get at most 20 updates/s
+# flight log on flash, see recorder.py
+FLIGHT_LOG_MAX_BYTES = const(32768)  # per file, the previous one is kept
+REPLAY_MAX_GAP_MS = const(10000)  # ms, longer idle stretches are shortened
+# idle-time gc, see memory.py
+GC_ALLOC_THRESHOLD = const(16384)  # bytes allocated since the last collect
+GC_FREE_FLOOR = const(24576)  # or fewer bytes than this left free
 
 
 # status
-heartbeat_timer_flag = True
-heartbeat = Timer(-1)
 status_dict = dict(
     hostname='null',
     seconds=0,
@@ -100,140 +94,440 @@ def robot_get_power():
 
 
 def robot_set_power(new_power_level):
+    # every later motion drives with it, so it has to be a valid setpoint
     global power_level
-    power_level = new_power_level
+    power = int(new_power_level)
+    power_level = min(max(power, -control_loop.SETPOINT_MAX),
+                      control_loop.SETPOINT_MAX)
+
+
+def _stop_motors():
+    control_loop.set_target(0, 0)
 
 
 def robot_stop():
-    in1.duty(0)
-    in2.duty(0)
-    in3.duty(0)
-    in4.duty(0)
+    deadman.release()
+    _stop_motors()
+    motion.begin(-1)
+
+
+def _drive(motor1, motor2, duration_ms):
+    deadman.release()  # a timed motion stops by itself
+    control_loop.set_target(motor1, motor2)
+    motion.begin(duration_ms)
 
 
 def robot_backward(duration_ms=DEFAULT_MOTION_DURATION_MS):
     global power_level
-    in1.duty(power_level)
-    in2.duty(0)
-    in3.duty(power_level)
-    in4.duty(0)
-    if duration_ms != -1:
-        time.sleep_ms(duration_ms)
-    robot_stop()
+    _drive(-power_level, -power_level, duration_ms)
 
 
 def robot_forward(duration_ms=DEFAULT_MOTION_DURATION_MS):
     global power_level
-    in1.duty(0)
-    in2.duty(power_level)
-    in3.duty(0)
-    in4.duty(power_level)
-    if duration_ms != -1:
-        time.sleep_ms(duration_ms)
-    robot_stop()
+    _drive(power_level, power_level, duration_ms)
 
 
 def robot_rotate_right(duration_ms=DEFAULT_ROTATE_DURATION_MS):
     global power_level
-    in1.duty(0)
-    in2.duty(power_level)
-    in3.duty(power_level)
-    in4.duty(0)
-    if duration_ms != -1:
-        time.sleep_ms(duration_ms)
-    robot_stop()
+    _drive(power_level, -power_level, duration_ms)
 
 
 def robot_rotate_left(duration_ms=DEFAULT_ROTATE_DURATION_MS):
     global power_level
-    in1.duty(power_level)
-    in2.duty(0)
-    in3.duty(0)
-    in4.duty(power_level)
-    if duration_ms != -1:
-        time.sleep_ms(duration_ms)
-    robot_stop()
+    _drive(-power_level, power_level, duration_ms)
 
 
 def robot_turn_right(duration_ms=DEFAULT_ROTATE_DURATION_MS):
     global power_level
-    in1.duty(0)
-    in2.duty(power_level)
-    in3.duty(0)
-    in4.duty(0)
-    if duration_ms != -1:
-        time.sleep_ms(duration_ms)
-    robot_stop()
+    _drive(power_level, 0, duration_ms)
 
 
 def robot_turn_left(duration_ms=DEFAULT_ROTATE_DURATION_MS):
     global power_level
-    in1.duty(0)
-    in2.duty(0)
-    in3.duty(0)
-    in4.duty(power_level)
-    if duration_ms != -1:
-        time.sleep_ms(duration_ms)
-    robot_stop()
+    _drive(0, power_level, duration_ms)
 
 
 def robot_wait(duration_ms=DEFAULT_MOTION_DURATION_MS):
-    time.sleep_ms(duration_ms)
+    motion.begin(duration_ms, stop=False)
 
 
 def robot_wait_1s():
-    time.sleep_ms(1000)
+    motion.begin(1000, stop=False)
 
 
 def robot_wait_5s():
-    time.sleep_ms(5000)
+    motion.begin(5000, stop=False)
 
 
 def get_pins_status():
-    global pins
-    pin_str = '('
-    for pin in pins:
-        pin_str = pin_str + '{}, '.format(pin.duty())
-    pin_str += ')'
-    return pin_str
-
-
-def robot_set_motor_powers(motor1: int, motor2: int):
-    global in1, in2, in3, in4
-    if motor1 == 0:
-        in1.duty(0)
-        in2.duty(0)
-    elif motor1 > 0:
-        in1.duty(0)
-        in2.duty(motor1)
-    elif motor1 < 0:
-        in1.duty(-motor1)
-        in2.duty(0)
-    if motor2 == 0:
-        in3.duty(0)
-        in4.duty(0)
-    elif motor2 > 0:
-        in3.duty(0)
-        in4.duty(motor2)
-    elif motor2 < 0:
-        in3.duty(-motor2)
-        in4.duty(0)
-    if uart_wrapper.is_bluetooth_connected():
-        uart_wrapper.raw_uart.write(get_pins_status() + '\n')
+    return '({}, {}, {}, {}, )'.format(*motor_duties)
+
+
+# fixed width uart status line, formatted in place so the whole buffer
+# can be written without slicing
+_motor_status_buf = bytearray(b'(   0,    0,    0,    0, )\n')
+_motor_status_dirty = False
+_motor_status_last_ms = 0
+
+
+def _format_motor_status():
+    pos = 1
+    for idx in range(4):
+        value = motor_duties[idx]
+        for digit in range(pos + 3, pos - 1, -1):
+            if value or digit == pos + 3:
+                _motor_status_buf[digit] = 48 + value % 10  # ascii '0'
+            else:
+                _motor_status_buf[digit] = 32  # ascii ' '
+            value //= 10
+        pos += 6
+
+
+def _emit_motor_status():
+    global _motor_status_dirty, _motor_status_last_ms
+    if not _motor_status_dirty:
+        return
+    if not uart_wrapper.is_bluetooth_connected():
+        _motor_status_dirty = False
+        return
+    now = time.ticks_ms()
+    if time.ticks_diff(now, _motor_status_last_ms) < \
+            MOTOR_STATUS_MIN_INTERVAL_MS:
+        _status_flag.set()  # motor_status_task flushes it later
+        return
+    _format_motor_status()
+    uart_wrapper.raw_uart.write(_motor_status_buf)
+    _motor_status_dirty = False
+    _motor_status_last_ms = now
+
+
+def _apply_motor_powers(motor1, motor2):
+    # only called from the control loop tick
+    global _motor_status_dirty
+    if motors.apply(motor1, motor2):
+        latency.duty_applied()
+        broadcast.update(broadcast.MOTORS)
+        _motor_status_dirty = True
+        _emit_motor_status()
+
+
+def _stream_lease_ms():
+    # follows what the /motors_ws client negotiated
+    lease_ms = deadman.timeout_ms[deadman.WEBSOCKET]
+    return lease_ms if lease_ms != deadman.NO_TIMEOUT else STREAM_STALE_MS
+
+
+def robot_set_motor_powers(motor1: int, motor2: int, lease_ms: int = None):
+    # lease_ms -1 holds the setpoint until the next one, None leases it
+    # like a streamed one, see STREAM_STALE_MS
+    if lease_ms is None:
+        lease_ms = _stream_lease_ms()
+    if _first_command:
+        _mark_first('first_command')
+    # websocket handlers run on server threads, they may only pre-empt a
+    # timed motion here and leave disarming its timer to the command task
+    generation = motion.preempt()
+    control_loop.set_target(motor1, motor2, lease_ms)
+    if generation:
+        cmd_ring.push(motion.release, generation)
+        _cmd_flag.set()
 
 
 def get_motors_status():
-    motor1 = 0
-    motor2 = 0
-    if in1.duty() == 0:
-        motor1 = -in2.duty()
-    else:
-        motor1 = in1.duty()
-    if in3.duty() == 0:
-        motor2 = -in3.duty()
+    # same sign convention as robot_set_motor_powers
+    return '{"m1":%d,"m2":%d}' % (motor_duties[1] - motor_duties[0],
+                                  motor_duties[3] - motor_duties[2])
+
+
+def get_sound_bearing():
+    # latest microphone time-difference-of-arrival estimate
+    if mic_array.last_bearing is None:
+        return json.dumps(None)
+    bearing, ticks_us, mic_count = mic_array.last_bearing
+    return json.dumps({'bearing': bearing, 'ticks_us': ticks_us,
+                       'mics': mic_count})
+
+
+def get_control_status():
+    return json.dumps(control_loop.stats())
+
+
+def get_queue_status():
+    return json.dumps(cmd_ring.stats())
+
+
+def _mark_boot(phase):
+    _boot_phases.append((phase, time.ticks_ms()))
+
+
+# one-off boot milestones that happen after main_init
+_first_wifi_up = True
+_first_command = True
+
+
+def _mark_first(phase):
+    global _first_wifi_up, _first_command
+    if phase == 'wifi_up':
+        _first_wifi_up = False
     else:
-        motor2 = in3.duty()
-    return json.dumps({'m1': motor1, 'm2': motor2})
+        _first_command = False
+    _mark_boot(phase)
+
+
+def get_boot_status():
+    # ms since reset at the end of every init phase, in order
+    return json.dumps([{'phase': phase, 'ms': ms}
+                       for phase, ms in _boot_phases])
+
+
+def get_memory_status():
+    # heap low-water mark, idle collections and their pauses
+    return json.dumps(memory.stats())
+
+
+def get_wifi_status():
+    # link quality, outages and the per phase timings of the last connect
+    result = dict(wlan_wrapper.link)
+    result.update(wlan_wrapper.timings)
+    return json.dumps(result)
+
+
+def get_outbox_status():
+    # queued, batched and dropped websocket replies, see outbox.py
+    return json.dumps(outbox.stats())
+
+
+def get_broadcast_status():
+    # observers per channel and how many state updates reached them
+    return json.dumps(broadcast.stats())
+
+
+def robot_set_pwm_freq(freq=MOTOR_PWM_FREQ):
+    try:
+        motors.set_pwm(freq=freq)
+    except ValueError as ex:
+        return 'error: %s' % ex
+    control_loop.refresh()
+    return motors.freq
+
+
+def robot_set_pwm_bits(bits=MOTOR_PWM_BITS):
+    # rebuilds the calibration tables for the new resolution
+    try:
+        motors.set_pwm(bits=bits)
+    except ValueError as ex:
+        return 'error: %s' % ex
+    control_loop.refresh()
+    return motors.bits
+
+
+def robot_load_calibration():
+    # (re)reads MOTOR_CALIBRATION_FILE, e.g. after uploading a new one
+    try:
+        motors.calibrate(load_calibration(MOTOR_CALIBRATION_FILE))
+    except (ValueError, TypeError, AttributeError) as ex:
+        return 'error: %s' % ex
+    control_loop.refresh()
+    return json.dumps(motors.calibration)
+
+
+def get_driver_status():
+    # pwm setup, per pin setpoints and duties and the calibration in use
+    return json.dumps(motors.stats())
+
+
+def get_deadman_status():
+    # per input source: timeout, stops and input loss to stop in ms
+    return json.dumps(deadman.stats())
+
+
+def get_latency_status():
+    # per stage histograms, see latency.py
+    return json.dumps(latency.stats())
+
+
+# commands a program may use: motor directions in units of the step power
+# and the duration used when the step gives none
+_program_cmds = {
+    'robot_stop': (0, 0, 0),
+    'robot_forward': (1, 1, DEFAULT_MOTION_DURATION_MS),
+    'robot_backward': (-1, -1, DEFAULT_MOTION_DURATION_MS),
+    'robot_rotate_right': (1, -1, DEFAULT_ROTATE_DURATION_MS),
+    'robot_rotate_left': (-1, 1, DEFAULT_ROTATE_DURATION_MS),
+    'robot_turn_right': (1, 0, DEFAULT_ROTATE_DURATION_MS),
+    'robot_turn_left': (0, 1, DEFAULT_ROTATE_DURATION_MS),
+    'robot_wait': (0, 0, DEFAULT_MOTION_DURATION_MS),
+    'robot_wait_1s': (0, 0, 1000),
+    'robot_wait_5s': (0, 0, 5000),
+}
+PROGRAM_MAX_STEP_MS = const(60000)
+
+
+def _program_power(param):
+    # program.m1/m2 are array('h'), out of range powers would wrap
+    power = int(param)
+    if not -control_loop.SETPOINT_MAX <= power <= control_loop.SETPOINT_MAX:
+        raise ValueError('bad power %d' % power)
+    return power
+
+
+def _compile_program(steps):
+    # steps are [command, param, duration_ms] with the trailing items
+    # optional; param is the power of a motion step or the new power of
+    # robot_set_power, the motors stop between steps like execute_cmds does
+    program.clear()
+    if not isinstance(steps, (list, tuple)):
+        raise ValueError('a program is a list of steps')
+    power = power_level
+    for step in steps:
+        if not isinstance(step, (list, tuple)) or not step:
+            raise ValueError('a step is [command, param, duration_ms]')
+        name = step[0]
+        param = step[1] if len(step) > 1 else None
+        duration = step[2] if len(step) > 2 else None
+        if not isinstance(name, str) or name not in valid_cmd_dict:
+            raise ValueError('unknown command')
+        if name == 'robot_set_power':
+            power = _program_power(param)
+            continue
+        if name not in _program_cmds:
+            raise ValueError('%s not allowed in a program' % name)
+        dir1, dir2, default_ms = _program_cmds[name]
+        step_power = power if param is None else _program_power(param)
+        if duration is None or name in ('robot_wait_1s', 'robot_wait_5s'):
+            duration = default_ms
+        duration = int(duration)
+        if not duration and not default_ms:
+            continue  # robot_stop, the motors stop between steps anyway
+        if not 0 < duration <= PROGRAM_MAX_STEP_MS:
+            raise ValueError('bad duration %d' % duration)
+        if not program.append(duration, dir1 * step_power, dir2 * step_power):
+            raise ValueError('more than %d steps' % program.MAX_STEPS)
+
+
+def run_program(steps):
+    # validates and compiles the whole program up front, then plays it on
+    # the motion timer, returns its length in ms or the reason it failed
+    try:
+        _compile_program(steps)
+    except (ValueError, TypeError, IndexError, KeyError,
+            OverflowError) as ex:
+        program.clear()
+        return 'error: %s' % ex
+    if program.length:
+        deadman.release()
+        program.start()
+    return program.duration_ms()
+
+
+def cancel_program():
+    was_running = program.is_running()
+    program.cancel()
+    if was_running:
+        _stop_motors()
+    return was_running
+
+
+def get_program_status():
+    # step timing errors in us, the last entry is the end of the program
+    return json.dumps(program.stats())
+
+
+_replay_task = None
+replay_stats = dict(
+    file=None,
+    running=False,
+    records=0,
+    max_late_ms=0,  # how far behind the recorded timing a record played
+)
+
+
+def replay_flight(index=0):
+    # plays flight.bin (0) or the rotated flight.1.bin (1) back with the
+    # recorded timing, setpoints through robot_set_motor_powers and other
+    # commands through the queue, motion commands are skipped as their
+    # setpoints were logged too; nothing is recorded meanwhile
+    global _replay_task
+    if index not in (0, 1):
+        return 'error: no flight log %s' % index
+    stop_replay()
+    deadman.release()
+    recorder.flush()
+    _replay_task = asyncio.create_task(_replay(recorder.FILE_NAMES[index]))
+    return recorder.FILE_NAMES[index]
+
+
+def stop_replay():
+    was_running = replay_stats['running']
+    if _replay_task is not None and was_running:
+        _replay_task.cancel()
+    return was_running
+
+
+async def _replay(file_name):
+    replay_stats.update(file=file_name, running=True, records=0,
+                        max_late_ms=0)
+    recorder.paused = True
+    try:
+        with open(file_name, 'rb') as log_file:
+            names = recorder.read_header(log_file)
+            if names is None:
+                print('%s is not a flight log' % file_name)
+                return
+            start_ms = time.ticks_ms()
+            at_ms = 0  # into the replay
+            last_ticks = None
+            for ticks, kind, code, a, b in recorder.read_records(log_file):
+                if kind == recorder.BOOT:
+                    last_ticks = None  # ticks restarted, no gap to keep
+                    robot_set_power(a)
+                    continue
+                if last_ticks is not None:
+                    at_ms += min(time.ticks_diff(ticks, last_ticks),
+                                 REPLAY_MAX_GAP_MS)
+                last_ticks = ticks
+                due_ms = time.ticks_diff(time.ticks_add(start_ms, at_ms),
+                                         time.ticks_ms())
+                if due_ms > 0:
+                    await asyncio.sleep_ms(due_ms)
+                elif -due_ms > replay_stats['max_late_ms']:
+                    replay_stats['max_late_ms'] = -due_ms
+                replay_stats['records'] += 1
+                if kind == recorder.SETPOINT:
+                    robot_set_motor_powers(a, b, -1 if code else None)
+                elif kind == recorder.COMMAND and code < len(names):
+                    cmd = valid_cmd_dict.get(names[code])
+                    if cmd is None or cmd in _not_replayed:
+                        continue
+                    cmd_ring.push(cmd, a if b else None, None,
+                                  cmd in motion_cmds)
+                    _cmd_flag.set()
+    finally:
+        recorder.paused = False
+        replay_stats['running'] = False
+        robot_stop()
+
+
+def get_recorder_status():
+    # flight log counters and the progress of a replay
+    result = recorder.stats()
+    result['replay'] = replay_stats
+    return json.dumps(result)
+
+
+# key received to setpoint handed to the control loop, the tick writes
+# the duty later and that shows up in get_latency_status' recv_to_duty
+wasd_stats = dict(
+    keys=0,
+    bursts=0,
+    last_us=0,
+    max_us=0,
+    total_us=0,
+)
+
+
+def get_wasd_status():
+    return json.dumps(wasd_stats)
 
 
 valid_cmds = [robot_stop,
@@ -250,18 +544,54 @@ valid_cmds = [robot_stop,
               robot_get_power,
               get_pins_status,
               get_motors_status,
+              get_queue_status,
+              get_wasd_status,
+              get_sound_bearing,
+              get_control_status,
+              get_latency_status,
+              get_wifi_status,
+              get_boot_status,
+              get_memory_status,
+              get_outbox_status,
+              get_broadcast_status,
+              get_deadman_status,
+              cancel_program,
+              get_program_status,
+              replay_flight,
+              stop_replay,
+              get_recorder_status,
+              robot_set_pwm_freq,
+              robot_set_pwm_bits,
+              robot_load_calibration,
+              get_driver_status,
               ]
 
 valid_cmd_dict = {cmd.__name__: cmd for cmd in valid_cmds}
+# flight log command codes
+_cmd_codes = {cmd: code for code, cmd in enumerate(valid_cmds)}
+# setpoint commands, a newer one queued behind an older one replaces it
+motion_cmds = (robot_stop,
+               robot_forward,
+               robot_backward,
+               robot_rotate_left,
+               robot_rotate_right,
+               robot_turn_left,
+               robot_turn_right,
+               )
+# the flight log has their setpoints, replay skips the commands themselves
+_not_replayed = motion_cmds + (cancel_program, replay_flight, stop_replay)
 # print(valid_cmd_dict)
 
 
 def execute_cmds(*cmds):
+    # runs the commands back to back on the motion timeline, returns at once
+    steps = []
     for cmd in cmds:
         # print(cmd)
         if cmd in valid_cmds:
-            print('Executing {}'.format(cmd.__name__))
-            cmd()
+            print('Scheduling {}'.format(cmd.__name__))
+            steps.append(cmd)
+    motion.run_sequence(steps)
 
 
 def websocket_on_accept(microWebSrv2, webSocket):
@@ -269,16 +599,23 @@ def websocket_on_accept(microWebSrv2, webSocket):
     print('   - User   : %s:%s' % webSocket.Request.UserAddress)
     print('   - Path   : %s' % webSocket.Request.Path)
     print('   - Origin : %s' % webSocket.Request.Origin)
+    if not outbox.register(webSocket):
+        print('# REFUSED, %d sockets open' % outbox.max_sockets)
+        webSocket.Close()
+        return
     if webSocket.Request.Path.lower() == '/controller_ws':
         controller_websocket_join(webSocket)
     elif webSocket.Request.Path.lower() == '/motors_ws':
         motors_websocket_join(webSocket)
+    elif webSocket.Request.Path.lower() == '/telemetry_ws':
+        telemetry_websocket_join(webSocket)
     else:
         print('Uknown ws path: "%s"' % webSocket.Request.Path.lower())
         webSocket.OnTextMessage = websocket_on_recv_text
         webSocket.OnBinaryMessage = websocket_on_recv_binary
         webSocket.OnClosed = websocket_on_close
         webSocket.Close()
+        outbox.unregister(webSocket)
 
 # ============================================================================
 # ============================================================================
@@ -289,10 +626,19 @@ global controller_ws
 controller_ws = None
 global motors_ws
 motors_ws = None
+# ack every binary frame with its seq, switched on by {"echo":1}
+motors_echo = False
 
+# guards controller_ws and motors_ws, nothing is sent while holding it,
+# every reply goes through the outbox
 global _wsLock
 _wsLock = allocate_lock()
 
+# wake the asyncio tasks, set from server threads and timer callbacks
+_cmd_flag = asyncio.ThreadSafeFlag()
+_motion_flag = asyncio.ThreadSafeFlag()
+_status_flag = asyncio.ThreadSafeFlag()
+
 
 def websocket_on_recv_text(webSocket, msg):
     pass
@@ -307,85 +653,160 @@ def websocket_on_recv_binary(webSocket, msg):
 
 
 def websocket_on_close(webSocket):
-    global controller_ws, motors_ws
+    global controller_ws, motors_ws, motors_echo
     print('WebSocket %s:%s closed' % webSocket.Request.UserAddress)
     if webSocket == controller_ws:
         controller_ws = None
     if webSocket == motors_ws:
         motors_ws = None
+        motors_echo = False
+        deadman.lost(deadman.WEBSOCKET)
+        deadman.reset_timeout(deadman.WEBSOCKET)
+    telemetry.remove_client(webSocket)
+    broadcast.remove_observer(webSocket)
+    outbox.unregister(webSocket)
 
 # ------------------------------------------------------------------------
 
 
 def controller_websocket_join(webSocket):
     global controller_ws
-    webSocket.OnTextMessage = controller_websocket_on_recv_text
     webSocket.OnClosed = websocket_on_close
     addr = webSocket.Request.UserAddress
     print('# Websocket join attempt from <%s:%s>' % addr)
-    accepted = True
     with _wsLock:
-        if controller_ws is None:
+        current = controller_ws
+        if current is None:
             controller_ws = webSocket
-            controller_ws.SendTextMessage('# HELLO <%s:%s>' % addr)
-        else:
-            webSocket.SendTextMessage('# REJECTED <%s:%s>' % addr)
-            controller_ws.SendTextMessage('# REJECTED <%s:%s>' % addr)
-            webSocket.Close()
-            accepted = False
-    if accepted:
+    if current is None:
+        webSocket.OnTextMessage = controller_websocket_on_recv_text
+        outbox.post_text(webSocket, '# HELLO <%s:%s>' % addr)
         print('# ACCEPTED <%s:%s>' % addr)
     else:
-        print('# REJECTED <%s:%s>' % addr)
+        _observer_join(webSocket, broadcast.CONTROLLER, current)
 
 
 def motors_websocket_join(webSocket):
     global motors_ws
-    webSocket.OnTextMessage = motors_websocket_on_recv_text
     webSocket.OnClosed = websocket_on_close
     addr = webSocket.Request.UserAddress
     print('# Websocket join attempt from <%s:%s>' % addr)
-    accepted = True
     with _wsLock:
-        if motors_ws is None:
+        current = motors_ws
+        if current is None:
             motors_ws = webSocket
-            motors_ws.SendTextMessage('# HELLO <%s:%s>' % addr)
-        else:
-            webSocket.SendTextMessage('# REJECTED <%s:%s>' % addr)
-            motors_ws.SendTextMessage('# REJECTED <%s:%s>' % addr)
-            webSocket.Close()
-            accepted = False
-    if accepted:
+    if current is None:
+        webSocket.OnTextMessage = motors_websocket_on_recv_text
+        webSocket.OnBinaryMessage = motors_websocket_on_recv_binary
+        outbox.post_text(webSocket, '# HELLO <%s:%s>' % addr)
         print('# ACCEPTED <%s:%s>' % addr)
     else:
-        print('# REJECTED <%s:%s>' % addr)
+        _observer_join(webSocket, broadcast.MOTORS, current)
+
+
+def _observer_join(webSocket, channel, driver):
+    # the driver seat is taken, watch the channel read only instead; the
+    # seat is free again once the driver disconnects
+    webSocket.OnTextMessage = observer_websocket_on_recv_text
+    webSocket.OnBinaryMessage = websocket_on_recv_binary
+    addr = webSocket.Request.UserAddress
+    outbox.post_text(webSocket, '# OBSERVER <%s:%s>' % addr)
+    outbox.post_text(driver, '# OBSERVER <%s:%s>' % addr)
+    broadcast.add_observer(channel, webSocket)
+    print('# OBSERVER <%s:%s>' % addr)
+
+
+def observer_websocket_on_recv_text(webSocket, msg):
+    outbox.post_text(webSocket, '{"result":"observer"}')
+
+
+def telemetry_websocket_join(webSocket):
+    # read only, any number of clients up to telemetry.MAX_CLIENTS
+    webSocket.OnTextMessage = telemetry_websocket_on_recv_text
+    webSocket.OnClosed = websocket_on_close
+    addr = webSocket.Request.UserAddress
+    print('# Telemetry join attempt from <%s:%s>' % addr)
+    if telemetry.add_client(webSocket):
+        outbox.post_text(webSocket, '# HELLO <%s:%s>' % addr)
+        print('# ACCEPTED <%s:%s>' % addr)
+        return
+    outbox.post_text(webSocket, '# REJECTED <%s:%s>' % addr, True)
+    print('# REJECTED <%s:%s>' % addr)
 # ------------------------------------------------------------------------
 
 
+def telemetry_websocket_on_recv_text(webSocket, msg):
+    # {"rate": samples per second, "batch": samples per frame}
+    try:
+        json_data = json.loads(msg)
+        telemetry.configure(webSocket,
+                            json_data.get('rate', telemetry.DEFAULT_RATE_HZ),
+                            json_data.get('batch', telemetry.DEFAULT_BATCH))
+    except (ValueError, TypeError, AttributeError):
+        outbox.post_text(webSocket, '{"result":"bad telemetry config"}')
+
+
 def controller_websocket_on_recv_text(webSocket, msg):
+    recv_us = time.ticks_us()
     json_data = json.loads(msg)
     cmd = None
     param = None
-    if 'cmd' not in json_data:
+    seq = -1
+    if 'seq' in json_data:
+        seq = int(json_data['seq'])
+    if 'program' in json_data:
+        # [[command, param, duration_ms], ...] in one message
+        cmd = run_program
+        param = json_data['program']
+    elif 'cmd' not in json_data:
         return
-    if json_data['cmd'] not in valid_cmd_dict:
+    elif json_data['cmd'] not in valid_cmd_dict:
         return
-    cmd = valid_cmd_dict[json_data['cmd']]
-    param = None
-    if 'param' in json_data:
-        param = json_data['param']
-        if param is not None:
-            try:
-                param = int(param)
-            except OSError:
-                pass
-    cmd_queue.append((cmd, param, webSocket))
+    else:
+        cmd = valid_cmd_dict[json_data['cmd']]
+        if 'param' in json_data:
+            param = json_data['param']
+            if param is not None:
+                try:
+                    param = int(param)
+                except (ValueError, TypeError):
+                    outbox.post_text(webSocket,
+                                     _result_message('error: bad param', seq))
+                    return
+    if not cmd_ring.push(cmd, param, webSocket, cmd in motion_cmds,
+                         seq, recv_us):
+        if cmd_ring.policy == cmd_ring.REJECT:
+            outbox.post_text(webSocket, _result_message('rejected', seq))
+        return
+    latency.record(latency.RECV_TO_ENQUEUE, recv_us)
+    _cmd_flag.set()
     print('%s(%s)' % (cmd.__name__, str(param), ))
 
 
+def _result_message(result, seq):
+    if seq < 0:
+        return '{"result":"%s"}' % str(result)
+    return '{"result":"%s","seq":%d}' % (str(result), seq)
+
+
+def _motors_ack(webSocket, seq, recv_us):
+    outbox.post_text(webSocket, '{"ack":%d}' % seq, recv_us=recv_us)
+
+
 def motors_websocket_on_recv_text(webSocket, msg):
-    global in1, in2, in3, in4
+    global motors_echo
+    recv_us = time.ticks_us()
     json_data = json.loads(msg)
+    if 'echo' in json_data:
+        motors_echo = bool(json_data['echo'])
+    if 'deadman' in json_data:
+        # {"deadman": ms} right after joining, answered with what was granted
+        try:
+            deadman.negotiate(deadman.WEBSOCKET, json_data['deadman'])
+        except (ValueError, TypeError):
+            pass
+        outbox.post_text(webSocket, '{"deadman":%d}' %
+                         deadman.timeout_ms[deadman.WEBSOCKET])
     if 'm1' not in json_data:
         return
     if 'm2' not in json_data:
@@ -398,44 +819,91 @@ def motors_websocket_on_recv_text(webSocket, msg):
     except OSError:
         webSocket.Close()
         pass
+    # fed first, a deadman check landing in between would otherwise find
+    # the old input age and stop the setpoint that was just set
+    deadman.feed(deadman.WEBSOCKET, motor1 != 0 or motor2 != 0)
     robot_set_motor_powers(motor1, motor2)
+    latency.expect_duty(recv_us, control_loop.target, control_loop.applied)
+    if 'seq' in json_data:
+        _motors_ack(webSocket, int(json_data['seq']), recv_us)
     # print('%s,%s' % (str(motor1), str(motor2)))
 
 
+def motors_websocket_on_recv_binary(webSocket, msg):
+    # compact alternative to the json frames, see motor_frame.py
+    recv_us = time.ticks_us()
+    if not motor_frame.decode(msg):
+        webSocket.Close()
+        return
+    deadman.feed(deadman.WEBSOCKET, motor_frame.frame[motor_frame.M1] != 0 or
+                 motor_frame.frame[motor_frame.M2] != 0)
+    robot_set_motor_powers(motor_frame.frame[motor_frame.M1],
+                           motor_frame.frame[motor_frame.M2])
+    latency.expect_duty(recv_us, control_loop.target, control_loop.applied)
+    if motors_echo:
+        _motors_ack(webSocket, motor_frame.frame[motor_frame.SEQ], recv_us)
+
+
 # ============================================================================
 # ============================================================================
 # ============================================================================
 
 
-# Loads the WebSockets module globally and configure it,
-wsMod = MicroWebSrv2.LoadModule('WebSockets')
-wsMod.OnWebSocketAccepted = websocket_on_accept
-mws2 = MicroWebSrv2()
-mws2.SetEmbeddedConfig()
-# All pages not found will be redirected to the home '/',
-mws2.NotFoundURL = 'https://alpsayin.com'
-mws2.StartManaged()
+wsMod = None
+mws2 = None
+
+
+def start_web_server():
+    # only once the motors are safe, websocket handlers can drive them
+    global wsMod, mws2
+    from MicroWebSrv2 import MicroWebSrv2
+    # Loads the WebSockets module globally and configure it,
+    wsMod = MicroWebSrv2.LoadModule('WebSockets')
+    wsMod.OnWebSocketAccepted = websocket_on_accept
+    mws2 = MicroWebSrv2()
+    mws2.SetEmbeddedConfig()
+    # All pages not found will be redirected to the home '/',
+    mws2.NotFoundURL = 'https://alpsayin.com'
+    mws2.StartManaged()
 
 
 def prepare_status_string():
-    global status_dict, in1, in2, in3, in4
+    global status_dict
     status_dict['mem_free'] = gc.mem_free()
     status_dict['pin_str'] = get_pins_status()
-    s = 'Uptime: {seconds: 5d}s\tpins:{pin_str}\tmem_free:{mem_free}'.format(
-        **status_dict)
+    status_dict['queue'] = cmd_ring.depth()
+    status_dict['dropped'] = cmd_ring.dropped + cmd_ring.rejected
+    status_dict['jitter_us'] = control_loop.max_jitter_us
+    status_dict['overruns'] = control_loop.overruns
+    status_dict['rssi'] = wlan_wrapper.link['rssi']
+    status_dict['outages'] = wlan_wrapper.link['outages']
+    status_dict['outage_ms'] = wlan_wrapper.link['outage_ms']
+    status_dict['reconnect_ms'] = wlan_wrapper.link['reconnect_ms']
+    status_dict['heap_low'] = memory.low_water
+    status_dict['gc_count'] = memory.collections
+    status_dict['gc_max_us'] = memory.max_pause_us
+    status_dict['tx_dropped'] = outbox.texts_dropped + outbox.stale_dropped
+    status_dict['deadman'] = deadman.stops[deadman.WEBSOCKET] + \
+        deadman.stops[deadman.BLUETOOTH]
+    status_dict['deadman_ms'] = max(deadman.max_stop_ms)
+    s = ('Uptime: {seconds: 5d}s\tpins:{pin_str}\tmem_free:{mem_free}'
+         '\tqueue:{queue}\tdropped:{dropped}'
+         '\tjitter:{jitter_us}us\toverruns:{overruns}'
+         '\trssi:{rssi}\toutages:{outages}\toutage:{outage_ms}ms'
+         '\treconnect:{reconnect_ms}ms'
+         '\theap_low:{heap_low}\tgc:{gc_count}'
+         '\tgc_max:{gc_max_us}us\ttx_dropped:{tx_dropped}'
+         '\tdeadman:{deadman}\tdeadman_max:{deadman_ms}ms'
+         ).format(**status_dict)
     return s
 
 
 def init_gpio():
-    global in1, in2, in3, in4
-    pin1.value(0)
-    pin2.value(0)
-    pin3.value(0)
-    pin4.value(0)
-    in1.duty(0)
-    in2.duty(0)
-    in3.duty(0)
-    in4.duty(0)
+    motors.stop()
+    # a broken file leaves the motors uncalibrated rather than stopping boot
+    result = robot_load_calibration()
+    if result.startswith('error'):
+        print('%s: %s' % (MOTOR_CALIBRATION_FILE, result))
 
 
 def print_status():
@@ -444,143 +912,344 @@ def print_status():
     status_dict['seconds'] += HEARTBEAT_PERIOD
 
 
-def heartbeat_callback(timer_obj):
-    global heartbeat_timer_flag
-    heartbeat_timer_flag = True
-
-
-def init_heartbeat_timer():
-    heartbeat.init(
-        period=HEARTBEAT_PERIOD * 1000,
-        mode=Timer.PERIODIC,
-        callback=heartbeat_callback
-    )
-
-
 def print_help():
     print('# boot.py script defines easy-to-type shorthands for robot control')
     print('')
-    print('''
-        robot_stop
-        robot_backward
-        robot_forward
-        robot_rotate_left
-        robot_rotate_right
-        robot_turn_left
-        robot_turn_right
-        robot_wait
-        robot_wait_1s
-        robot_wait_5s
-        execute_cmds
-        robot_get_power
-        robot_set_power
-        print_status
-        print_help
-        get_pins_status
-        get_motors_status
-
-        robot_stop as stop
-        robot_stop as rs
-        robot_backward as b
-        robot_forward as f
-        robot_rotate_left as rl
-        robot_rotate_right as rr
-        robot_turn_left as tl
-        robot_turn_right as tr
-        robot_wait as rw
-        robot_wait_1s as rw1
-        robot_wait_5s as rw5
-        execute_cmds as ec
-        robot_get_power as getpow, robot_set_power as setpow
-        get_pins_status as getpins
-        get_motors_status as getmotors
-        print_help as robot_help
-    ''')
+    for cmd in repl_cmds:
+        print('        %s' % cmd.__name__)
+    print('')
+    for alias, cmd in repl_aliases:
+        print('        %s as %s' % (cmd.__name__, alias))
     print('')
-    print('# You can issue multiple commands like below:')
-    print('f(), rl(), rl(), rl(), b(), b()')
-    print('# Or you can use the ec shorthand:')
+    print('# Every motion command pre-empts the one before it, so f(), b()')
+    print('# only drives backward; to run commands one after another use ec:')
     print('ec(f, rw1, rl, rw, rl, rw, rl, rw5, b, b)')
     print('')
 
 
-def WASD_robot_handler_task(read_period_ms=100):
-    global cmd_queue
+# everything boot.py puts into the repl, the network commands plus the
+# repl only helpers, and their easy-to-type shorthands
+repl_cmds = valid_cmds + [execute_cmds,
+                          run_program,
+                          print_status,
+                          print_help,
+                          ]
+repl_aliases = (('stop', robot_stop),
+                ('rs', robot_stop),
+                ('b', robot_backward),
+                ('f', robot_forward),
+                ('rl', robot_rotate_left),
+                ('rr', robot_rotate_right),
+                ('tl', robot_turn_left),
+                ('tr', robot_turn_right),
+                ('rw', robot_wait),
+                ('rw1', robot_wait_1s),
+                ('rw5', robot_wait_5s),
+                ('ec', execute_cmds),
+                ('getpow', robot_get_power),
+                ('setpow', robot_set_power),
+                ('getpins', get_pins_status),
+                ('getmotors', get_motors_status),
+                ('getqueue', get_queue_status),
+                ('getwasd', get_wasd_status),
+                ('getbearing', get_sound_bearing),
+                ('getcontrol', get_control_status),
+                ('getlatency', get_latency_status),
+                ('getwifi', get_wifi_status),
+                ('rp', run_program),
+                ('cp', cancel_program),
+                ('getprogram', get_program_status),
+                ('getboot', get_boot_status),
+                ('getmem', get_memory_status),
+                ('getout', get_outbox_status),
+                ('getbcast', get_broadcast_status),
+                ('getdeadman', get_deadman_status),
+                ('replay', replay_flight),
+                ('stopreplay', stop_replay),
+                ('getrec', get_recorder_status),
+                ('setfreq', robot_set_pwm_freq),
+                ('setbits', robot_set_pwm_bits),
+                ('loadcal', robot_load_calibration),
+                ('getdriver', get_driver_status),
+                ('robot_help', print_help),
+                )
+
+
+def repl_namespace():
+    # boot.py: globals().update(app.repl_namespace())
+    names = {cmd.__name__: cmd for cmd in repl_cmds}
+    for alias, cmd in repl_aliases:
+        names[alias] = cmd
+    return names
+
+
+# WASD bluetooth keys, byte -> action index into the quarter power tables
+_wasd_action = bytearray(256)
+_wasd_action[ord('w')] = 1
+_wasd_action[ord('s')] = 2
+_wasd_action[ord('a')] = 3
+_wasd_action[ord('d')] = 4
+_wasd_action[ord('h')] = 5
+# motor power in quarters of power_level per action, index 0 is unused
+_wasd_m1_quarters = array('b', [0, 4, -4, 1, 4, 0])
+_wasd_m2_quarters = array('b', [0, 4, -4, 4, 1, 0])
+_wasd_rx_buf = bytearray(uart_wrapper.RXBUF_LEN)
+
+
+def _wasd_dispatch(nbytes):
+    # a burst only matters for its last valid key
+    idx = nbytes - 1
+    while idx >= 0:
+        action = _wasd_action[_wasd_rx_buf[idx]]
+        if action:
+            # the bluetooth app sends a key once, not as a stream
+            deadman.feed(deadman.BLUETOOTH,
+                         _wasd_m1_quarters[action] != 0 or
+                         _wasd_m2_quarters[action] != 0)
+            robot_set_motor_powers(
+                power_level * _wasd_m1_quarters[action] // 4,
+                power_level * _wasd_m2_quarters[action] // 4,
+                -1)
+            return True
+        idx -= 1
+    return False
+
+
+async def WASD_robot_handler_task():
+    # the stream wakes this task as soon as the uart has data
+    reader = asyncio.StreamReader(uart_wrapper.raw_uart)
     while True:
-        time.sleep_ms(read_period_ms)
-        if uart_wrapper.is_bluetooth_connected():
-            while uart_wrapper.raw_uart.any():
-                single_char = uart_wrapper.raw_uart.read(1)
-                if single_char == b'w':
-                    robot_set_motor_powers(power_level, power_level)
-                if single_char == b's':
-                    robot_set_motor_powers(-power_level, -power_level)
-                if single_char == b'a':
-                    robot_set_motor_powers(int(power_level/4), power_level)
-                if single_char == b'd':
-                    robot_set_motor_powers(power_level, int(power_level/4))
-                if single_char == b'h':
-                    robot_set_motor_powers(0, 0)
+        nbytes = await reader.readinto(_wasd_rx_buf)
+        if not nbytes or not uart_wrapper.is_bluetooth_connected():
+            continue
+        received_us = time.ticks_us()
+        if _wasd_dispatch(nbytes):
+            latency.expect_duty(received_us, control_loop.target,
+                                control_loop.applied)
+            elapsed_us = time.ticks_diff(time.ticks_us(), received_us)
+            wasd_stats['keys'] += 1
+            wasd_stats['last_us'] = elapsed_us
+            wasd_stats['total_us'] += elapsed_us
+            if elapsed_us > wasd_stats['max_us']:
+                wasd_stats['max_us'] = elapsed_us
+        wasd_stats['bursts'] += 1
 
 
 def main_init():
     global status_dict
 
     machine.freq(DEVICE_FREQ)
+    _mark_boot('freq')
 
     init_gpio()
+    # every target goes to the flight log, streamed, timed or programmed
+    control_loop.init(_apply_motor_powers,
+                      CONTROL_RATE_HZ,
+                      CONTROL_SLEW_PER_S,
+                      recorder.setpoint)
+    motion.init(_stop_motors, _motion_flag.set)
+    program.init(control_loop.set_target)
+    cmd_ring.init(CMD_QUEUE_LEN, CMD_QUEUE_POLICY)
+    outbox.init(MAX_WEBSOCKETS)
+    broadcast.init(_controller_state,
+                   get_motors_status,
+                   BROADCAST_MIN_PERIOD_MS)
+    _mark_boot('motors_safe')
+
+    # touches flash, so after the motors are safe
+    recorder.init([cmd.__name__ for cmd in valid_cmds],
+                  FLIGHT_LOG_MAX_BYTES,
+                  power_level)
+    _mark_boot('recorder')
 
     uart_wrapper.init()
+    deadman.init(_stop_motors,
+                 DEADMAN_WEBSOCKET_MS,
+                 DEADMAN_BLUETOOTH_MS,
+                 uart_wrapper.is_bluetooth_connected)
+    _mark_boot('uart')
 
     print_help()
 
-    init_wlan_result = wlan_wrapper.init_wifi(
+    # wifi_task finishes the connection while everything else runs
+    wlan_wrapper.begin_connect(
         WLAN_SSID,
         WLAN_KEY,
         DHCP_HOSTNAME,
-        timeout=10)
+        WLAN_REUSE_IP)
+    _mark_boot('wifi_begin')
 
-    if(init_wlan_result):
-        status_dict.update(hostname=wlan_wrapper.wlan.config('dhcp_hostname'))
-        print('Wifi initialised')
+    start_web_server()
+    _mark_boot('web_server')
 
-    init_heartbeat_timer()
+    mic_array.init()
+    _mark_boot('mics')
 
-    init_mic_timers()
-    set_mic_isrs()
+    # everything long-lived is allocated by now
+    memory.init(GC_ALLOC_THRESHOLD, GC_FREE_FLOOR)
+    _mark_boot('gc')
 
     print('\nPress CTRL-C to drop to REPL to control the robot with existing functions\n')  # noqa E501
 
 
-def heartbeat_task():
-    # print_status()
-    # TODO: flip a led here
-    pass
+def _on_wifi_up():
+    status_dict.update(hostname=wlan_wrapper.wlan.config('dhcp_hostname'))
+    print('Wifi initialised')
+    if _first_wifi_up:
+        _mark_first('wifi_up')
+
+
+def _on_wifi_down():
+    # nobody can steer over the network any more, bluetooth still can
+    if not uart_wrapper.is_bluetooth_connected():
+        robot_stop()
+
+
+def _robot_idle():
+    # nothing moves and nobody could start it, the wifi cache's bssid scan
+    # stalls the control tick and the deadman for seconds
+    return not (control_loop.target[0] or control_loop.target[1] or
+                control_loop.applied[0] or control_loop.applied[1] or
+                motion.is_busy() or cmd_ring.depth() or
+                replay_stats['running'] or outbox.socket_count() or
+                uart_wrapper.is_bluetooth_connected())
+
+
+async def wifi_task():
+    init_wlan_result = await wlan_wrapper.connect_task(WLAN_CONNECT_TIMEOUT_MS)
+    if(init_wlan_result):
+        _on_wifi_up()
+    await wlan_wrapper.supervise_task(HEARTBEAT_PERIOD * 1000,
+                                      _on_wifi_down,
+                                      _on_wifi_up,
+                                      _robot_idle)
+
+
+async def heartbeat_task():
+    while True:
+        await asyncio.sleep(HEARTBEAT_PERIOD)
+        # print_status()
+        # TODO: flip a led here
+
+
+# command, param and result of the last command run, for the observers
+_last_command = [None, None, None]
+
+
+def _controller_state():
+    cmd, param, result = _last_command
+    return json.dumps({'cmd': cmd.__name__ if cmd else None,
+                       'param': param,
+                       'result': str(result)})
+
+
+def _run_entry(cmd, param, websocket):
+    if cmd is motion.release:
+        cmd(param)  # queued by robot_set_motor_powers, not a command
+        return
+    if _first_command:
+        _mark_first('first_command')
+    recv_us = cmd_ring.last_recv_us
+    start_us = latency.record(latency.QUEUE_WAIT, cmd_ring.last_enqueue_us)
+    code = _cmd_codes.get(cmd)
+    if code is not None:
+        recorder.command(code, param)
+    if param is not None:
+        result = cmd(param)
+    else:
+        result = cmd()
+    done_us = latency.record(latency.EXECUTE, start_us)
+    _last_command[0] = cmd
+    _last_command[1] = param
+    _last_command[2] = result
+    broadcast.update(broadcast.CONTROLLER)
+    if websocket:
+        if cmd in motion_cmds:
+            latency.expect_duty(recv_us, control_loop.target,
+                                control_loop.applied)
+        # results of a burst of commands leave as one frame
+        outbox.post_text(websocket,
+                         _result_message(result, cmd_ring.last_seq),
+                         defer=True, recv_us=recv_us, done_us=done_us)
+
+
+def process_cmd_queue():
+    while cmd_ring.depth():
+        entry = cmd_ring.pop()
+        if entry is None:
+            break
+        cmd, param, websocket = entry
+        try:
+            _run_entry(cmd, param, websocket)
+        except Exception as ex:
+            # one bad command must not end cmd_task and the whole loop
+            print('%s failed: %r' % (cmd.__name__, ex))
+            if websocket:
+                outbox.post_text(websocket,
+                                 _result_message(
+                                     'error: %s' % type(ex).__name__,
+                                     cmd_ring.last_seq),
+                                 defer=True)
+    outbox.flush()
+
+
+async def cmd_task():
+    while True:
+        process_cmd_queue()
+        await _cmd_flag.wait()
+
+
+async def motion_task():
+    # backstop for the motion timer, sleeps until the deadline it was given
+    while True:
+        await _motion_flag.wait()
+        remaining_ms = motion.remaining_ms()
+        while remaining_ms >= 0:
+            await asyncio.sleep_ms(remaining_ms + MOTION_BACKSTOP_SLACK_MS)
+            motion.service()
+            remaining_ms = motion.remaining_ms()
+
+
+async def motor_status_task():
+    # flushes a uart status line that _emit_motor_status had to hold back
+    while True:
+        await _status_flag.wait()
+        wait_ms = MOTOR_STATUS_MIN_INTERVAL_MS - time.ticks_diff(
+            time.ticks_ms(), _motor_status_last_ms)
+        if wait_ms > 0:
+            await asyncio.sleep_ms(wait_ms)
+        _emit_motor_status()
+
+
+async def run_tasks():
+    _mark_boot('loop')
+    await asyncio.gather(
+        cmd_task(),
+        motion_task(),
+        motor_status_task(),
+        WASD_robot_handler_task(),
+        mic_array.task(),
+        telemetry.task(),
+        outbox.task(),
+        broadcast.task(),
+        recorder.task(),
+        memory.task(),
+        wifi_task(),
+        heartbeat_task(),
+    )
 
 
 def main():
-    global heartbeat_timer_flag, publish_timer_flag, status_dict, cmd_queue
     main_init()
-    start_new_thread(WASD_robot_handler_task, (100,))
+    # the motors are safe and wifi is connecting meanwhile
+    repl_drop.wait(BOOT_TIME)
+    _mark_boot('repl_drop')
     try:
-        while True:
-            machine.idle()  # wait until cpu wake
-            # Periodic Heartbeat Task
-            if heartbeat_timer_flag:
-                heartbeat_timer_flag = False
-                heartbeat_task()
-
-            while cmd_queue:
-                cmd, param, websocket = cmd_queue.pop()
-                if param:
-                    result = cmd(param)
-                else:
-                    result = cmd()
-                if websocket:
-                    with _wsLock:
-                        websocket.SendTextMessage(
-                            '{"result":"%s"}' % str(result))
-
+        asyncio.run(run_tasks())
     except KeyboardInterrupt:
         print('Caught CTRL-C')
-        pass
+    finally:
+        asyncio.new_event_loop()  # clear the tasks left behind
+
+
+_mark_boot('app_loaded')
@@ -4,37 +4,7 @@ import webrepl
 print('boot.py')
 webrepl.start()
 
-from app import robot_stop
-from app import robot_backward
-from app import robot_forward
-from app import robot_rotate_left
-from app import robot_rotate_right
-from app import robot_turn_left
-from app import robot_turn_right
-from app import robot_wait
-from app import robot_wait_1s
-from app import robot_wait_5s
-from app import execute_cmds
-from app import robot_get_power
-from app import robot_set_power
-from app import print_status
-from app import print_help
-from app import get_pins_status
-from app import get_motors_status
-
-from app import robot_stop as stop
-from app import robot_stop as rs
-from app import robot_backward as b
-from app import robot_forward as f
-from app import robot_rotate_left as rl
-from app import robot_rotate_right as rr
-from app import robot_turn_left as tl
-from app import robot_turn_right as tr
-from app import robot_wait as rw
-from app import robot_wait_1s as rw1
-from app import robot_wait_5s as rw5
-from app import execute_cmds as ec
-from app import robot_get_power as getpow, robot_set_power as setpow
-from app import get_pins_status as getpins
-from app import get_motors_status as getmotors
-from app import print_help as robot_help
\ No newline at end of file
+# a single import puts every command and its shorthand into the repl,
+# see repl_cmds and repl_aliases in app.py
+import app  # noqa E402
+globals().update(app.repl_namespace())
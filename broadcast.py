@@ -0,0 +1,114 @@
+from micropython import const
+from _thread import allocate_lock
+import uasyncio as asyncio
+import outbox
+
+# one active driver per channel, any number of read-only observers up to
+# the outbox socket cap; observers get the channel state, serialised once
+# per update and shared by all of them
+CONTROLLER = const(0)
+MOTORS = const(1)
+CHANNELS = const(2)
+CHANNEL_NAMES = ('controller', 'motors')
+DEFAULT_MIN_PERIOD_MS = const(50)  # at most 20 updates per second
+
+_lock = allocate_lock()  # serialises server threads adding and removing
+# tuples replaced as a whole, the task iterates them without the lock
+_observers = [(), ()]
+_dirty = bytearray(CHANNELS)
+_serializers = [None] * CHANNELS
+_min_period_ms = DEFAULT_MIN_PERIOD_MS
+_flag = asyncio.ThreadSafeFlag()
+
+# counters
+updates = 0  # update() calls, from the driver path
+broadcasts = 0  # serialised states, at most one per channel per period
+posted = 0  # frames handed to the outbox
+
+
+def init(controller_state, motors_state, min_period_ms=DEFAULT_MIN_PERIOD_MS):
+    # *_state() return the current state of a channel as a text frame
+    global _min_period_ms
+    _serializers[CONTROLLER] = controller_state
+    _serializers[MOTORS] = motors_state
+    _min_period_ms = min_period_ms
+
+
+def add_observer(channel, websocket):
+    with _lock:
+        if websocket not in _observers[channel]:
+            _observers[channel] = _observers[channel] + (websocket,)
+    # a new observer gets the current state straight away
+    _dirty[channel] = 1
+    _flag.set()
+
+
+def remove_observer(websocket):
+    with _lock:
+        for channel in range(CHANNELS):
+            if websocket in _observers[channel]:
+                _observers[channel] = tuple(
+                    ws for ws in _observers[channel] if ws is not websocket)
+
+
+def is_observer(websocket):
+    for channel in range(CHANNELS):
+        if websocket in _observers[channel]:
+            return True
+    return False
+
+
+def observer_count(channel=None):
+    if channel is not None:
+        return len(_observers[channel])
+    return sum(len(observers) for observers in _observers)
+
+
+def update(channel):
+    # cheap enough for the driver path and the control tick, the state is
+    # only serialised later by the task
+    global updates
+    updates += 1
+    if _observers[channel]:
+        _dirty[channel] = 1
+        _flag.set()
+
+
+def service():
+    # fans out every changed channel, returns the number of frames posted
+    global broadcasts, posted
+    count = 0
+    for channel in range(CHANNELS):
+        if not _dirty[channel]:
+            continue
+        _dirty[channel] = 0
+        observers = _observers[channel]
+        if not observers:
+            continue
+        msg = _serializers[channel]()
+        broadcasts += 1
+        for websocket in observers:
+            # a state an observer has not received yet is simply replaced
+            if outbox.post_latest(websocket, msg):
+                count += 1
+    posted += count
+    return count
+
+
+async def task():
+    while True:
+        await _flag.wait()
+        service()
+        await asyncio.sleep_ms(_min_period_ms)
+
+
+def stats():
+    result = {
+        'updates': updates,
+        'broadcasts': broadcasts,
+        'posted': posted,
+        'min_period_ms': _min_period_ms,
+    }
+    for channel in range(CHANNELS):
+        result[CHANNEL_NAMES[channel]] = len(_observers[channel])
+    return result
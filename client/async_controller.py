@@ -0,0 +1,269 @@
+import asyncio
+import struct
+import time
+import websockets
+from pynput import keyboard
+import simplejson as json
+import simple_controller as controller
+
+# matches telemetry.py on the robot
+TELEMETRY_HEADER = struct.Struct('<BBH')
+TELEMETRY_SAMPLE = struct.Struct('<IhhIHHH')
+PRINT_PERIOD = 0.5  # s, status line refresh
+RECONNECT_MIN_DELAY = 0.5  # s, doubles on every failed attempt
+RECONNECT_MAX_DELAY = 8.0
+TELEMETRY = False
+
+ARROW_KEYS = {
+    keyboard.Key.up: 'up',
+    keyboard.Key.down: 'down',
+    keyboard.Key.left: 'left',
+    keyboard.Key.right: 'right',
+}
+
+
+class RobotLink:
+    """One robot, its motors_ws writer and the tasks reading from it.
+
+    Key events arrive on an asyncio.Queue from the keyboard listener
+    thread, so the arrow key state is only ever touched by the event loop.
+    """
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.keys = asyncio.Queue()
+        self.connected = asyncio.Event()
+        self.ws = None
+        self.seq = 0
+        self.last_sent = None
+        self.last_send_time = 0.0
+        self.pending_acks = {}
+        self.round_trips = []
+        self.telemetry = None  # latest sample tuple, see TELEMETRY_SAMPLE
+        self.frames_sent = 0
+        self.send_failures = 0
+        self.send_time_total = 0.0  # s spent in ws.send
+        self.send_time_max = 0.0
+        self.reconnects = 0
+        self.connects = 0
+        self.running = True
+
+    def start_listener(self):
+        loop = asyncio.get_running_loop()
+
+        def on_press(key):
+            loop.call_soon_threadsafe(self.keys.put_nowait, (key, True))
+
+        def on_release(key):
+            loop.call_soon_threadsafe(self.keys.put_nowait, (key, False))
+            if key == keyboard.Key.esc:
+                return False
+
+        listener = keyboard.Listener(on_press=on_press,
+                                     on_release=on_release)
+        listener.start()
+        return listener
+
+    def apply_key(self, key, pressed):
+        if key == keyboard.Key.esc and not pressed:
+            self.running = False
+            return
+        name = ARROW_KEYS.get(key)
+        if name is not None:
+            setattr(controller, name, pressed)
+
+    async def connection_task(self):
+        delay = RECONNECT_MIN_DELAY
+        while self.running:
+            try:
+                async with websockets.connect(
+                        f'ws://{self.hostname}/motors_ws',
+                        open_timeout=2) as ws:
+                    hello = await ws.recv()
+                    print(f'\n{self.hostname} welcome message = {hello}')
+                    await ws.send(controller.join_message())
+                    self.ws = ws
+                    self.last_sent = None  # resend the setpoint right away
+                    self.connected.set()
+                    if self.connects:
+                        self.reconnects += 1
+                    self.connects += 1
+                    delay = RECONNECT_MIN_DELAY
+                    await self.reader(ws)
+            except (OSError, asyncio.TimeoutError,
+                    websockets.exceptions.WebSocketException) as ex:
+                print(f'\n{self.hostname} motors_ws: {ex!r}, '
+                      f'retrying in {delay:.1f} s')
+            self.connected.clear()
+            self.ws = None
+            if not self.running:
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def reader(self, ws):
+        # returns when the socket closes
+        try:
+            async for msg in ws:
+                received = time.perf_counter()
+                if isinstance(msg, bytes):
+                    continue
+                # the robot batches replies, one json object per line
+                for line in msg.split('\n'):
+                    try:
+                        seq = json.loads(line)['ack']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    sent = self.pending_acks.pop(seq, None)
+                    if sent is not None:
+                        self.round_trips.append(received - sent)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def telemetry_task(self):
+        delay = RECONNECT_MIN_DELAY
+        while self.running:
+            try:
+                async with websockets.connect(
+                        f'ws://{self.hostname}/telemetry_ws',
+                        open_timeout=2) as ws:
+                    delay = RECONNECT_MIN_DELAY
+                    async for msg in ws:
+                        if isinstance(msg, bytes):
+                            self.decode_telemetry(msg)
+            except (OSError, asyncio.TimeoutError,
+                    websockets.exceptions.WebSocketException):
+                pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def decode_telemetry(self, frame):
+        if len(frame) < TELEMETRY_HEADER.size:
+            return
+        _, count, _ = TELEMETRY_HEADER.unpack_from(frame)
+        if count and len(frame) >= \
+                TELEMETRY_HEADER.size + count * TELEMETRY_SAMPLE.size:
+            self.telemetry = TELEMETRY_SAMPLE.unpack_from(
+                frame,
+                TELEMETRY_HEADER.size + (count - 1) * TELEMETRY_SAMPLE.size)
+
+    async def writer_task(self):
+        # sends on key changes right away, rate limited by MAX_RATE, and
+        # repeats the setpoint every KEEPALIVE_PERIOD while idle
+        min_interval = 1.0 / controller.MAX_RATE
+        while self.running:
+            try:
+                key, pressed = await asyncio.wait_for(
+                    self.keys.get(),
+                    controller.keepalive_wait(self.last_send_time))
+                self.apply_key(key, pressed)
+            except asyncio.TimeoutError:
+                pass
+            wait = min_interval - (time.perf_counter() - self.last_send_time)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            # fold in whatever arrived meanwhile
+            while not self.keys.empty():
+                self.apply_key(*self.keys.get_nowait())
+            if not self.connected.is_set():
+                continue
+            motors_powers = controller.compute_motor_speeds()
+            now = time.perf_counter()
+            if motors_powers == self.last_sent and \
+                    now - self.last_send_time < controller.KEEPALIVE_PERIOD:
+                continue
+            await self.send(motors_powers)
+            self.last_sent = motors_powers
+            self.last_send_time = now
+        if self.connected.is_set():
+            await self.send({'m1': 0, 'm2': 0})
+
+    async def send(self, motors_powers):
+        seq = self.seq
+        self.seq = (seq + 1) & 0xFFFF
+        if controller.BINARY:
+            msg = controller.MOTOR_FRAME.pack(
+                seq, motors_powers['m1'], motors_powers['m2'])
+        else:
+            if controller.ECHO:
+                motors_powers = dict(motors_powers, seq=seq)
+            msg = json.dumps(motors_powers, separators=(',', ':'))
+        if controller.ECHO:
+            self.pending_acks[seq] = time.perf_counter()
+        start = time.perf_counter()
+        try:
+            await self.ws.send(msg)
+        except (AttributeError, websockets.exceptions.ConnectionClosed):
+            self.send_failures += 1
+            return False
+        elapsed = time.perf_counter() - start
+        self.frames_sent += 1
+        self.send_time_total += elapsed
+        self.send_time_max = max(self.send_time_max, elapsed)
+        return True
+
+    async def print_task(self):
+        # one status line, refreshed at most every PRINT_PERIOD
+        while self.running:
+            await asyncio.sleep(PRINT_PERIOD)
+            line = (f'\r{"up" if self.connected.is_set() else "DOWN"} '
+                    f'{controller.compute_motor_speeds()} '
+                    f'sent:{self.frames_sent} fail:{self.send_failures} '
+                    f'reconnects:{self.reconnects}')
+            if self.round_trips:
+                line += f' rtt:{self.round_trips[-1] * 1000:.1f}ms'
+            if self.telemetry is not None:
+                line += (f' robot m1:{self.telemetry[1]} '
+                         f'm2:{self.telemetry[2]} '
+                         f'mem:{self.telemetry[3]}')
+            print(line, end='', flush=True)
+
+    def print_stats(self):
+        print(f'\nframes sent: {self.frames_sent}, '
+              f'send failures: {self.send_failures}, '
+              f'reconnects: {self.reconnects}')
+        if self.round_trips:
+            values = sorted(self.round_trips)
+            print(f'round trip ({len(values)} acked): '
+                  f'p50 {controller.percentile(values, 50) * 1000:.2f} ms, '
+                  f'p95 {controller.percentile(values, 95) * 1000:.2f} ms, '
+                  f'p99 {controller.percentile(values, 99) * 1000:.2f} ms')
+
+
+async def run(link):
+    link.start_listener()
+    tasks = [
+        asyncio.create_task(link.connection_task()),
+        asyncio.create_task(link.writer_task()),
+        asyncio.create_task(link.print_task()),
+    ]
+    if TELEMETRY:
+        tasks.append(asyncio.create_task(link.telemetry_task()))
+    # the writer returns once esc was released
+    await tasks[1]
+    for task in tasks:
+        task.cancel()
+    if link.ws is not None:
+        await link.ws.close()
+
+
+def main():
+    global TELEMETRY
+    parser = controller.build_parser(
+        'asyncio esp32 robot controller with arrow keys, esc quits')
+    parser.add_argument(
+        '--telemetry', '-tm',
+        action='store_true',
+        help='Also subscribe to /telemetry_ws and show the robot state')
+    vargs = controller.process_args(parser)
+    TELEMETRY = vargs['telemetry']
+    link = RobotLink(controller.HOSTNAME)
+    try:
+        asyncio.run(run(link))
+    except KeyboardInterrupt:
+        print('Caught CTRL-C')
+    link.print_stats()
+
+
+if __name__ == '__main__':
+    main()
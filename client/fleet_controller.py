@@ -0,0 +1,269 @@
+import asyncio
+import time
+import websockets
+from pynput import keyboard
+import simplejson as json
+import simple_controller as controller
+from async_controller import RobotLink, ARROW_KEYS
+
+STANDIN_FIRST_PORT = 8765
+SELECT_KEYS = '0123456789'  # 0 drives every robot, n drives robot n only
+
+
+class FleetLink(RobotLink):
+    """RobotLink with a one slot mailbox feeding its own sender task.
+
+    The fleet writer only drops the newest setpoint into the mailbox, so a
+    robot stuck on a slow or dead socket never delays the others.
+    """
+
+    def __init__(self, hostname):
+        super().__init__(hostname)
+        self.mailbox = None
+        self.wake = asyncio.Event()
+        self.overwritten = 0  # setpoints replaced before they were sent
+
+    def post(self, motors_powers):
+        if self.mailbox is not None:
+            self.overwritten += 1
+        self.mailbox = motors_powers
+        self.wake.set()
+
+    async def sender_task(self):
+        while self.running:
+            await self.wake.wait()
+            self.wake.clear()
+            if self.mailbox is None or not self.connected.is_set():
+                continue
+            motors_powers = self.mailbox
+            self.mailbox = None
+            await self.send(motors_powers)
+
+    def stats(self):
+        attempts = self.frames_sent + self.send_failures
+        values = sorted(self.round_trips)
+        return {
+            'host': self.hostname,
+            'connected': self.connected.is_set(),
+            'sent': self.frames_sent,
+            'failures': self.send_failures,
+            'error_rate': self.send_failures / attempts if attempts else 0.0,
+            'overwritten': self.overwritten,
+            'reconnects': self.reconnects,
+            'send_avg_ms': (self.send_time_total / self.frames_sent * 1000
+                            if self.frames_sent else 0.0),
+            'send_max_ms': self.send_time_max * 1000,
+            'rtt_p50_ms': (controller.percentile(values, 50) * 1000
+                           if values else None),
+            'rtt_p95_ms': (controller.percentile(values, 95) * 1000
+                           if values else None),
+        }
+
+
+class Fleet:
+    """Pool of persistent motors_ws connections, one per robot."""
+
+    def __init__(self, hostnames):
+        self.links = [FleetLink(hostname) for hostname in hostnames]
+        self.keys = asyncio.Queue()
+        self.selected = 0  # 0 for all, else 1 based robot index
+        self.running = True
+        self.tasks = []
+
+    def start(self):
+        for link in self.links:
+            self.tasks.append(asyncio.create_task(link.connection_task()))
+            self.tasks.append(asyncio.create_task(link.sender_task()))
+
+    async def stop(self):
+        self.running = False
+        for link in self.links:
+            link.running = False
+        self.send_all({'m1': 0, 'm2': 0})
+        # give the senders a moment to flush the stop
+        await asyncio.sleep(0.1)
+        for task in self.tasks:
+            task.cancel()
+        for link in self.links:
+            if link.ws is not None:
+                await link.ws.close()
+
+    def send_all(self, motors_powers):
+        for link in self.links:
+            link.post(motors_powers)
+
+    def send_each(self, powers_by_host):
+        # per robot setpoints, hosts missing from the dict are left alone
+        for link in self.links:
+            if link.hostname in powers_by_host:
+                link.post(powers_by_host[link.hostname])
+
+    def drive(self, motors_powers):
+        # the selected robot gets the keys, the others hold still
+        if self.selected == 0:
+            self.send_all(motors_powers)
+            return
+        stop = {'m1': 0, 'm2': 0}
+        self.send_each({
+            link.hostname: motors_powers if idx + 1 == self.selected else stop
+            for idx, link in enumerate(self.links)})
+
+    def start_listener(self):
+        loop = asyncio.get_running_loop()
+
+        def on_press(key):
+            loop.call_soon_threadsafe(self.keys.put_nowait, (key, True))
+
+        def on_release(key):
+            loop.call_soon_threadsafe(self.keys.put_nowait, (key, False))
+            if key == keyboard.Key.esc:
+                return False
+
+        listener = keyboard.Listener(on_press=on_press,
+                                     on_release=on_release)
+        listener.start()
+        return listener
+
+    def apply_key(self, key, pressed):
+        char = getattr(key, 'char', None)
+        if pressed and char is not None and char in SELECT_KEYS:
+            selected = SELECT_KEYS.index(char)
+            if selected <= len(self.links):
+                self.selected = selected
+            return
+        if key == keyboard.Key.esc and not pressed:
+            self.running = False
+            return
+        name = ARROW_KEYS.get(key)
+        if name is not None:
+            setattr(controller, name, pressed)
+
+    async def writer_task(self):
+        # same pacing as RobotLink.writer_task, fanned out to the pool
+        min_interval = 1.0 / controller.MAX_RATE
+        last_sent = None
+        last_selected = self.selected
+        last_send_time = 0.0
+        while self.running:
+            try:
+                key, pressed = await asyncio.wait_for(
+                    self.keys.get(), controller.keepalive_wait(last_send_time))
+                self.apply_key(key, pressed)
+            except asyncio.TimeoutError:
+                pass
+            wait = min_interval - (time.perf_counter() - last_send_time)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            while not self.keys.empty():
+                self.apply_key(*self.keys.get_nowait())
+            motors_powers = controller.compute_motor_speeds()
+            now = time.perf_counter()
+            if motors_powers == last_sent and \
+                    self.selected == last_selected and \
+                    now - last_send_time < controller.KEEPALIVE_PERIOD:
+                continue
+            self.drive(motors_powers)
+            last_sent = motors_powers
+            last_selected = self.selected
+            last_send_time = now
+
+    async def print_task(self):
+        while self.running:
+            await asyncio.sleep(controller.KEEPALIVE_PERIOD * 4)
+            up = sum(link.connected.is_set() for link in self.links)
+            target = 'all' if self.selected == 0 else \
+                self.links[self.selected - 1].hostname
+            print(f'\rdriving {target}, {up}/{len(self.links)} connected '
+                  f'{controller.compute_motor_speeds()}',
+                  end='', flush=True)
+
+    def print_stats(self):
+        print('')
+        for link in self.links:
+            stats = link.stats()
+            rtt = ''
+            if stats['rtt_p50_ms'] is not None:
+                rtt = (f', rtt p50 {stats["rtt_p50_ms"]:.2f} ms '
+                       f'p95 {stats["rtt_p95_ms"]:.2f} ms')
+            print(f'{stats["host"]}: sent {stats["sent"]}, '
+                  f'errors {stats["failures"]} '
+                  f'({stats["error_rate"] * 100:.1f}%), '
+                  f'overwritten {stats["overwritten"]}, '
+                  f'reconnects {stats["reconnects"]}, '
+                  f'send avg {stats["send_avg_ms"]:.2f} ms '
+                  f'max {stats["send_max_ms"]:.2f} ms{rtt}')
+
+
+async def standin_handler(ws):
+    # behaves like /motors_ws on the robot: hello, then acks if asked to
+    addr = ws.remote_address
+    await ws.send(f'# HELLO <{addr[0]}:{addr[1]}>')
+    echo = False
+    try:
+        async for msg in ws:
+            if isinstance(msg, bytes):
+                seq, _, _ = controller.MOTOR_FRAME.unpack(msg)
+            else:
+                data = json.loads(msg)
+                if 'deadman' in data:
+                    await ws.send(json.dumps({'deadman': data['deadman']}))
+                if 'echo' in data:
+                    echo = bool(data['echo'])
+                    continue
+                seq = data.get('seq')
+                if seq is None:
+                    continue
+            if echo or not isinstance(msg, bytes):
+                await ws.send(json.dumps({'ack': seq}))
+    except websockets.exceptions.ConnectionClosed:
+        pass
+
+
+async def start_standins(host, count, first_port=STANDIN_FIRST_PORT):
+    # local stand-in robots for trying the fleet without hardware
+    servers = []
+    for port in range(first_port, first_port + count):
+        servers.append(await websockets.serve(standin_handler, host, port))
+    return servers, [f'{host}:{port}'
+                     for port in range(first_port, first_port + count)]
+
+
+async def run(hostnames, standins):
+    servers = []
+    if standins:
+        servers, hostnames = await start_standins(hostnames[0], standins)
+    fleet = Fleet(hostnames)
+    fleet.start()
+    fleet.start_listener()
+    printer = asyncio.create_task(fleet.print_task())
+    try:
+        await fleet.writer_task()
+    finally:
+        printer.cancel()
+        await fleet.stop()
+        for server in servers:
+            server.close()
+        fleet.print_stats()
+
+
+def main():
+    parser = controller.build_parser(
+        'Drive several esp32 robots at once, --target takes a comma '
+        'separated list; keys 1-9 pick one robot, 0 picks all, esc quits')
+    parser.add_argument(
+        '--standin', '-si',
+        type=int,
+        default=0,
+        help='Run this many local stand-in robots on the --target host '
+             f'from port {STANDIN_FIRST_PORT} up and drive those instead')
+    vargs = controller.process_args(parser)
+    hostnames = [host.strip() for host in controller.HOSTNAME.split(',')
+                 if host.strip()]
+    try:
+        asyncio.run(run(hostnames, vargs['standin']))
+    except KeyboardInterrupt:
+        print('Caught CTRL-C')
+
+
+if __name__ == '__main__':
+    main()
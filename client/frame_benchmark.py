@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import struct
+import timeit
+from argparse import ArgumentParser
+
+# motor_frame.py lives next to app.py on the robot side
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import motor_frame  # noqa E402
+
+MOTOR_FRAME = struct.Struct('<Hhh')
+# websocket header of a masked client frame with a payload < 126 bytes
+WS_CLIENT_HEADER_LEN = 2 + 4
+
+SAMPLES = [(0, 0), (1000, 1000), (-1000, -1000), (250, 1000),
+           (-500, 500), (1000, -250), (1023, -1023), (0, 500)]
+
+
+def decode_json(msg):
+    # mirrors motors_websocket_on_recv_text in app.py
+    json_data = json.loads(msg)
+    if 'm1' not in json_data:
+        return None
+    if 'm2' not in json_data:
+        return None
+    return int(json_data['m1']), int(json_data['m2'])
+
+
+def decode_binary(msg):
+    # mirrors motors_websocket_on_recv_binary in app.py
+    if not motor_frame.decode(msg):
+        return None
+    return motor_frame.frame[motor_frame.M1], motor_frame.frame[motor_frame.M2]
+
+
+def bench(decode, frames, number):
+    def run():
+        for frame in frames:
+            decode(frame)
+    elapsed = min(timeit.repeat(run, number=number, repeat=5))
+    return elapsed / (number * len(frames))
+
+
+def main():
+    parser = ArgumentParser(
+        description='Compare json and binary /motors_ws frame cost')
+    parser.add_argument('--number', '-n', type=int, default=20000,
+                        help='Iterations over the sample set per repeat')
+    vargs = parser.parse_args()
+
+    json_frames = [json.dumps({'m1': m1, 'm2': m2}, separators=(',', ':'))
+                   for m1, m2 in SAMPLES]
+    binary_frames = [MOTOR_FRAME.pack(seq, m1, m2)
+                     for seq, (m1, m2) in enumerate(SAMPLES)]
+
+    for json_frame, binary_frame in zip(json_frames, binary_frames):
+        assert decode_json(json_frame) == decode_binary(binary_frame)
+
+    json_payload = sum(len(f) for f in json_frames) / len(json_frames)
+    binary_payload = sum(len(f) for f in binary_frames) / len(binary_frames)
+    json_decode = bench(decode_json, json_frames, vargs.number)
+    binary_decode = bench(decode_binary, binary_frames, vargs.number)
+
+    print(f'{"format":<8}{"decode us":>12}{"payload B":>12}{"on wire B":>12}')
+    for name, decode_s, payload in (('json', json_decode, json_payload),
+                                    ('binary', binary_decode, binary_payload)):
+        print(f'{name:<8}{decode_s * 1e6:>12.3f}{payload:>12.1f}'
+              f'{payload + WS_CLIENT_HEADER_LEN:>12.1f}')
+    print('host CPython timings, expect the ratio rather than the absolute '
+          'numbers to carry over to the esp32')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 import time
+import struct
+import threading
 import websocket
 from pynput import keyboard
 import simplejson as json
@@ -8,6 +10,15 @@ DEFAULT_POWER = 1000
 ROTATE_POWER = 500
 LOW_POWER = 250
 HOSTNAME = None
+BINARY = False
+# matches motor_frame.py on the robot: uint16 seq, int16 m1, int16 m2
+MOTOR_FRAME = struct.Struct('<Hhh')
+MAX_RATE = 50.0  # Hz, upper bound on frames sent per second
+KEEPALIVE_PERIOD = 0.25  # s, resend the current setpoint when idle
+# robot stops the motors when no frame came for this long, None for twice
+# the keepalive period
+DEADMAN_MS = None
+ECHO = False  # ask the robot to ack every frame and measure round trips
 
 motors_ws = None
 
@@ -16,6 +27,23 @@ down = False
 left = False
 right = False
 
+# set by the keyboard listener thread, wakes the sender right away
+input_event = threading.Event()
+first_unsent_input = None  # perf_counter of the oldest input not sent yet
+
+# sender counters
+frames_sent = 0
+frames_suppressed = 0
+keepalives_sent = 0
+latency_total = 0.0
+latency_max = 0.0
+latency_count = 0
+
+# round trip times of acked frames, seq -> perf_counter of the send
+pending_acks = {}
+pending_acks_lock = threading.Lock()
+round_trips = []
+
 
 def compute_motor_speeds():
     global up, down, left, right
@@ -67,6 +95,7 @@ def on_press(key):
     except AttributeError:
         print('special key {0} pressed'.format(
             key))
+    notify_input()
 
 
 def on_release(key):
@@ -84,11 +113,29 @@ def on_release(key):
     if key == keyboard.Key.right:
         right = False
         print('\r^RIGHT', end='')
+    notify_input()
     if key == keyboard.Key.esc:
         # Stop listener
         return False
 
 
+def notify_input():
+    global first_unsent_input
+    if first_unsent_input is None:
+        first_unsent_input = time.perf_counter()
+    input_event.set()
+
+
+def positive_float_input(arg_float: str) -> float:
+    try:
+        result = float(arg_float)
+    except Exception as ex:
+        raise ArgumentTypeError(f"Input is not a valid number -> {ex}")
+    if result <= 0:
+        raise ArgumentTypeError(f"Input must be positive -> {result}")
+    return result
+
+
 def deci_percent_input(arg_decipercent: str) -> int:
     try:
         result = int(arg_decipercent)
@@ -100,10 +147,8 @@ def deci_percent_input(arg_decipercent: str) -> int:
     return result
 
 
-def process_args():
-    global LOW_POWER, DEFAULT_POWER, ROTATE_POWER, HOSTNAME
-    parser = ArgumentParser(
-        description='Simple esp32 robot controller with arrow keys')
+def build_parser(description='Simple esp32 robot controller with arrow keys'):
+    parser = ArgumentParser(description=description)
     parser.add_argument(
         '--target', '-t', help='Target esp32 hostname or IP address')
     parser.add_argument(
@@ -121,6 +166,39 @@ def process_args():
         type=deci_percent_input,
         default=DEFAULT_POWER,
         help='Deci percentage of motor power to use to send default power')
+    parser.add_argument(
+        '--binary', '-b',
+        action='store_true',
+        help='Send compact binary motor frames instead of json')
+    parser.add_argument(
+        '--max-rate', '-mr',
+        type=positive_float_input,
+        default=MAX_RATE,
+        help='Maximum number of frames sent per second')
+    parser.add_argument(
+        '--keepalive', '-ka',
+        type=positive_float_input,
+        default=KEEPALIVE_PERIOD,
+        help='Seconds between repeated frames while the input is idle')
+    parser.add_argument(
+        '--deadman', '-dm',
+        type=int,
+        default=DEADMAN_MS,
+        help='ms without a frame before the robot stops, '
+             'twice the keepalive by default')
+    parser.add_argument(
+        '--echo', '-e',
+        action='store_true',
+        help='Have every frame acked and report round trip percentiles')
+    return parser
+
+
+def process_args(parser=None):
+    # other clients pass build_parser() with their own options added
+    global LOW_POWER, DEFAULT_POWER, ROTATE_POWER, HOSTNAME, BINARY
+    global MAX_RATE, KEEPALIVE_PERIOD, ECHO, DEADMAN_MS
+    if parser is None:
+        parser = build_parser()
     vargs = vars(parser.parse_args())
     print(vargs)
     HOSTNAME = vargs['target']
@@ -128,6 +206,28 @@ def process_args():
         HOSTNAME = input('enter esp32 hostname:')
     LOW_POWER = vargs['low_power']
     DEFAULT_POWER = vargs['default_power']
+    BINARY = vargs['binary']
+    MAX_RATE = vargs['max_rate']
+    KEEPALIVE_PERIOD = vargs['keepalive']
+    ECHO = vargs['echo']
+    DEADMAN_MS = vargs['deadman']
+    if DEADMAN_MS is None:
+        DEADMAN_MS = int(KEEPALIVE_PERIOD * 2000)
+    return vargs
+
+
+def keepalive_wait(last_send_time):
+    # s until the setpoint is due again, so an idle wake-up that sent
+    # nothing does not push the next keepalive a whole period out
+    return max(KEEPALIVE_PERIOD - (time.perf_counter() - last_send_time), 0)
+
+
+def join_message():
+    # sent right after the welcome message
+    settings = {'deadman': DEADMAN_MS}
+    if ECHO and BINARY:
+        settings['echo'] = 1
+    return json.dumps(settings)
 
 
 def main():
@@ -138,6 +238,10 @@ def main():
                       timeout=2)
     print(f'Websockets connected: {motors_ws.getstatus()}')
     print(f'Welcome message = {motors_ws.recv()}')
+    motors_ws.send(join_message())
+    if ECHO:
+        reader = threading.Thread(target=read_acks, daemon=True)
+        reader.start()
 
     # ...or, in a non-blocking fashion:
     listener = keyboard.Listener(
@@ -146,19 +250,124 @@ def main():
     listener.start()
     print(f'Keyboard listener started: {listener}')
 
-    motors_powers = compute_motor_speeds()
+    seq = 0
+    last_sent = None
+    last_send_time = 0.0
+    min_interval = 1.0 / MAX_RATE
 
     while True:
         try:
-            time.sleep(0.1)
+            input_event.wait(keepalive_wait(last_send_time))
+            input_event.clear()
+            # honour the rate limit, inputs arriving meanwhile fold in
+            now = time.perf_counter()
+            if now - last_send_time < min_interval:
+                time.sleep(min_interval - (now - last_send_time))
+                input_event.clear()
             motors_powers = compute_motor_speeds()
-            data_json_str = json.dumps(motors_powers, separators=(',', ':'))
-            print(f'{data_json_str}')
-            motors_ws.send(data_json_str)
+            now = time.perf_counter()
+            if motors_powers == last_sent and \
+                    now - last_send_time < KEEPALIVE_PERIOD:
+                count_suppressed()
+                continue
+            seq = send_motor_powers(motors_powers, seq)
+            record_sent(motors_powers == last_sent)
+            last_sent = motors_powers
+            last_send_time = now
         except KeyboardInterrupt:
             print('Caught CTRL-C')
             motors_ws.close()
             break
+    print_sender_stats()
+    print_round_trip_stats()
+
+
+def send_motor_powers(motors_powers, seq):
+    if ECHO:
+        with pending_acks_lock:
+            pending_acks[seq] = time.perf_counter()
+    if BINARY:
+        frame = MOTOR_FRAME.pack(
+            seq, motors_powers['m1'], motors_powers['m2'])
+        print(f'{motors_powers} #{seq}')
+        motors_ws.send_binary(frame)
+        return (seq + 1) & 0xFFFF
+    if ECHO:
+        motors_powers = dict(motors_powers, seq=seq)
+    data_json_str = json.dumps(motors_powers, separators=(',', ':'))
+    print(f'{data_json_str}')
+    motors_ws.send(data_json_str)
+    if ECHO:
+        return (seq + 1) & 0xFFFF
+    return seq
+
+
+def read_acks():
+    # runs on its own thread, the robot answers {"ack":seq} per frame
+    while True:
+        try:
+            msg = motors_ws.recv()
+        except Exception:
+            return
+        received = time.perf_counter()
+        # the robot batches replies, one json object per line
+        for line in msg.split('\n'):
+            try:
+                seq = json.loads(line)['ack']
+            except (ValueError, KeyError, TypeError):
+                continue
+            with pending_acks_lock:
+                sent = pending_acks.pop(seq, None)
+            if sent is not None:
+                round_trips.append(received - sent)
+
+
+def percentile(sorted_values, percent):
+    idx = min(len(sorted_values) - 1,
+              int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def count_suppressed():
+    global frames_suppressed, first_unsent_input
+    frames_suppressed += 1
+    first_unsent_input = None
+
+
+def record_sent(keepalive):
+    global frames_sent, keepalives_sent, first_unsent_input
+    global latency_total, latency_max, latency_count
+    frames_sent += 1
+    if keepalive:
+        keepalives_sent += 1
+    if first_unsent_input is not None:
+        latency = time.perf_counter() - first_unsent_input
+        first_unsent_input = None
+        latency_total += latency
+        latency_count += 1
+        latency_max = max(latency_max, latency)
+
+
+def print_sender_stats():
+    print(f'frames sent: {frames_sent} '
+          f'(keepalives: {keepalives_sent}), '
+          f'suppressed: {frames_suppressed}')
+    if latency_count:
+        print(f'key to send latency: '
+              f'avg {latency_total / latency_count * 1000:.2f} ms, '
+              f'max {latency_max * 1000:.2f} ms')
+
+
+def print_round_trip_stats():
+    if not round_trips:
+        return
+    values = sorted(round_trips)
+    print(f'round trip ({len(values)} acked, '
+          f'{len(pending_acks)} unanswered): '
+          f'p50 {percentile(values, 50) * 1000:.2f} ms, '
+          f'p95 {percentile(values, 95) * 1000:.2f} ms, '
+          f'p99 {percentile(values, 99) * 1000:.2f} ms, '
+          f'max {values[-1] * 1000:.2f} ms')
 
 
 if __name__ == '__main__':
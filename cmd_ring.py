@@ -0,0 +1,165 @@
+import time
+from array import array
+from micropython import const
+from _thread import allocate_lock
+
+# overflow policies
+DROP_OLDEST = const(0)
+DROP_NEWEST = const(1)
+REJECT = const(2)
+
+DEFAULT_CAPACITY = const(16)
+
+_lock = allocate_lock()
+_capacity = 0
+_cmds = []
+_params = []
+_sockets = []
+_seqs = array('l')
+_recv_us = array('l')
+_enqueue_us = array('l')
+_head = 0  # next slot to pop
+_count = 0  # occupied slots
+# slot of the pending coalescable command while it is the newest entry,
+# -1 otherwise; one queued behind it must still see it run first
+_motion_slot = -1
+policy = DROP_OLDEST
+
+# describes the entry returned by the last pop(), cmd_task is the only reader
+last_seq = -1
+last_recv_us = 0
+last_enqueue_us = 0
+
+# counters
+enqueued = 0
+dequeued = 0
+dropped = 0
+rejected = 0
+coalesced = 0
+high_water = 0
+
+
+def init(capacity=DEFAULT_CAPACITY, overflow_policy=DROP_OLDEST):
+    global _capacity, _cmds, _params, _sockets, policy
+    global _seqs, _recv_us, _enqueue_us
+    with _lock:
+        _capacity = capacity
+        _cmds = [None] * capacity
+        _params = [None] * capacity
+        _sockets = [None] * capacity
+        _seqs = array('l', [-1] * capacity)
+        _recv_us = array('l', [0] * capacity)
+        _enqueue_us = array('l', [0] * capacity)
+        policy = overflow_policy
+        _reset()
+
+
+def _reset():
+    global _head, _count, _motion_slot
+    for idx in range(_capacity):
+        _cmds[idx] = None
+        _params[idx] = None
+        _sockets[idx] = None
+    _head = 0
+    _count = 0
+    _motion_slot = -1
+
+
+def clear():
+    with _lock:
+        _reset()
+
+
+def depth():
+    return _count
+
+
+def push(cmd, param=None, websocket=None, coalesce=False,
+         seq=-1, recv_us=0):
+    # returns False when the command did not make it into the queue
+    # seq is echoed in the reply, -1 for none; recv_us is the ticks_us the
+    # websocket handler got the command at
+    global _count, _head, _motion_slot
+    global enqueued, dropped, rejected, coalesced, high_water
+    with _lock:
+        if coalesce and _motion_slot != -1:
+            # only the newest setpoint survives, it takes the stale one's
+            # slot so coalescing never needs room in the queue
+            _store(_motion_slot, cmd, param, websocket, seq, recv_us)
+            coalesced += 1
+            enqueued += 1
+            return True
+        if _count == _capacity:
+            if policy == DROP_OLDEST:
+                if _head == _motion_slot:
+                    _motion_slot = -1
+                _cmds[_head] = None
+                _params[_head] = None
+                _sockets[_head] = None
+                _head = (_head + 1) % _capacity
+                _count -= 1
+                dropped += 1
+            elif policy == DROP_NEWEST:
+                dropped += 1
+                return False
+            else:
+                rejected += 1
+                return False
+        slot = (_head + _count) % _capacity
+        _store(slot, cmd, param, websocket, seq, recv_us)
+        _motion_slot = slot if coalesce else -1
+        _count += 1
+        enqueued += 1
+        if _count > high_water:
+            high_water = _count
+        return True
+
+
+def _store(slot, cmd, param, websocket, seq, recv_us):
+    _cmds[slot] = cmd
+    _params[slot] = param
+    _sockets[slot] = websocket
+    _seqs[slot] = seq
+    _recv_us[slot] = recv_us
+    _enqueue_us[slot] = time.ticks_us()
+
+
+def pop():
+    # returns (cmd, param, websocket) in arrival order, None when empty
+    global _head, _count, _motion_slot, dequeued
+    global last_seq, last_recv_us, last_enqueue_us
+    with _lock:
+        if not _count:
+            return None
+        slot = _head
+        cmd = _cmds[slot]
+        param = _params[slot]
+        websocket = _sockets[slot]
+        _cmds[slot] = None
+        _params[slot] = None
+        _sockets[slot] = None
+        _head = (_head + 1) % _capacity
+        _count -= 1
+        if slot == _motion_slot:
+            _motion_slot = -1
+        last_seq = _seqs[slot]
+        last_recv_us = _recv_us[slot]
+        last_enqueue_us = _enqueue_us[slot]
+        dequeued += 1
+        return cmd, param, websocket
+
+
+def stats():
+    return {
+        'depth': _count,
+        'capacity': _capacity,
+        'enqueued': enqueued,
+        'dequeued': dequeued,
+        'dropped': dropped,
+        'rejected': rejected,
+        'coalesced': coalesced,
+        'high_water': high_water,
+    }
+
+
+init()
@@ -0,0 +1,165 @@
+from machine import Timer
+from micropython import const
+from array import array
+import time
+
+# hardware timer driving the control tick
+CONTROL_TIMER_ID = const(0)
+DEFAULT_RATE_HZ = const(100)
+DEFAULT_SLEW_PER_S = const(5000)  # duty units per second, 0 disables
+# tick jitter histogram, the last bucket collects everything beyond
+JITTER_BUCKET_US = const(250)
+JITTER_BUCKETS = const(16)
+
+# signed m1/m2 setpoints, same convention as robot_set_motor_powers,
+# clamped to +-SETPOINT_MAX (motor_driver.py's full duty)
+SETPOINT_MAX = const(1023)
+target = array('h', [0, 0])
+applied = array('h', [0, 0])
+jitter_histogram = array('L', [0] * JITTER_BUCKETS)
+
+_timer = Timer(CONTROL_TIMER_ID)
+_apply_fn = None
+_on_target = None
+_period_us = 1000000 // DEFAULT_RATE_HZ
+_slew_per_tick = DEFAULT_SLEW_PER_S // DEFAULT_RATE_HZ
+_leased = False
+_refresh = False
+_lease_until_ms = 0
+_last_tick_us = 0
+_have_last_tick = False
+
+# counters
+ticks = 0
+overruns = 0  # tick took longer than its period
+late_ticks = 0  # tick started more than half a period late
+stale_stops = 0
+max_jitter_us = 0
+
+
+def init(apply_fn, rate_hz=DEFAULT_RATE_HZ, slew_per_s=DEFAULT_SLEW_PER_S,
+         on_target=None):
+    # apply_fn(m1, m2) writes the duties, it is only called on a change;
+    # on_target(m1, m2, hold) sees every target set, whoever set it, and
+    # may be called from timer context
+    global _apply_fn, _on_target, _period_us, _have_last_tick
+    _apply_fn = apply_fn
+    _on_target = on_target
+    _period_us = 1000000 // rate_hz
+    set_slew_rate(slew_per_s)
+    _have_last_tick = False
+    _timer.init(period=1000 // rate_hz, mode=Timer.PERIODIC, callback=_tick)
+
+
+def deinit():
+    _timer.deinit()
+
+
+def set_slew_rate(slew_per_s):
+    global _slew_per_tick
+    _slew_per_tick = slew_per_s * _period_us // 1000000
+    if slew_per_s and not _slew_per_tick:
+        _slew_per_tick = 1
+
+
+def set_target(motor1, motor2, lease_ms=-1):
+    # with a lease the target drops to 0 unless renewed within lease_ms
+    global _leased, _lease_until_ms
+    if lease_ms >= 0:
+        _lease_until_ms = time.ticks_add(time.ticks_ms(), lease_ms)
+    _leased = lease_ms >= 0
+    # an array('h') store wraps out of range values on the esp32
+    target[0] = min(max(motor1, -SETPOINT_MAX), SETPOINT_MAX)
+    target[1] = min(max(motor2, -SETPOINT_MAX), SETPOINT_MAX)
+    if _on_target is not None:
+        _on_target(target[0], target[1], lease_ms < 0)
+
+
+def refresh():
+    # the next tick calls apply_fn even without a change, e.g. once the
+    # mapping behind it was reconfigured
+    global _refresh
+    _refresh = True
+
+
+def us_to_next_tick():
+    # 0 when a tick is due or the loop has not ticked yet
+    if not _have_last_tick:
+        return 0
+    left = _period_us - time.ticks_diff(time.ticks_us(), _last_tick_us)
+    return left if left > 0 else 0
+
+
+def _step(current, wanted):
+    # only growing magnitudes are slew limited, slowing down is immediate
+    if _slew_per_tick == 0 or wanted == current:
+        return wanted
+    if (current > 0 and wanted < 0) or (current < 0 and wanted > 0):
+        current = 0
+    if abs(wanted) <= abs(current):
+        return wanted
+    if wanted > current:
+        return min(wanted, current + _slew_per_tick)
+    return max(wanted, current - _slew_per_tick)
+
+
+def _tick(timer_obj):
+    global _last_tick_us, _have_last_tick, _leased, _refresh
+    global ticks, overruns, late_ticks, stale_stops, max_jitter_us
+    start_us = time.ticks_us()
+    if _have_last_tick:
+        interval_us = time.ticks_diff(start_us, _last_tick_us)
+        jitter_us = abs(interval_us - _period_us)
+        bucket = jitter_us // JITTER_BUCKET_US
+        if bucket >= JITTER_BUCKETS:
+            bucket = JITTER_BUCKETS - 1
+        jitter_histogram[bucket] += 1
+        if jitter_us > max_jitter_us:
+            max_jitter_us = jitter_us
+        if interval_us > _period_us + (_period_us >> 1):
+            late_ticks += 1
+    _last_tick_us = start_us
+    _have_last_tick = True
+
+    if _leased and time.ticks_diff(time.ticks_ms(), _lease_until_ms) >= 0:
+        _leased = False
+        target[0] = 0
+        target[1] = 0
+        stale_stops += 1
+    motor1 = _step(applied[0], target[0])
+    motor2 = _step(applied[1], target[1])
+    if motor1 != applied[0] or motor2 != applied[1] or _refresh:
+        _refresh = False
+        applied[0] = motor1
+        applied[1] = motor2
+        _apply_fn(motor1, motor2)
+
+    ticks += 1
+    if time.ticks_diff(time.ticks_us(), start_us) > _period_us:
+        overruns += 1
+
+
+def reset_stats():
+    global ticks, overruns, late_ticks, stale_stops, max_jitter_us
+    global _have_last_tick
+    for idx in range(JITTER_BUCKETS):
+        jitter_histogram[idx] = 0
+    ticks = 0
+    overruns = 0
+    late_ticks = 0
+    stale_stops = 0
+    max_jitter_us = 0
+    _have_last_tick = False
+
+
+def stats():
+    return {
+        'rate_hz': 1000000 // _period_us,
+        'ticks': ticks,
+        'overruns': overruns,
+        'late_ticks': late_ticks,
+        'stale_stops': stale_stops,
+        'max_jitter_us': max_jitter_us,
+        'jitter_bucket_us': JITTER_BUCKET_US,
+        'jitter_histogram': list(jitter_histogram),
+    }
@@ -0,0 +1,135 @@
+from machine import Timer
+from micropython import const
+from array import array
+import time
+
+# stops the motors when the input source that set them goes quiet or loses
+# its link, checked on its own hardware timer so a stuck event loop or
+# server thread cannot keep the robot driving
+DEADMAN_TIMER_ID = const(3)
+CHECK_MS = const(10)  # a stop lands within the timeout plus this
+WEBSOCKET = const(0)  # /motors_ws setpoints
+BLUETOOTH = const(1)  # uart WASD keys
+SOURCES = const(2)
+SOURCE_NAMES = ('websocket', 'bluetooth')
+MIN_TIMEOUT_MS = const(50)
+MAX_TIMEOUT_MS = const(5000)
+NO_TIMEOUT = const(0)  # only the link is watched
+
+_timer = Timer(DEADMAN_TIMER_ID)
+_stop_fn = None
+_links = [None] * SOURCES  # is_up() per source, None when there is no link
+_default_ms = array('H', [0] * SOURCES)
+timeout_ms = array('H', [0] * SOURCES)
+_last_input_ms = array('l', [0] * SOURCES)
+_link_ok_ms = array('l', [0] * SOURCES)  # last check the link was up
+_active = -1  # source whose setpoint is on the motors, -1 when none
+
+# counters per source
+stops = array('L', [0] * SOURCES)
+last_stop_ms = array('l', [0] * SOURCES)  # input loss to stop
+max_stop_ms = array('l', [0] * SOURCES)
+
+
+def init(stop_fn, websocket_ms, bluetooth_ms=NO_TIMEOUT,
+         bluetooth_link=None):
+    # stop_fn() zeroes the setpoint, it runs in timer context;
+    # bluetooth_link() returns False once the remote is gone
+    global _stop_fn
+    _stop_fn = stop_fn
+    _default_ms[WEBSOCKET] = websocket_ms
+    _default_ms[BLUETOOTH] = bluetooth_ms
+    _links[BLUETOOTH] = bluetooth_link
+    for source in range(SOURCES):
+        timeout_ms[source] = _default_ms[source]
+    # always running, stopping it when idle would race with feed()
+    _timer.init(period=CHECK_MS, mode=Timer.PERIODIC, callback=_check)
+
+
+def deinit():
+    _timer.deinit()
+
+
+def negotiate(source, requested_ms):
+    # returns the timeout the source got, clamped to what the robot allows
+    requested_ms = min(max(int(requested_ms), MIN_TIMEOUT_MS), MAX_TIMEOUT_MS)
+    timeout_ms[source] = requested_ms
+    return requested_ms
+
+
+def reset_timeout(source):
+    timeout_ms[source] = _default_ms[source]
+
+
+def feed(source, moving=True):
+    # a valid input from source is about to set the motors, call it first
+    # so no check sees the old input age; moving is False when it stops
+    # them and there is nothing left to guard
+    global _active
+    now = time.ticks_ms()
+    _last_input_ms[source] = now
+    _link_ok_ms[source] = now
+    if not moving:
+        if _active == source:
+            _active = -1
+        return
+    _active = source
+
+
+def release():
+    # something other than a guarded source took over the motors,
+    # e.g. a timed motion or a program that ends by itself
+    global _active
+    _active = -1
+
+
+def lost(source):
+    # the source is known to be gone, e.g. its socket closed
+    if _active == source:
+        _trip(source, time.ticks_ms())
+
+
+def _trip(source, since_ms):
+    global _active
+    _active = -1
+    _stop_fn()
+    elapsed_ms = time.ticks_diff(time.ticks_ms(), since_ms)
+    stops[source] += 1
+    last_stop_ms[source] = elapsed_ms
+    if elapsed_ms > max_stop_ms[source]:
+        max_stop_ms[source] = elapsed_ms
+
+
+def _check(timer_obj):
+    source = _active
+    if source < 0:
+        return
+    now = time.ticks_ms()
+    link = _links[source]
+    if link is not None:
+        if link():
+            _link_ok_ms[source] = now
+        else:
+            _trip(source, _link_ok_ms[source])
+            return
+    timeout = timeout_ms[source]
+    if timeout != NO_TIMEOUT and \
+            time.ticks_diff(now, _last_input_ms[source]) >= timeout:
+        _trip(source, _last_input_ms[source])
+
+
+def stats():
+    result = {
+        'active': SOURCE_NAMES[_active] if _active >= 0 else None,
+        'check_ms': CHECK_MS,
+    }
+    now = time.ticks_ms()
+    for source in range(SOURCES):
+        result[SOURCE_NAMES[source]] = {
+            'timeout_ms': timeout_ms[source],
+            'input_age_ms': time.ticks_diff(now, _last_input_ms[source]),
+            'stops': stops[source],
+            'last_stop_ms': last_stop_ms[source],
+            'max_stop_ms': max_stop_ms[source],
+        }
+    return result
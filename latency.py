@@ -0,0 +1,137 @@
+import time
+from array import array
+from micropython import const
+from _thread import allocate_lock
+
+# stages a command goes through, all durations in us
+RECV_TO_ENQUEUE = const(0)  # websocket handler until it sits in cmd_ring
+QUEUE_WAIT = const(1)  # cmd_ring until cmd_task pops it
+EXECUTE = const(2)  # the command itself
+REPLY = const(3)  # command done until the outbox sent its reply
+RECV_TO_REPLY = const(4)  # whole round trip on the robot, up to the send
+RECV_TO_DUTY = const(5)  # websocket handler until the pwm duty changed
+STAGES = const(6)
+STAGE_NAMES = ('recv_to_enqueue', 'queue_wait', 'execute', 'reply',
+               'recv_to_reply', 'recv_to_duty')
+
+# bucket upper bounds in us, the last bucket collects everything beyond
+BUCKET_LIMITS_US = array('L', [100, 200, 500, 1000, 2000, 5000, 10000,
+                               20000, 50000, 100000, 200000])
+BUCKETS = const(12)
+
+# histogram[stage * BUCKETS + bucket]
+histogram = array('L', [0] * (STAGES * BUCKETS))
+counts = array('L', [0] * STAGES)
+totals_us = array('L', [0] * STAGES)
+max_us = array('L', [0] * STAGES)
+
+_duty_pending = False
+_duty_from_us = 0
+# server threads, the event loop and the control tick all record; the tick
+# runs as a scheduled callback on the loop's thread, so it must never wait
+# for the lock and drops its sample instead
+_lock = allocate_lock()
+
+# counters
+contended = 0  # tick samples dropped because the lock was held
+
+
+def record(stage, start_us, end_us=None):
+    # returns end_us so consecutive stages can be chained
+    if end_us is None:
+        end_us = time.ticks_us()
+    with _lock:
+        _add(stage, time.ticks_diff(end_us, start_us))
+    return end_us
+
+
+def _add(stage, elapsed_us):
+    # under _lock
+    if elapsed_us < 0:
+        elapsed_us = 0
+    bucket = 0
+    while bucket < BUCKETS - 1 and elapsed_us > BUCKET_LIMITS_US[bucket]:
+        bucket += 1
+    histogram[stage * BUCKETS + bucket] += 1
+    counts[stage] += 1
+    totals_us[stage] = (totals_us[stage] + elapsed_us) & 0xFFFFFFFF
+    if elapsed_us > max_us[stage]:
+        max_us[stage] = elapsed_us
+
+
+def expect_duty(recv_us, target, applied):
+    # called after a new setpoint went in, the control tick that writes it
+    # closes the trace through duty_applied(); the oldest input wins
+    global _duty_pending, _duty_from_us
+    with _lock:
+        if target[0] == applied[0] and target[1] == applied[1]:
+            # nothing left to write, an older pending trace is moot as well
+            _duty_pending = False
+            return
+        if not _duty_pending:
+            _duty_from_us = recv_us
+            _duty_pending = True
+
+
+def duty_applied():
+    # control tick context, must not allocate or block
+    global _duty_pending, contended
+    if not _duty_pending:
+        return
+    if not _lock.acquire(0):
+        contended += 1
+        return
+    if _duty_pending:
+        _duty_pending = False
+        _add(RECV_TO_DUTY, time.ticks_diff(time.ticks_us(), _duty_from_us))
+    _lock.release()
+
+
+def percentile_us(stage, percent):
+    # upper bound of the bucket holding the percentile, -1 when empty or
+    # beyond the last limit
+    total = counts[stage]
+    if not total:
+        return -1
+    wanted = (total * percent + 99) // 100
+    seen = 0
+    for bucket in range(BUCKETS - 1):
+        seen += histogram[stage * BUCKETS + bucket]
+        if seen >= wanted:
+            return BUCKET_LIMITS_US[bucket]
+    return -1
+
+
+def reset():
+    global _duty_pending
+    with _lock:
+        _reset()
+
+
+def _reset():
+    global _duty_pending
+    for idx in range(STAGES * BUCKETS):
+        histogram[idx] = 0
+    for stage in range(STAGES):
+        counts[stage] = 0
+        totals_us[stage] = 0
+        max_us[stage] = 0
+    _duty_pending = False
+
+
+def stats():
+    result = {'bucket_limits_us': list(BUCKET_LIMITS_US),
+              'contended': contended}
+    for stage in range(STAGES):
+        count = counts[stage]
+        result[STAGE_NAMES[stage]] = {
+            'count': count,
+            'avg_us': totals_us[stage] // count if count else 0,
+            'max_us': max_us[stage],
+            'p50_us': percentile_us(stage, 50),
+            'p95_us': percentile_us(stage, 95),
+            'p99_us': percentile_us(stage, 99),
+            'histogram': list(histogram[stage * BUCKETS:
+                                        (stage + 1) * BUCKETS]),
+        }
+    return result
@@ -0,0 +1,117 @@
+import gc
+import time
+from micropython import const
+import uasyncio as asyncio
+import cmd_ring
+import control_loop
+
+# collect once this much was allocated since the last collection, or when
+# the free heap drops below the floor, whichever comes first
+DEFAULT_ALLOC_THRESHOLD = const(16384)
+DEFAULT_FREE_FLOOR = const(24576)
+CHECK_MS = const(50)
+# a collection waits for an idle window this long before the next control
+# tick, unless the free heap fell below half the floor
+MIN_WINDOW_US = const(5000)
+MAX_DEFERRALS = const(20)
+
+_alloc_threshold = DEFAULT_ALLOC_THRESHOLD
+_free_floor = DEFAULT_FREE_FLOOR
+_alloc_base = 0  # mem_alloc() right after the last collection
+_deferrals = 0
+_last_sample_ms = 0
+_last_sample_alloc = 0
+
+# counters
+collections = 0
+forced = 0  # collections that could not wait for an idle window
+max_pause_us = 0
+last_pause_us = 0
+total_pause_us = 0
+low_water = 0  # lowest mem_free() seen
+alloc_rate = 0  # bytes per second between the last two samples
+
+
+def init(alloc_threshold=DEFAULT_ALLOC_THRESHOLD,
+         free_floor=DEFAULT_FREE_FLOOR):
+    # call once every long-lived buffer is allocated, compacts the heap
+    # and makes the allocator's own collection a backstop only
+    global _alloc_threshold, _free_floor, low_water
+    _alloc_threshold = alloc_threshold
+    _free_floor = free_floor
+    gc.threshold(alloc_threshold * 2)
+    collect()
+    low_water = gc.mem_free()
+
+
+def collect():
+    global _alloc_base, _deferrals, _last_sample_alloc
+    global collections, max_pause_us, last_pause_us, total_pause_us
+    start_us = time.ticks_us()
+    gc.collect()
+    pause_us = time.ticks_diff(time.ticks_us(), start_us)
+    collections += 1
+    last_pause_us = pause_us
+    total_pause_us += pause_us
+    if pause_us > max_pause_us:
+        max_pause_us = pause_us
+    _alloc_base = gc.mem_alloc()
+    _last_sample_alloc = _alloc_base
+    _deferrals = 0
+
+
+def _sample(now_ms):
+    # returns True when a collection is due
+    global low_water, alloc_rate, _last_sample_ms, _last_sample_alloc
+    free = gc.mem_free()
+    alloc = gc.mem_alloc()
+    if free < low_water:
+        low_water = free
+    elapsed_ms = time.ticks_diff(now_ms, _last_sample_ms)
+    if elapsed_ms > 0 and alloc >= _last_sample_alloc:
+        alloc_rate = (alloc - _last_sample_alloc) * 1000 // elapsed_ms
+    _last_sample_ms = now_ms
+    _last_sample_alloc = alloc
+    return alloc - _alloc_base >= _alloc_threshold or free < _free_floor
+
+
+def _idle_window():
+    return cmd_ring.depth() == 0 and \
+        control_loop.us_to_next_tick() >= MIN_WINDOW_US
+
+
+def service():
+    # returns ms until it wants to be called again
+    global _deferrals, forced
+    if not _sample(time.ticks_ms()):
+        return CHECK_MS
+    if _idle_window():
+        collect()
+        return CHECK_MS
+    _deferrals += 1
+    if _deferrals >= MAX_DEFERRALS or gc.mem_free() < _free_floor // 2:
+        forced += 1
+        collect()
+        return CHECK_MS
+    return 1  # look for the next window soon
+
+
+async def task():
+    while True:
+        await asyncio.sleep_ms(service())
+
+
+def stats():
+    return {
+        'mem_free': gc.mem_free(),
+        'mem_alloc': gc.mem_alloc(),
+        'low_water': low_water,
+        'alloc_rate': alloc_rate,
+        'alloc_threshold': _alloc_threshold,
+        'free_floor': _free_floor,
+        'collections': collections,
+        'forced': forced,
+        'last_pause_us': last_pause_us,
+        'max_pause_us': max_pause_us,
+        'avg_pause_us': total_pause_us // collections if collections else 0,
+    }
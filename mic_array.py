@@ -0,0 +1,185 @@
+import math
+import time
+from array import array
+from machine import Pin
+import micropython
+from micropython import const
+import uasyncio as asyncio
+
+# microphone pins and their position on the chassis in mm,
+# x towards the front, y towards the left, same order as MIC_PINS
+MIC_PINS = (13, 34, 39, 36)
+MIC_POSITIONS_MM = ((40, 40), (-40, 40), (-40, -40), (40, -40))
+SPEED_OF_SOUND_MM_PER_US = 0.343
+DEBOUNCE_MS = const(1000)  # ms a mic stays deaf after it fired
+# events closer than this are one sound, must exceed the time sound
+# needs to cross the array (~330 us for the default layout)
+GROUP_WINDOW_US = const(1000)
+EVENT_RING_LEN = const(32)  # power of two
+_EVENT_MASK = const(31)
+
+# event ring, written only by the isrs, read only by the consumer task
+_event_us = array('L', [0] * EVENT_RING_LEN)
+_event_mic = bytearray(EVENT_RING_LEN)
+_head = 0
+_tail = 0
+
+_armed = bytearray(len(MIC_PINS))
+_rearm_pending = bytearray(len(MIC_PINS))
+_rearm_at_ms = array('l', [0] * len(MIC_PINS))
+_group_mic = bytearray(len(MIC_PINS))
+_group_us = array('l', [0] * len(MIC_PINS))
+_mics = []
+_isrs = []
+_subscribers = []
+_flag = asyncio.ThreadSafeFlag()
+
+# counters
+events = 0
+dropped = 0
+estimates = 0
+last_bearing = None  # (bearing_deg, ticks_us, mic_count)
+
+
+def _make_isr(idx):
+    # hard isr, must not allocate: only timestamps and hands over
+    def isr(pin):
+        global _head, events, dropped
+        if not _armed[idx]:
+            return
+        now_us = time.ticks_us()
+        _armed[idx] = 0
+        slot = _head
+        nxt = (slot + 1) & _EVENT_MASK
+        if nxt == _tail:
+            dropped += 1
+        else:
+            _event_us[slot] = now_us
+            _event_mic[slot] = idx
+            _head = nxt
+            events += 1
+        try:
+            micropython.schedule(_on_event, idx)
+        except RuntimeError:
+            pass  # schedule queue full, mic_task re-arms it anyway
+    return isr
+
+
+def _on_event(idx):
+    # runs via micropython.schedule, outside the isr
+    _rearm_at_ms[idx] = time.ticks_add(time.ticks_ms(), DEBOUNCE_MS)
+    _rearm_pending[idx] = 1
+    _flag.set()
+
+
+def init():
+    micropython.alloc_emergency_exception_buf(100)
+    for idx, pin_id in enumerate(MIC_PINS):
+        pin = Pin(pin_id, Pin.IN)
+        isr = _make_isr(idx)
+        _mics.append(pin)
+        _isrs.append(isr)
+        _armed[idx] = 1
+        pin.irq(isr, Pin.IRQ_FALLING, hard=True)
+
+
+def subscribe(callback):
+    # callback(bearing_deg, ticks_us, mic_count), bearing 0 is straight
+    # ahead and grows counter clockwise
+    if callback not in _subscribers:
+        _subscribers.append(callback)
+
+
+def unsubscribe(callback):
+    if callback in _subscribers:
+        _subscribers.remove(callback)
+
+
+def _rearm_due():
+    # returns ms until the next re-arm, -1 if none is pending
+    now_ms = time.ticks_ms()
+    next_ms = -1
+    for idx in range(len(MIC_PINS)):
+        if not _armed[idx] and not _rearm_pending[idx]:
+            # the isr could not schedule _on_event
+            _on_event(idx)
+        if not _rearm_pending[idx]:
+            continue
+        wait_ms = time.ticks_diff(_rearm_at_ms[idx], now_ms)
+        if wait_ms <= 0:
+            _rearm_pending[idx] = 0
+            _armed[idx] = 1
+        elif next_ms < 0 or wait_ms < next_ms:
+            next_ms = wait_ms
+    return next_ms
+
+
+def estimate_bearing(count):
+    # far field plane wave, t_i = t0 - (p_i . u) / c, least squares for u
+    # over the _group_mic/_group_us entries, needs three mics or more
+    if count < 3:
+        return None
+    mean_x = mean_y = mean_t = 0.0
+    for idx in range(count):
+        pos = MIC_POSITIONS_MM[_group_mic[idx]]
+        mean_x += pos[0]
+        mean_y += pos[1]
+        mean_t += _group_us[idx]
+    mean_x /= count
+    mean_y /= count
+    mean_t /= count
+    sxx = sxy = syy = sxt = syt = 0.0
+    for idx in range(count):
+        pos = MIC_POSITIONS_MM[_group_mic[idx]]
+        dx = pos[0] - mean_x
+        dy = pos[1] - mean_y
+        dt = _group_us[idx] - mean_t
+        sxx += dx * dx
+        sxy += dx * dy
+        syy += dy * dy
+        sxt += dx * dt
+        syt += dy * dt
+    det = sxx * syy - sxy * sxy
+    if abs(det) < 1e-6:
+        return None
+    slowness_x = -(syy * sxt - sxy * syt) / det
+    slowness_y = -(sxx * syt - sxy * sxt) / det
+    return math.degrees(math.atan2(slowness_y, slowness_x))
+
+
+def _consume():
+    global _tail, estimates, last_bearing
+    while _tail != _head:
+        first_us = _event_us[_tail]
+        count = 0
+        while _tail != _head and count < len(MIC_PINS):
+            offset_us = time.ticks_diff(_event_us[_tail], first_us)
+            if offset_us > GROUP_WINDOW_US:
+                break
+            _group_mic[count] = _event_mic[_tail]
+            _group_us[count] = offset_us
+            count += 1
+            _tail = (_tail + 1) & _EVENT_MASK
+        bearing = estimate_bearing(count)
+        if bearing is None:
+            continue
+        estimates += 1
+        last_bearing = (bearing, first_us, count)
+        for callback in _subscribers:
+            callback(bearing, first_us, count)
+
+
+async def task():
+    while True:
+        wait_ms = _rearm_due()
+        if wait_ms < 0:
+            await _flag.wait()
+        else:
+            try:
+                await asyncio.wait_for_ms(_flag.wait(), wait_ms)
+            except asyncio.TimeoutError:
+                pass
+        if _tail != _head:
+            # let the rest of the wavefront reach the other mics
+            await asyncio.sleep_ms(GROUP_WINDOW_US // 1000 + 1)
+            _consume()
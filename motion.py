@@ -0,0 +1,170 @@
+from machine import Timer
+from micropython import const
+from _thread import allocate_lock
+import time
+
+# hardware timer that fires the stop deadline of the running motion
+MOTION_TIMER_ID = const(2)
+
+_timer = Timer(MOTION_TIMER_ID)
+_stop_fn = None
+_on_armed = None
+_deadline = None  # ticks_ms at which the running motion ends, None when idle
+_stop_at_deadline = True
+_sequence = ()
+_seq_idx = 0
+_stepping = False
+_wait_ms = 0  # of a wait queued behind a motion that stops by itself
+# bumped by every begin() and preempt(), a deadline only stops the motors
+# while the generation it was armed in is current
+_generation = 0
+_armed = -1
+# taken without blocking by whoever expires a deadline, the timer callback
+# and service() can race for the same one
+_expire_lock = allocate_lock()
+
+
+def init(stop_fn, on_armed=None):
+    # on_armed() is called whenever a new deadline is armed
+    global _stop_fn, _on_armed
+    _stop_fn = stop_fn
+    _on_armed = on_armed
+
+
+def is_busy():
+    return _deadline is not None or _seq_idx < len(_sequence)
+
+
+def remaining_ms():
+    # -1 when no deadline is armed
+    if _deadline is None:
+        return -1
+    return max(time.ticks_diff(_deadline, time.ticks_ms()), 0)
+
+
+def begin(duration_ms, stop=True):
+    # called by a primitive right after it applied its duties
+    # duration_ms == -1 keeps the duties until something pre-empts them
+    # a call from outside a running sequence pre-empts that sequence
+    # only from the command task or the timer itself, server threads use
+    # preempt()
+    global _deadline, _stop_at_deadline, _generation, _armed
+    global _sequence, _wait_ms
+    if not _stepping:
+        _drop_sequence()
+        if not stop and _deadline is not None and _stop_at_deadline and \
+                _armed == _generation:
+            # a wait must not take the pending stop away from a timed
+            # motion, it starts once that stopped
+            _wait_ms = duration_ms
+            _sequence = _WAIT_SEQUENCE
+            return
+    _timer.deinit()
+    _generation += 1
+    _stop_at_deadline = stop
+    if duration_ms == -1:
+        _deadline = None
+        return
+    _armed = _generation
+    _deadline = time.ticks_add(time.ticks_ms(), duration_ms)
+    _timer.init(period=max(duration_ms, 1), mode=Timer.ONE_SHOT,
+                callback=_on_timer)
+    if _on_armed is not None:
+        _on_armed()
+
+
+def preempt():
+    # safe from any thread: the armed deadline and sequence no longer stop
+    # anything; returns the generation to hand to release() through the
+    # command queue, 0 when there was nothing to pre-empt
+    global _generation
+    with _expire_lock:  # waits out a stop that is already under way
+        if _armed != _generation or not is_busy():
+            return 0
+        _generation += 1
+        return _generation
+
+
+def release(generation):
+    # disarms the timer unless something began since preempt()
+    if generation == _generation:
+        begin(-1)
+
+
+def cancel():
+    global _deadline, _generation
+    _timer.deinit()
+    _generation += 1
+    _deadline = None
+    _drop_sequence()
+
+
+def current_sequence():
+    # the steps of the last run_sequence(), () once something pre-empted it
+    return _sequence
+
+
+def run_sequence(steps):
+    global _sequence, _seq_idx
+    cancel()
+    _sequence = steps
+    _seq_idx = 0
+    _advance()
+
+
+def service():
+    # backstop for the timer, called from the main loop on every wake
+    if _deadline is None:
+        return
+    if time.ticks_diff(time.ticks_ms(), _deadline) >= 0:
+        _expire()
+
+
+def _on_timer(timer_obj):
+    _expire()
+
+
+def _expire():
+    global _deadline, _generation
+    if not _expire_lock.acquire(0):
+        return  # the other path is expiring it
+    try:
+        if _deadline is None:
+            return  # the other path got there first
+        if _armed != _generation:
+            _deadline = None  # pre-empted, release() disarms the timer
+            return
+        _timer.deinit()
+        _generation += 1
+        _deadline = None
+        if _stop_at_deadline:
+            _stop_fn()
+    finally:
+        _expire_lock.release()
+    _advance()
+
+
+def _queued_wait():
+    begin(_wait_ms, stop=False)
+
+
+_WAIT_SEQUENCE = (_queued_wait,)
+
+
+def _drop_sequence():
+    global _sequence, _seq_idx
+    _sequence = ()
+    _seq_idx = 0
+
+
+def _advance():
+    # run instant steps back to back, stop at the first one arming a deadline
+    global _seq_idx, _stepping
+    while _deadline is None and _seq_idx < len(_sequence):
+        step = _sequence[_seq_idx]
+        _seq_idx += 1
+        _stepping = True
+        try:
+            step()
+        finally:
+            _stepping = False
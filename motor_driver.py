@@ -0,0 +1,196 @@
+from machine import Pin, PWM
+from micropython import const
+from array import array
+import json
+import time
+
+# signed setpoints of -SETPOINT_MAX..SETPOINT_MAX per motor, same convention
+# as robot_set_motor_powers; a per motor table maps the magnitude to a duty
+SETPOINT_MAX = const(1023)
+TABLE_LEN = const(1024)
+DEFAULT_FREQ_HZ = const(20)
+# duty resolution, 10 bits is written with duty() so an uncalibrated table
+# maps a setpoint onto the same duty as before, others with duty_u16()
+DEFAULT_BITS = const(10)
+MIN_BITS = const(4)
+MAX_BITS = const(16)
+LEDC_CLOCK_HZ = const(80000000)  # freq * 2**bits must stay below this
+# per motor calibration, deadband and gain are fractions of full duty
+#   deadband  duty the motor needs to start turning, where setpoint 1 lands
+#   gain      duty of the largest setpoint, e.g. to cap a fresh battery
+#   trim      scales gain to balance the motors, e.g. -0.04 slows one by 4%
+#   curve     exponent of the response between the two, 1 is linear
+DEFAULT_CALIBRATION = dict(deadband=0.0, gain=1.0, trim=0.0, curve=1.0)
+MOTORS = ('m1', 'm2')
+
+
+def load_calibration(file_name):
+    # {"m1": {...}, "m2": {...}} as tools/motor_calibrate.py writes it,
+    # None when there is no such file
+    try:
+        with open(file_name) as cal_file:
+            return json.load(cal_file)
+    except OSError:
+        return None
+
+
+def _motor_calibration(calibration, motor):
+    result = dict(DEFAULT_CALIBRATION)
+    if calibration and motor in calibration:
+        for key, value in calibration[motor].items():
+            if key not in result:
+                raise ValueError('unknown calibration %s.%s' % (motor, key))
+            result[key] = float(value)
+    if not 0 <= result['deadband'] < 1 or result['gain'] <= 0 or \
+            result['trim'] <= -1 or result['curve'] <= 0:
+        raise ValueError('bad calibration for %s' % motor)
+    return result
+
+
+class MotorDriver:
+    # owns the four h-bridge inputs, motor1 on pins 0 and 1, motor2 on 2
+    # and 3, the second pin of a pair drives its motor forward; only the
+    # control tick calls apply(), reconfiguring marks the pins stale and
+    # the next apply() rewrites them, so pins are only written from there;
+    # the tick can run in the middle of a rebuild, so tables are built into
+    # the spare pair and swapped in together with their writers
+
+    def __init__(self, gpios, freq=DEFAULT_FREQ_HZ, bits=DEFAULT_BITS):
+        self._pwms = [PWM(Pin(gpio, Pin.OUT), freq=freq, duty=0)
+                      for gpio in gpios]
+        # per pin, the setpoint magnitude and the duty it was mapped to
+        self.levels = array('H', [0, 0, 0, 0])
+        self.duties = array('H', [0, 0, 0, 0])
+        self._table_pairs = tuple((array('H', bytearray(2 * TABLE_LEN)),
+                                   array('H', bytearray(2 * TABLE_LEN)))
+                                  for _ in range(2))
+        self._spare = 0
+        # (tables, writers) the tick looks up, only ever replaced whole
+        self._mapping = None
+        self._stale = False
+        self.freq = freq
+        self.bits = bits
+        self.calibration = {motor: dict(DEFAULT_CALIBRATION)
+                            for motor in MOTORS}
+        # counters
+        self.writes = 0
+        self.rebuilds = 0
+        self.rebuild_us = 0
+        self.set_pwm(freq, bits)
+
+    def set_pwm(self, freq=None, bits=None):
+        # raises ValueError when the ledc timer cannot do both
+        freq = self.freq if freq is None else int(freq)
+        bits = self.bits if bits is None else int(bits)
+        if not MIN_BITS <= bits <= MAX_BITS:
+            raise ValueError('bits must be %d..%d' % (MIN_BITS, MAX_BITS))
+        if freq <= 0 or freq * (1 << bits) > LEDC_CLOCK_HZ:
+            raise ValueError('%d Hz is too fast for %d bits' % (freq, bits))
+        if freq != self.freq:
+            for pwm in self._pwms:
+                pwm.freq(freq)
+        self.freq = freq
+        if bits != self.bits or self._mapping is None:
+            self.bits = bits
+            self._rebuild([pwm.duty if bits == DEFAULT_BITS
+                           else pwm.duty_u16 for pwm in self._pwms])
+
+    def calibrate(self, calibration):
+        # None goes back to the uncalibrated mapping
+        motors = {motor: _motor_calibration(calibration, motor)
+                  for motor in MOTORS}
+        self.calibration = motors
+        self._rebuild()
+
+    def _rebuild(self, writers=None):
+        # all the float math happens here, apply() only looks up; writers
+        # go with the tables when the bits changed
+        start_us = time.ticks_us()
+        top = (1 << self.bits) - 1
+        scale = 1 if self.bits == DEFAULT_BITS else 65535 / top
+        tables = self._table_pairs[self._spare]
+        for motor, table in zip(MOTORS, tables):
+            cal = self.calibration[motor]
+            deadband = cal['deadband']
+            span = min(cal['gain'] * (1 + cal['trim']), 1) - deadband
+            curve = cal['curve']
+            table[0] = 0
+            for level in range(1, TABLE_LEN):
+                fraction = deadband + span * (level / SETPOINT_MAX) ** curve
+                fraction = min(max(fraction, 0), 1)
+                table[level] = int(int(fraction * top + 0.5) * scale + 0.5)
+        if writers is None:
+            writers = self._mapping[1]
+        # one store, a tick sees the old mapping or the new one, never half
+        self._mapping = (tables, writers)
+        self._spare ^= 1
+        self._stale = True
+        self.rebuilds += 1
+        self.rebuild_us = time.ticks_diff(time.ticks_us(), start_us)
+
+    def _set(self, idx, level):
+        if level > SETPOINT_MAX:
+            level = SETPOINT_MAX
+        if self.levels[idx] == level:
+            return False
+        self.levels[idx] = level
+        tables, writers = self._mapping
+        duty = tables[idx >> 1][level]
+        if self.duties[idx] != duty:
+            self.duties[idx] = duty
+            writers[idx](duty)
+            self.writes += 1
+        return True
+
+    def _rewrite(self):
+        self._stale = False
+        tables, writers = self._mapping
+        for idx in range(4):
+            duty = tables[idx >> 1][self.levels[idx]]
+            self.duties[idx] = duty
+            writers[idx](duty)
+            self.writes += 1
+
+    def apply(self, motor1, motor2):
+        # True when a setpoint changed
+        if self._stale:
+            self._rewrite()
+        changed = False
+        if motor1 >= 0:
+            changed |= self._set(0, 0)
+            changed |= self._set(1, motor1)
+        else:
+            changed |= self._set(0, -motor1)
+            changed |= self._set(1, 0)
+        if motor2 >= 0:
+            changed |= self._set(2, 0)
+            changed |= self._set(3, motor2)
+        else:
+            changed |= self._set(2, -motor2)
+            changed |= self._set(3, 0)
+        return changed
+
+    def stop(self):
+        # safe state, straight to the pins, only before the control loop runs
+        writers = self._mapping[1]
+        for idx in range(4):
+            self.levels[idx] = 0
+            self.duties[idx] = 0
+            writers[idx](0)
+        self._stale = False
+
+    def duty(self, motor, setpoint):
+        # what apply() would write for a setpoint of motor 0 or 1
+        return self._mapping[0][motor][min(abs(setpoint), SETPOINT_MAX)]
+
+    def stats(self):
+        return {
+            'freq_hz': self.freq,
+            'bits': self.bits,
+            'levels': list(self.levels),
+            'duties': list(self.duties),
+            'calibration': self.calibration,
+            'writes': self.writes,
+            'rebuilds': self.rebuilds,
+            'rebuild_us': self.rebuild_us,
+        }
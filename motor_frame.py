@@ -0,0 +1,37 @@
+from array import array
+
+# /motors_ws binary frame, little-endian struct '<Hhh'
+#   uint16 seq, int16 m1, int16 m2
+FRAME_LEN = 6
+SEQ = 0
+M1 = 1
+M2 = 2
+
+# last decoded frame, indexed by SEQ/M1/M2
+frame = array('l', [0, 0, 0])
+
+
+def _int16(value):
+    if value & 0x8000:
+        return value - 0x10000
+    return value
+
+
+def decode(msg):
+    # fills frame in place, returns False for a malformed message
+    if len(msg) != FRAME_LEN:
+        return False
+    frame[SEQ] = msg[0] | (msg[1] << 8)
+    frame[M1] = _int16(msg[2] | (msg[3] << 8))
+    frame[M2] = _int16(msg[4] | (msg[5] << 8))
+    return True
+
+
+def encode_into(buf, seq, motor1, motor2):
+    buf[0] = seq & 0xFF
+    buf[1] = (seq >> 8) & 0xFF
+    buf[2] = motor1 & 0xFF
+    buf[3] = (motor1 >> 8) & 0xFF
+    buf[4] = motor2 & 0xFF
+    buf[5] = (motor2 >> 8) & 0xFF
+    return buf
@@ -0,0 +1,293 @@
+import time
+from array import array
+from micropython import const
+from _thread import allocate_lock
+import uasyncio as asyncio
+import latency
+
+# every accepted websocket gets a slot, sockets beyond the cap given to
+# init() are refused, which bounds the memory all clients together can take
+DEFAULT_MAX_SOCKETS = const(8)
+TEXT_QUEUE_LEN = const(8)  # queued text frames per socket, oldest dropped
+# consecutive text messages go out as one frame, separated by this
+SEPARATOR = '\n'
+# a send that blocks longer than this marks the peer stalled, its queue
+# is then left alone for a while so it cannot hold up everyone else
+STALL_US = const(20000)
+STALL_BACKOFF_MS = const(250)
+NO_TIME = const(-1)  # ticks are never negative
+
+_lock = allocate_lock()  # server threads post while the task sends
+_flag = asyncio.ThreadSafeFlag()  # wakes task()
+max_sockets = DEFAULT_MAX_SOCKETS
+_sockets = [None] * max_sockets
+_texts = [None] * max_sockets  # list of pending text messages per slot
+# per text, when its command was received and done, NO_TIME if untimed;
+# the reply stages of latency.py end once the text was sent
+_recv_us = [None] * max_sockets
+_done_us = [None] * max_sockets
+_latest = [None] * max_sockets  # newest state frame, replaces older ones
+_closing = bytearray(max_sockets)
+_stalled_until = array('l', [0] * max_sockets)
+_stalled = bytearray(max_sockets)
+_started = False
+
+# counters
+texts_queued = 0
+frames_sent = 0
+texts_dropped = 0  # a slow peer had TEXT_QUEUE_LEN messages pending
+texts_batched = 0  # went out sharing a frame with an earlier message
+stale_dropped = 0  # states replaced by a newer one before they were sent
+send_failures = 0
+stalls = 0  # sends that took longer than STALL_US
+max_send_us = 0
+refused = 0  # no free slot
+
+
+def init(sockets=DEFAULT_MAX_SOCKETS):
+    # task() is the only place websockets are written from
+    global _started, max_sockets, _sockets, _texts, _latest, _closing
+    global _stalled_until, _stalled, _recv_us, _done_us
+    if _started:
+        return
+    _started = True
+    max_sockets = sockets
+    _sockets = [None] * sockets
+    _texts = [None] * sockets
+    _recv_us = [None] * sockets
+    _done_us = [None] * sockets
+    _latest = [None] * sockets
+    _closing = bytearray(sockets)
+    _stalled_until = array('l', [0] * sockets)
+    _stalled = bytearray(sockets)
+
+
+def _slot(websocket):
+    if websocket is None:
+        return -1
+    for idx in range(max_sockets):
+        if _sockets[idx] is websocket:
+            return idx
+    return -1
+
+
+def _free_slot():
+    for idx in range(max_sockets):
+        if _sockets[idx] is None:
+            return idx
+    return -1
+
+
+def register(websocket):
+    # returns False when all slots are taken
+    global refused
+    with _lock:
+        if _slot(websocket) >= 0:
+            return True
+        idx = _free_slot()
+        if idx < 0:
+            refused += 1
+            return False
+        _sockets[idx] = websocket
+        _texts[idx] = []
+        _recv_us[idx] = []
+        _done_us[idx] = []
+        _latest[idx] = None
+        _closing[idx] = 0
+        _stalled[idx] = 0
+        return True
+
+
+def unregister(websocket):
+    with _lock:
+        idx = _slot(websocket)
+        if idx >= 0:
+            _sockets[idx] = None
+            _texts[idx] = None
+            _recv_us[idx] = None
+            _done_us[idx] = None
+            _latest[idx] = None
+
+
+def socket_count():
+    count = 0
+    for websocket in _sockets:
+        if websocket is not None:
+            count += 1
+    return count
+
+
+def flush():
+    # sends whatever was posted with defer=True
+    _flag.set()
+
+
+def post_text(websocket, msg, close=False, defer=False, recv_us=NO_TIME,
+              done_us=NO_TIME):
+    # never blocks on the network, returns False if the socket is unknown;
+    # close=True closes the socket once everything queued went out, defer
+    # holds the message back until flush() so a burst goes out as one frame;
+    # recv_us/done_us of a reply time latency.RECV_TO_REPLY and REPLY
+    global texts_queued, texts_dropped
+    with _lock:
+        idx = _slot(websocket)
+        if idx < 0 or _closing[idx]:
+            return False
+        texts = _texts[idx]
+        if len(texts) >= TEXT_QUEUE_LEN:
+            texts.pop(0)
+            _recv_us[idx].pop(0)
+            _done_us[idx].pop(0)
+            texts_dropped += 1
+        texts.append(msg)
+        _recv_us[idx].append(recv_us)
+        _done_us[idx].append(done_us)
+        texts_queued += 1
+        if close:
+            _closing[idx] = 1
+    if not defer:
+        _flag.set()
+    return True
+
+
+def post_latest(websocket, frame):
+    # a state that only matters until the next one, e.g. telemetry; str
+    # goes out as text, bytes or a memoryview as a binary frame, which the
+    # caller must leave alone until it posts the next one
+    global stale_dropped
+    with _lock:
+        idx = _slot(websocket)
+        if idx < 0 or _closing[idx]:
+            return False
+        if _latest[idx] is not None:
+            stale_dropped += 1
+        _latest[idx] = frame
+    _flag.set()
+    return True
+
+
+def _take(idx):
+    # under _lock: hand the pending frames of a slot over to the sender
+    global texts_batched
+    websocket = _sockets[idx]
+    if websocket is None:
+        return None, None, None, None, None, False
+    texts = _texts[idx]
+    text = recv_us = done_us = None
+    if texts:
+        text = texts[0] if len(texts) == 1 else SEPARATOR.join(texts)
+        texts_batched += len(texts) - 1
+        recv_us = _recv_us[idx]
+        done_us = _done_us[idx]
+        _texts[idx] = []
+        _recv_us[idx] = []
+        _done_us[idx] = []
+    frame = _latest[idx]
+    _latest[idx] = None
+    return websocket, text, recv_us, done_us, frame, _closing[idx] == 1
+
+
+def _record_replies(recv_us, done_us, sent_us):
+    for idx in range(len(recv_us)):
+        if recv_us[idx] != NO_TIME:
+            latency.record(latency.RECV_TO_REPLY, recv_us[idx], sent_us)
+        if done_us[idx] != NO_TIME:
+            latency.record(latency.REPLY, done_us[idx], sent_us)
+
+
+def _send(websocket, frame):
+    global frames_sent, send_failures
+    if isinstance(frame, str):
+        sent = websocket.SendTextMessage(frame)
+    else:
+        sent = websocket.SendBinaryMessage(frame)
+    if sent is False:
+        send_failures += 1
+        return False
+    frames_sent += 1
+    return True
+
+
+def _service_slot(idx, now_ms):
+    # sends what a slot has pending, returns ms until a stalled peer may be
+    # tried again, -1 when there is nothing to wait for
+    global stalls, max_send_us
+    if _stalled[idx]:
+        wait_ms = time.ticks_diff(_stalled_until[idx], now_ms)
+        if wait_ms > 0:
+            pending = _texts[idx] or _latest[idx] is not None
+            return wait_ms if pending else -1
+        _stalled[idx] = 0
+    with _lock:
+        websocket, text, recv_us, done_us, frame, close = _take(idx)
+    if websocket is None or (text is None and frame is None and not close):
+        return -1
+    start_us = time.ticks_us()
+    ok = True
+    if text is not None:
+        ok = _send(websocket, text)
+        if ok:
+            _record_replies(recv_us, done_us, time.ticks_us())
+    if frame is not None and ok:
+        ok = _send(websocket, frame)
+    elapsed_us = time.ticks_diff(time.ticks_us(), start_us)
+    if elapsed_us > max_send_us:
+        max_send_us = elapsed_us
+    if close:
+        unregister(websocket)
+        websocket.Close()
+    elif not ok or elapsed_us > STALL_US:
+        stalls += 1
+        _stalled[idx] = 1
+        _stalled_until[idx] = time.ticks_add(time.ticks_ms(),
+                                             STALL_BACKOFF_MS)
+    return -1
+
+
+def _service_next(idx, wait_ms):
+    # services one slot, returns the shorter of wait_ms and its wait
+    slot_wait_ms = _service_slot(idx, time.ticks_ms())
+    if slot_wait_ms >= 0 and (wait_ms < 0 or slot_wait_ms < wait_ms):
+        return slot_wait_ms
+    return wait_ms
+
+
+def service():
+    # one pass over every socket the way task() makes it, without yielding
+    # in between; returns what _service_slot() does
+    wait_ms = -1
+    for idx in range(max_sockets):
+        wait_ms = _service_next(idx, wait_ms)
+    return wait_ms
+
+
+async def task():
+    while True:
+        wait_ms = -1
+        for idx in range(max_sockets):
+            wait_ms = _service_next(idx, wait_ms)
+            await asyncio.sleep_ms(0)  # one socket at a time
+        if wait_ms < 0:
+            await _flag.wait()
+        else:
+            try:
+                await asyncio.wait_for_ms(_flag.wait(), wait_ms)
+            except asyncio.TimeoutError:
+                pass
+
+
+def stats():
+    return {
+        'sockets': socket_count(),
+        'max_sockets': max_sockets,
+        'texts_queued': texts_queued,
+        'frames_sent': frames_sent,
+        'texts_batched': texts_batched,
+        'texts_dropped': texts_dropped,
+        'stale_dropped': stale_dropped,
+        'send_failures': send_failures,
+        'stalls': stalls,
+        'stalled': sum(_stalled),
+        'max_send_us': max_send_us,
+        'refused': refused,
+    }
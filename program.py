@@ -0,0 +1,127 @@
+import time
+from array import array
+from micropython import const
+import motion
+
+# a compiled program is a timeline of duty setpoints, entry idx starts
+# at_ms[idx] after the program started and lasts until entry idx + 1
+MAX_STEPS = const(64)
+
+at_ms = array('l', [0] * (MAX_STEPS + 1))  # at_ms[length] is the end
+m1 = array('h', [0] * MAX_STEPS)
+m2 = array('h', [0] * MAX_STEPS)
+error_us = array('l', [0] * (MAX_STEPS + 1))  # late (+) or early (-)
+length = 0
+
+_set_target = None
+_steps = ()
+_next = 0
+_active = False
+_start_ms = 0
+_start_us = 0
+
+# counters
+started = 0
+completed = 0
+cancelled = 0
+max_error_us = 0
+
+
+def init(set_target):
+    # set_target(m1, m2) is called at every step boundary
+    global _set_target
+    _set_target = set_target
+
+
+def clear():
+    global length
+    cancel()
+    length = 0
+
+
+def append(duration_ms, motor1, motor2):
+    # returns False when the program is full
+    global length
+    if length == MAX_STEPS:
+        return False
+    at_ms[length + 1] = at_ms[length] + duration_ms
+    m1[length] = motor1
+    m2[length] = motor2
+    length += 1
+    return True
+
+
+def duration_ms():
+    return at_ms[length]
+
+
+def is_running():
+    # another motion pre-empting the program drops its sequence
+    return _active and motion.current_sequence() is _steps
+
+
+def start():
+    global _steps, _next, _active, started
+    cancel()
+    for idx in range(length + 1):
+        error_us[idx] = 0
+    _next = 0
+    _active = True
+    started += 1
+    # the same step function once per entry, then _finish at the end
+    _steps = (_step,) * length + (_finish,)
+    motion.run_sequence(_steps)
+
+
+def cancel():
+    global _active, cancelled
+    if is_running():
+        motion.cancel()
+        cancelled += 1
+    _active = False
+
+
+def _late_us(idx):
+    global max_error_us
+    late = time.ticks_diff(time.ticks_us(),
+                           time.ticks_add(_start_us, at_ms[idx] * 1000))
+    error_us[idx] = late
+    if abs(late) > max_error_us:
+        max_error_us = abs(late)
+
+
+def _step():
+    # motion timer context: apply the entry and arm the next boundary,
+    # measured from the program start so errors do not add up
+    global _next, _start_ms, _start_us
+    idx = _next
+    _next += 1
+    if idx == 0:
+        _start_ms = time.ticks_ms()
+        _start_us = time.ticks_us()
+    else:
+        _late_us(idx)
+    _set_target(m1[idx], m2[idx])
+    motion.begin(max(time.ticks_diff(
+        time.ticks_add(_start_ms, at_ms[idx + 1]), time.ticks_ms()), 0))
+
+
+def _finish():
+    global _active, completed
+    _late_us(length)
+    _active = False
+    completed += 1
+
+
+def stats():
+    return {
+        'length': length,
+        'duration_ms': at_ms[length],
+        'running': is_running(),
+        'step': _next,
+        'started': started,
+        'completed': completed,
+        'cancelled': cancelled,
+        'max_error_us': max_error_us,
+        'error_us': list(error_us[:length + 1]),
+    }
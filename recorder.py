@@ -0,0 +1,247 @@
+import os
+import struct
+import time
+from array import array
+from micropython import const
+from _thread import allocate_lock
+import uasyncio as asyncio
+
+# flight log on flash, every file starts with a header
+#   'FREC', version B, record length B, names length H, command names
+#   joined by '\n' (a COMMAND record's code indexes into them)
+# followed by fixed width records '<IBBhh': ticks_ms, kind, code, a, b
+#   BOOT      code 0, a power level, b 0    recorder started
+#   SETPOINT  code 1 if held until the next one, a m1, b m2
+#   COMMAND   code command index, a param, b 1 if there was a param
+MAGIC = b'FREC'
+FILE_VERSION = const(1)
+HEADER_FMT = '<4sBBH'
+HEADER_LEN = const(8)
+RECORD_FMT = '<IBBhh'
+RECORD_LEN = const(10)
+BOOT = const(0)
+SETPOINT = const(1)
+COMMAND = const(2)
+
+# two RAM blocks, the control path fills one while the other is written
+BLOCK_SIZE = const(1000)  # 100 records
+FLUSH_MS = const(5000)  # partial blocks too, bounds what a crash loses
+# flight.bin is rotated to flight.1.bin once it reaches this size
+DEFAULT_MAX_FILE_BYTES = const(32768)
+FILE_NAMES = ('flight.bin', 'flight.1.bin')
+
+_lock = allocate_lock()
+_bufs = (bytearray(BLOCK_SIZE), bytearray(BLOCK_SIZE))
+_fill = array('H', [0, 0])
+_active = 0
+_pending = -1  # block waiting for the flush task, -1 when there is none
+_flag = asyncio.ThreadSafeFlag()
+_header = None
+_max_file_bytes = DEFAULT_MAX_FILE_BYTES
+_file_bytes = 0
+paused = False  # set while a recording is replayed
+# setpoints also come from timer callbacks, which run between bytecodes of
+# whoever holds _lock, so they never wait for it; one that finds it taken
+# is parked here and written ahead of the next record
+_deferred = array('h', [0, 0, 0])  # m1, m2, code
+_deferred_ms = 0
+_has_deferred = False
+
+# counters
+records = 0
+dropped = 0  # flash fell behind and both blocks were full
+flushes = 0
+rotations = 0
+max_flush_us = 0
+write_errors = 0
+
+
+def init(cmd_names, max_file_bytes=DEFAULT_MAX_FILE_BYTES, power_level=0):
+    # cmd_names: COMMAND codes are indices into it, power_level is the
+    # state commands start from, replay restores it at every BOOT
+    global _header, _max_file_bytes, _file_bytes
+    names = '\n'.join(cmd_names).encode()
+    _header = struct.pack(HEADER_FMT, MAGIC, FILE_VERSION, RECORD_LEN,
+                          len(names)) + names
+    _max_file_bytes = max_file_bytes
+    try:
+        _file_bytes = os.stat(FILE_NAMES[0])[6]
+        with open(FILE_NAMES[0], 'rb') as log_file:
+            current = log_file.read(len(_header))
+        if current != _header:
+            # older firmware, its command codes mean something else
+            _rotate()
+    except OSError:
+        _file_bytes = 0
+    _append(BOOT, 0, _clamp(power_level), 0)
+
+
+def _swap():
+    # under _lock: hand the active block to the flush task
+    global _active, _pending
+    if _pending >= 0:
+        return False
+    _pending = _active
+    _active ^= 1
+    _fill[_active] = 0
+    _flag.set()
+    return True
+
+
+def _put(ticks_ms, kind, code, a, b):
+    # under _lock
+    global records, dropped
+    pos = _fill[_active]
+    if pos + RECORD_LEN > BLOCK_SIZE:
+        if not _swap():
+            dropped += 1
+            return
+        pos = 0
+    struct.pack_into(RECORD_FMT, _bufs[_active], pos,
+                     ticks_ms, kind, code, a, b)
+    _fill[_active] = pos + RECORD_LEN
+    records += 1
+
+
+def _put_deferred():
+    # under _lock
+    global _has_deferred
+    if _has_deferred:
+        _has_deferred = False
+        _put(_deferred_ms, SETPOINT, _deferred[2], _deferred[0],
+             _deferred[1])
+
+
+def _append(kind, code, a, b):
+    if paused:
+        return
+    with _lock:
+        _put_deferred()
+        _put(time.ticks_ms(), kind, code, a, b)
+
+
+def _clamp(value):
+    return min(max(value, -32768), 32767)
+
+
+def setpoint(motor1, motor2, hold=False):
+    # never blocks, see _deferred
+    global _deferred_ms, _has_deferred, dropped
+    if paused:
+        return
+    code = 1 if hold else 0
+    if not _lock.acquire(0):
+        if _has_deferred:
+            dropped += 1
+        _deferred[0] = _clamp(motor1)
+        _deferred[1] = _clamp(motor2)
+        _deferred[2] = code
+        _deferred_ms = time.ticks_ms()
+        _has_deferred = True
+        return
+    _put_deferred()
+    _put(time.ticks_ms(), SETPOINT, code, _clamp(motor1), _clamp(motor2))
+    _lock.release()
+
+
+def command(code, param=None):
+    # only int params are kept
+    if isinstance(param, int):
+        _append(COMMAND, code, _clamp(param), 1)
+    else:
+        _append(COMMAND, code, 0, 0)
+
+
+def _rotate():
+    global _file_bytes, rotations
+    try:
+        os.remove(FILE_NAMES[1])
+    except OSError:
+        pass
+    os.rename(FILE_NAMES[0], FILE_NAMES[1])
+    _file_bytes = 0
+    rotations += 1
+
+
+def _write(idx):
+    global _pending, _file_bytes, flushes, max_flush_us, write_errors
+    start_us = time.ticks_us()
+    size = _fill[idx]
+    try:
+        if _file_bytes + size > _max_file_bytes and _file_bytes:
+            _rotate()
+        with open(FILE_NAMES[0], 'ab') as log_file:
+            if _file_bytes == 0:
+                log_file.write(_header)
+                _file_bytes = len(_header)
+            log_file.write(memoryview(_bufs[idx])[:size])
+        _file_bytes += size
+        flushes += 1
+    except OSError:
+        write_errors += 1
+    _pending = -1
+    elapsed_us = time.ticks_diff(time.ticks_us(), start_us)
+    if elapsed_us > max_flush_us:
+        max_flush_us = elapsed_us
+
+
+def flush():
+    # writes everything recorded so far, blocks on flash
+    if _pending >= 0:
+        _write(_pending)
+    with _lock:
+        _put_deferred()
+        swapped = _fill[_active] and _swap()
+    if swapped:
+        _write(_pending)
+
+
+async def task():
+    while True:
+        try:
+            await asyncio.wait_for_ms(_flag.wait(), FLUSH_MS)
+        except asyncio.TimeoutError:
+            with _lock:
+                _put_deferred()
+                if _fill[_active]:
+                    _swap()
+        if _pending >= 0:
+            _write(_pending)
+
+
+def read_header(log_file):
+    # returns the command names, None if this is not a flight log
+    header = log_file.read(HEADER_LEN)
+    if len(header) < HEADER_LEN:
+        return None
+    magic, version, record_len, names_len = struct.unpack(HEADER_FMT, header)
+    if magic != MAGIC or version != FILE_VERSION or record_len != RECORD_LEN:
+        return None
+    names = log_file.read(names_len)
+    return names.decode().split('\n') if names else []
+
+
+def read_records(log_file):
+    # yields (ticks_ms, kind, code, a, b), reads a block at a time
+    buf = bytearray(BLOCK_SIZE)
+    while True:
+        size = log_file.readinto(buf)
+        if not size:
+            return
+        for pos in range(0, size - RECORD_LEN + 1, RECORD_LEN):
+            yield struct.unpack_from(RECORD_FMT, buf, pos)
+
+
+def stats():
+    return {
+        'records': records,
+        'dropped': dropped,
+        'flushes': flushes,
+        'rotations': rotations,
+        'file_bytes': _file_bytes,
+        'max_file_bytes': _max_file_bytes,
+        'buffered': _fill[_active],
+        'max_flush_us': max_flush_us,
+        'write_errors': write_errors,
+        'paused': paused,
+    }
@@ -0,0 +1,98 @@
+"""Host stand-in for the parts of MicroWebSrv2 app.py uses, see host.py.
+
+No sockets are opened. accept_websocket() builds a client connection and
+hands it to the loaded WebSockets module the way the real server does once
+a handshake completes; the returned WebSocket can then be fed messages with
+sim_text()/sim_binary() and records everything the app sends back.
+"""
+
+__all__ = ['MicroWebSrv2', 'WebSocket', 'accept_websocket']
+
+
+class _Request:
+    def __init__(self, path, address):
+        self.Path = path
+        self.UserAddress = address
+        self.Origin = 'http://%s:%d' % address
+
+
+class WebSocket:
+    def __init__(self, path, address):
+        self.Request = _Request(path, address)
+        self.OnTextMessage = None
+        self.OnBinaryMessage = None
+        self.OnClosed = None
+        self.IsClosed = False
+        self.sent = []
+
+    def SendTextMessage(self, msg):
+        if self.IsClosed:
+            return False
+        self.sent.append(msg)
+        return True
+
+    def SendBinaryMessage(self, msg):
+        if self.IsClosed:
+            return False
+        self.sent.append(bytes(msg))
+        return True
+
+    def Close(self):
+        if self.IsClosed:
+            return
+        self.IsClosed = True
+        if self.OnClosed is not None:
+            self.OnClosed(self)
+
+    def sim_text(self, msg):
+        if self.OnTextMessage is not None and not self.IsClosed:
+            self.OnTextMessage(self, msg)
+
+    def sim_binary(self, msg):
+        if self.OnBinaryMessage is not None and not self.IsClosed:
+            self.OnBinaryMessage(self, msg)
+
+
+class _WebSocketsModule:
+    def __init__(self):
+        self.OnWebSocketAccepted = None
+        self.OnWebSocketProtocol = None
+
+
+class MicroWebSrv2:
+    _modules = {}
+    _instance = None
+
+    def __init__(self):
+        self.NotFoundURL = None
+        self.IsRunning = False
+        MicroWebSrv2._instance = self
+
+    @staticmethod
+    def LoadModule(name):
+        module = MicroWebSrv2._modules.get(name)
+        if module is None:
+            if name != 'WebSockets':
+                raise ValueError('Unknown module "%s"' % name)
+            module = _WebSocketsModule()
+            MicroWebSrv2._modules[name] = module
+        return module
+
+    def SetEmbeddedConfig(self):
+        pass
+
+    def StartManaged(self, parllProcCount=1, procStackSize=0):
+        self.IsRunning = True
+
+    def StartInPureThread(self, procStackSize=0):
+        self.IsRunning = True
+
+    def Stop(self):
+        self.IsRunning = False
+
+
+def accept_websocket(path, address=('127.0.0.1', 50000)):
+    websocket = WebSocket(path, address)
+    module = MicroWebSrv2.LoadModule('WebSockets')
+    module.OnWebSocketAccepted(MicroWebSrv2._instance, websocket)
+    return websocket
@@ -0,0 +1,255 @@
+"""Command path benchmarks for app.py, run on the host through host.py.
+
+    python sim/bench.py                       # print the results
+    python sim/bench.py --save base.json      # keep them as a baseline
+    python sim/bench.py --baseline base.json  # exit 1 on a regression
+
+Latencies are wall clock on the host, so compare runs on the same machine.
+Allocation is the peak transient heap use of one message as seen by
+tracemalloc, which tracks the esp32 numbers far better than the timings.
+"""
+import contextlib
+import io
+import json
+import struct
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+import host
+
+host.install()
+
+import machine  # noqa E402
+import outbox  # noqa E402
+
+MOTOR_FRAME = struct.Struct('<Hhh')
+SETPOINTS = [(1000, 1000), (-1000, -1000), (250, 1000), (-500, 500)]
+COMMANDS = ['robot_forward', 'robot_backward',
+            'robot_rotate_left', 'robot_rotate_right']
+
+_duty_written_at = None
+
+
+def _on_duty(pwm, duty):
+    global _duty_written_at
+    if _duty_written_at is None:
+        _duty_written_at = time.perf_counter()
+
+
+def load_app():
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+        app.main_init()
+    machine.duty_listeners.append(_on_duty)
+    return app
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_until_duty(max_ms=50):
+    # duties are written by the control tick, let virtual time reach it
+    start_us = host.clock.now_us
+    while _duty_written_at is None and \
+            host.clock.now_us - start_us < max_ms * 1000:
+        step_us = 1000
+        next_due_us = host.clock.next_due_us()
+        if next_due_us is not None:
+            step_us = min(max(next_due_us - host.clock.now_us, 0), step_us)
+        host.clock.advance_us(step_us)
+    return host.clock.now_us - start_us
+
+
+def measure_latency(send, iterations, repeat=5, between=None):
+    # host time spent from handing a message to the app until the first
+    # duty write, plus the virtual time the tick made it wait, best of a
+    # few runs to keep host scheduling noise out of the baseline; between()
+    # runs untimed after every message
+    global _duty_written_at
+    best = {}
+    for _ in range(repeat):
+        samples = []
+        waits = []
+        for idx in range(iterations):
+            # land messages at varying points of the control period
+            host.clock.advance_us(idx * 3217 % 10007)
+            _duty_written_at = None
+            start = time.perf_counter()
+            send(idx)
+            waits.append(run_until_duty())
+            if _duty_written_at is not None:
+                samples.append(_duty_written_at - start)
+            if between is not None:
+                between()
+        for metric, fraction in (('p50_us', 0.5), ('p99_us', 0.99)):
+            value = percentile(samples, fraction) * 1e6
+            best[metric] = min(best.get(metric, value), value)
+        for metric, fraction in (('tick_wait_p50_us', 0.5),
+                                 ('tick_wait_p99_us', 0.99)):
+            value = percentile(waits, fraction)
+            best[metric] = min(best.get(metric, value), value)
+    return best
+
+
+def measure_alloc(send, iterations):
+    # peak bytes held while one message is processed, averaged
+    global _duty_written_at
+    peaks = []
+    tracemalloc.start()
+    try:
+        for idx in range(iterations):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            _duty_written_at = None
+            send(idx)
+            run_until_duty()
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+    return {'alloc_bytes': sum(peaks) / len(peaks)}
+
+
+def motors_json_sender(websocket):
+    messages = [json.dumps({'m1': m1, 'm2': m2}) for m1, m2 in SETPOINTS]
+
+    def send(idx):
+        websocket.sim_text(messages[idx % len(messages)])
+    return send
+
+
+def motors_binary_sender(websocket):
+    frames = [MOTOR_FRAME.pack(seq, m1, m2)
+              for seq, (m1, m2) in enumerate(SETPOINTS)]
+
+    def send(idx):
+        websocket.sim_binary(frames[idx % len(frames)])
+    return send
+
+
+def controller_sender(app, websocket):
+    messages = [json.dumps({'cmd': cmd}) for cmd in COMMANDS]
+
+    def send(idx):
+        websocket.sim_text(messages[idx % len(messages)])
+        app.process_cmd_queue()
+        outbox.service()  # what outbox.task() does once the loop runs
+        websocket.sent.clear()
+    return send
+
+
+def bench_queue_throughput(app, iterations):
+    import cmd_ring
+    cmd = app.robot_get_power
+    best = 0
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            cmd_ring.push(cmd)
+            cmd_ring.push(app.robot_forward, None, None, True)
+            cmd_ring.pop()
+            cmd_ring.pop()
+        elapsed = time.perf_counter() - start
+        best = max(best, iterations * 4 / elapsed)
+    return {'ops_per_s': best}
+
+
+def bench_observers(driver, iterations, counts=(0, 2, 4, 6)):
+    # driver latency on /motors_ws while observers watch the same channel,
+    # the fan-out runs between messages the way broadcast.task() would
+    import broadcast
+    send = motors_binary_sender(driver)
+    results = {}
+    for count in counts:
+        observers = [host.open_websocket('/motors_ws',
+                                         ('127.0.0.1', 50001 + idx))
+                     for idx in range(count)]
+        fanout = []
+
+        def fan_out():
+            start = time.perf_counter()
+            broadcast.service()
+            fanout.append(time.perf_counter() - start)
+            outbox.service()
+            for observer in observers:
+                observer.sent.clear()
+        metrics = measure_latency(send, iterations, between=fan_out)
+        metrics['fanout_us'] = sum(fanout) / len(fanout) * 1e6
+        results['observers_%d' % count] = metrics
+        for observer in observers:
+            observer.Close()
+    return results
+
+
+def run(iterations):
+    app = load_app()
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        motors_ws = host.open_websocket('/motors_ws')
+        controller_ws = host.open_websocket('/controller_ws')
+        senders = {
+            'motors_ws_json': motors_json_sender(motors_ws),
+            'motors_ws_binary': motors_binary_sender(motors_ws),
+            'controller_ws': controller_sender(app, controller_ws),
+        }
+        for name, send in senders.items():
+            results[name] = measure_latency(send, iterations)
+            results[name].update(measure_alloc(send, iterations // 10 or 1))
+        results['cmd_ring'] = bench_queue_throughput(app, iterations)
+        results.update(bench_observers(motors_ws, iterations))
+    return results
+
+
+def print_results(results):
+    for name, metrics in results.items():
+        line = ', '.join('%s=%.1f' % item for item in metrics.items())
+        print('%-18s %s' % (name, line))
+
+
+def compare(results, baseline, tolerance):
+    # higher is better only for throughput
+    regressions = []
+    for name, metrics in baseline.items():
+        for metric, old in metrics.items():
+            new = results.get(name, {}).get(metric)
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            if metric.endswith('_per_s'):
+                change = -change
+            if change > tolerance:
+                regressions.append('%s.%s: %.1f -> %.1f (%+.0f%%)' % (
+                    name, metric, old, new, change * 100))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the app.py command path')
+    parser.add_argument('--iterations', '-n', type=int, default=2000)
+    parser.add_argument('--save', help='Write the results to this json file')
+    parser.add_argument('--baseline',
+                        help='Compare against a json file written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown before failing')
+    vargs = parser.parse_args()
+
+    results = run(vargs.iterations)
+    print_results(results)
+    if vargs.save:
+        with open(vargs.save, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    if vargs.baseline:
+        with open(vargs.baseline) as json_file:
+            baseline = json.load(json_file)
+        regressions = compare(results, baseline, vargs.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+# host stand-in, the robot reads its own credentials.py from flash
+WLAN_SSID = 'sim-ssid'
+WLAN_KEY = 'sim-key'
@@ -0,0 +1,197 @@
+"""Host (CPython) stand-in for the esp32 runtime.
+
+The modules next to this file shadow the MicroPython ones app.py imports
+(machine, micropython, network, MicroWebSrv2, ...). install() puts them on
+sys.path in front of the repo root and swaps the MicroPython only parts of
+time and gc for versions driven by a virtual clock, so the real app.py can
+be imported and run unmodified:
+
+    import host
+    host.install()
+    import app
+    host.run_app(5000)  # runs app.main() for 5 s of virtual time
+"""
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+SIM_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SIM_DIR)
+
+# MicroPython ticks wrap at 2**30
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD >> 1
+
+# roughly what an esp32 without psram leaves to the MicroPython heap
+HEAP_SIZE = 111168
+
+
+class VirtualClock:
+    """Microsecond clock that only moves when the driving thread advances it.
+
+    The thread that called install() is the driver: its sleeps and
+    machine.idle() advance time and fire due timers and scheduled
+    callbacks. Sleeps on any other thread block until the driver has
+    advanced the clock far enough.
+    """
+
+    def __init__(self):
+        self.now_us = 0
+        self.driver = threading.get_ident()
+        self.stop_at_us = None
+        self._cond = threading.Condition()
+        self._timers = []
+        self._scheduled = []
+
+    def is_driver(self):
+        return threading.get_ident() == self.driver
+
+    def add_timer(self, timer):
+        if timer not in self._timers:
+            self._timers.append(timer)
+
+    def remove_timer(self, timer):
+        if timer in self._timers:
+            self._timers.remove(timer)
+
+    def next_due_us(self):
+        if not self._timers:
+            return None
+        return min(t.due_us for t in self._timers)
+
+    def schedule(self, func, arg):
+        self._scheduled.append((func, arg))
+
+    def run_scheduled(self):
+        while self._scheduled:
+            func, arg = self._scheduled.pop(0)
+            func(arg)
+
+    def advance_us(self, delta_us):
+        target = self.now_us + max(int(delta_us), 0)
+        while True:
+            self.run_scheduled()
+            due = [t for t in self._timers if t.due_us <= target]
+            if not due:
+                break
+            timer = min(due, key=lambda t: t.due_us)
+            self.now_us = max(self.now_us, timer.due_us)
+            timer.fire()
+        self.now_us = target
+        with self._cond:
+            self._cond.notify_all()
+        self.run_scheduled()
+        if self.stop_at_us is not None and self.now_us >= self.stop_at_us:
+            self.stop_at_us = None
+            raise KeyboardInterrupt
+
+    def sleep_us(self, delta_us):
+        if self.is_driver():
+            self.advance_us(delta_us)
+            return
+        target = self.now_us + delta_us
+        with self._cond:
+            while self.now_us < target:
+                self._cond.wait(0.05)
+
+
+clock = VirtualClock()
+
+
+def ticks_ms():
+    return (clock.now_us // 1000) & TICKS_MAX
+
+
+def ticks_us():
+    return clock.now_us & TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + TICKS_HALFPERIOD) & TICKS_MAX) - \
+        TICKS_HALFPERIOD
+
+
+def sleep_ms(delay_ms):
+    clock.sleep_us(delay_ms * 1000)
+
+
+def sleep_us(delay_us):
+    clock.sleep_us(delay_us)
+
+
+def sleep(delay_s):
+    clock.sleep_us(delay_s * 1000000)
+
+
+def time_s():
+    return clock.now_us // 1000000
+
+
+def mem_alloc():
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return 0
+
+
+def mem_free():
+    return max(HEAP_SIZE - mem_alloc(), 0)
+
+
+gc_threshold = -1
+
+
+def threshold(amount=None):
+    # MicroPython gc.threshold(), recorded only, CPython collects on its own
+    global gc_threshold
+    if amount is None:
+        return gc_threshold
+    gc_threshold = amount
+
+
+_installed = False
+
+
+def install():
+    global _installed
+    if _installed:
+        return clock
+    for path in (REPO_DIR, SIM_DIR):
+        if path in sys.path:
+            sys.path.remove(path)
+    sys.path[0:0] = [SIM_DIR, REPO_DIR]
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_cpu = ticks_us
+    time.ticks_add = ticks_add
+    time.ticks_diff = ticks_diff
+    time.sleep_ms = sleep_ms
+    time.sleep_us = sleep_us
+    time.sleep = sleep
+    time.time = time_s
+    gc.mem_free = mem_free
+    gc.mem_alloc = mem_alloc
+    gc.threshold = threshold
+    clock.driver = threading.get_ident()
+    _installed = True
+    return clock
+
+
+def open_websocket(path, address=('127.0.0.1', 50000)):
+    """Hand a new client socket to the app's OnWebSocketAccepted handler."""
+    import MicroWebSrv2
+    return MicroWebSrv2.accept_websocket(path, address)
+
+
+def run_app(duration_ms):
+    """Run app.main() until duration_ms of virtual time has passed."""
+    import app
+    clock.stop_at_us = clock.now_us + duration_ms * 1000
+    app.main()
@@ -0,0 +1,228 @@
+"""Host stand-in for the esp32 machine module, see host.py."""
+from host import clock
+
+_freq = 160000000
+
+# called as listener(pwm, duty) on every duty write, used by the benchmarks
+duty_listeners = []
+
+
+def freq(value=None):
+    global _freq
+    if value is None:
+        return _freq
+    _freq = value
+
+
+def idle():
+    # the real idle() returns on the next interrupt, at least the 1 ms tick
+    clock.advance_us(1000)
+
+
+def reset():
+    raise SystemExit('machine.reset()')
+
+
+def unique_id():
+    return b'\x24\x0a\xc4\x00\x00\x01'
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, pin_id, mode=-1, pull=-1, value=None):
+        self.id = pin_id
+        self.mode = mode
+        self._value = 0 if value is None else value
+        self._handler = None
+        self._trigger = 0
+        self._hard = False
+
+    def __repr__(self):
+        return 'Pin(%d)' % self.id
+
+    def init(self, mode=-1, pull=-1, value=None):
+        self.mode = mode
+        if value is not None:
+            self._value = value
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._handler = handler
+        self._trigger = trigger if handler is not None else 0
+        self._hard = hard
+        return self
+
+    def sim_edge(self, rising=False):
+        # drive an edge from the outside, firing the irq handler if armed
+        self._value = 1 if rising else 0
+        trigger = self.IRQ_RISING if rising else self.IRQ_FALLING
+        if self._handler is not None and self._trigger & trigger:
+            self._handler(self)
+
+
+class PWM:
+    def __init__(self, pin, freq=5000, duty=0, **kwargs):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty
+        self.history = [(clock.now_us, duty)]
+
+    def __repr__(self):
+        return 'PWM(%r, freq=%d, duty=%d)' % (self.pin, self._freq, self._duty)
+
+    def init(self, freq=None, duty=None, **kwargs):
+        if freq is not None:
+            self._freq = freq
+        if duty is not None:
+            self.duty(duty)
+
+    def deinit(self):
+        self.duty(0)
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+        if len(self.history) > 1024:
+            del self.history[:512]
+        self.history.append((clock.now_us, value))
+        for listener in duty_listeners:
+            listener(self, value)
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty * 65535 // 1023
+        self.duty(value * 1023 // 65535)
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    # the esp32 has four hardware timers, ids alias onto them like the port
+    _hardware = {}
+
+    def __new__(cls, timer_id=-1, **kwargs):
+        index = ((timer_id >> 1) & 1) * 2 + (timer_id & 1)
+        timer = cls._hardware.get(index)
+        if timer is None:
+            timer = super().__new__(cls)
+            timer.index = index
+            timer.due_us = 0
+            timer.period_us = 0
+            timer.mode = cls.ONE_SHOT
+            timer.callback = None
+            cls._hardware[index] = timer
+        return timer
+
+    def __init__(self, timer_id=-1, **kwargs):
+        if kwargs:
+            self.init(**kwargs)
+
+    def __repr__(self):
+        return 'Timer(%d)' % self.index
+
+    def init(self, mode=PERIODIC, period=-1, callback=None, freq=None):
+        if freq is not None:
+            period = 1000 / freq
+        self.mode = mode
+        self.period_us = max(int(period * 1000), 1)
+        self.callback = callback
+        self.due_us = clock.now_us + self.period_us
+        clock.add_timer(self)
+
+    def deinit(self):
+        clock.remove_timer(self)
+
+    def value(self):
+        return max(self.due_us - clock.now_us, 0) // 1000
+
+    def fire(self):
+        if self.mode == self.PERIODIC:
+            self.due_us += self.period_us
+        else:
+            clock.remove_timer(self)
+        if self.callback is not None:
+            self.callback(self)
+
+
+class UART:
+    """Loopback UART: feed() queues what the remote end sends, everything
+    the firmware writes collects in tx."""
+
+    def __init__(self, uart_id, baudrate=115200, **kwargs):
+        self.id = uart_id
+        self.baudrate = baudrate
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self._irq_handler = None
+
+    def init(self, baudrate=115200, **kwargs):
+        self.baudrate = baudrate
+
+    def deinit(self):
+        pass
+
+    def feed(self, data):
+        self.rx.extend(data)
+        if self._irq_handler is not None:
+            self._irq_handler(self)
+
+    def any(self):
+        return len(self.rx)
+
+    def read(self, nbytes=None):
+        if not self.rx:
+            return None
+        if nbytes is None:
+            nbytes = len(self.rx)
+        data = bytes(self.rx[:nbytes])
+        del self.rx[:nbytes]
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        if not self.rx:
+            return None
+        if nbytes is None:
+            nbytes = len(buf)
+        nbytes = min(nbytes, len(self.rx))
+        buf[:nbytes] = self.rx[:nbytes]
+        del self.rx[:nbytes]
+        return nbytes
+
+    def readline(self):
+        idx = self.rx.find(b'\n')
+        return self.read(len(self.rx) if idx == -1 else idx + 1)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.tx.extend(data)
+        if len(self.tx) > 65536:
+            del self.tx[:32768]
+        return len(data)
+
+    def irq(self, handler=None, trigger=0, hard=False):
+        self._irq_handler = handler
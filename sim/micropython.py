@@ -0,0 +1,37 @@
+"""Host stand-in for the micropython module, see host.py."""
+from host import clock
+
+
+def const(value):
+    return value
+
+
+def native(func):
+    return func
+
+
+def viper(func):
+    return func
+
+
+def schedule(func, arg):
+    # like the firmware, runs from the driving thread at the next tick
+    clock.schedule(func, arg)
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def heap_lock():
+    pass
+
+
+def heap_unlock():
+    return 0
+
+
+def mem_info(verbose=False):
+    import gc
+    print('mem: total={} free={}'.format(
+        gc.mem_alloc() + gc.mem_free(), gc.mem_free()))
@@ -0,0 +1,132 @@
+"""Host stand-in for the esp32 network module, see host.py.
+
+The fake access points live in access_points; connect() succeeds after
+connect_delay_ms of virtual time when the ssid is listed there.
+"""
+from host import clock
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 1000
+STAT_CONNECTING = 1001
+STAT_GOT_IP = 1010
+STAT_BEACON_TIMEOUT = 200
+STAT_NO_AP_FOUND = 201
+STAT_WRONG_PASSWORD = 202
+STAT_ASSOC_FAIL = 203
+STAT_HANDSHAKE_TIMEOUT = 204
+
+# (ssid, bssid, channel, rssi)
+access_points = [
+    (b'sim-ssid', b'\x24\x0a\xc4\x11\x22\x33', 6, -55),
+]
+scan_delay_ms = 2000  # a full scan on the esp32 takes seconds
+connect_delay_ms = 800
+dhcp_delay_ms = 400
+# virtual time a status query costs, keeps busy-wait loops moving
+status_cost_us = 100
+
+
+class WLAN:
+    _interfaces = {}
+
+    def __new__(cls, interface_id=STA_IF):
+        wlan = cls._interfaces.get(interface_id)
+        if wlan is None:
+            wlan = super().__new__(cls)
+            wlan.interface_id = interface_id
+            wlan._active = False
+            wlan._status = STAT_IDLE
+            wlan._ap = None
+            wlan._ready_us = 0
+            wlan._ifconfig = ('0.0.0.0', '0.0.0.0', '0.0.0.0', '0.0.0.0')
+            wlan._static = None
+            wlan._config = {'dhcp_hostname': 'espressif',
+                            'mac': b'\x24\x0a\xc4\x00\x00\x01'}
+            cls._interfaces[interface_id] = wlan
+        return wlan
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = bool(value)
+        if not self._active:
+            self._status = STAT_IDLE
+            self._ap = None
+
+    def scan(self):
+        if clock.is_driver():
+            clock.advance_us(scan_delay_ms * 1000)
+        return [(ssid, bssid, channel, rssi, 3, False)
+                for ssid, bssid, channel, rssi in access_points]
+
+    def connect(self, ssid=None, key=None, bssid=None, **kwargs):
+        if not self._active:
+            raise OSError('Wifi Not Started')
+        if isinstance(ssid, str):
+            ssid = ssid.encode()
+        self._ap = None
+        for ap in access_points:
+            if ap[0] == ssid and (bssid is None or ap[1] == bssid):
+                self._ap = ap
+        delay_ms = connect_delay_ms
+        if bssid is None or self._config.get('channel') is None:
+            delay_ms += scan_delay_ms
+        if self._static is None:
+            delay_ms += dhcp_delay_ms
+        self._status = STAT_CONNECTING
+        self._ready_us = clock.now_us + delay_ms * 1000
+
+    def disconnect(self):
+        self._status = STAT_IDLE
+        self._ap = None
+
+    def sim_drop(self):
+        # link loss, e.g. the robot drove out of range
+        self._status = STAT_BEACON_TIMEOUT
+        self._ap = None
+
+    def _update(self):
+        if clock.is_driver():
+            clock.advance_us(status_cost_us)
+        if self._status == STAT_CONNECTING and clock.now_us >= self._ready_us:
+            if self._ap is None:
+                self._status = STAT_NO_AP_FOUND
+            else:
+                self._status = STAT_GOT_IP
+                self._ifconfig = self._static or (
+                    '192.168.1.42', '255.255.255.0',
+                    '192.168.1.1', '192.168.1.1')
+
+    def status(self, param=None):
+        self._update()
+        if param == 'rssi':
+            if self._ap is None or self._status != STAT_GOT_IP:
+                raise OSError('not connected')
+            return self._ap[3]
+        return self._status
+
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+
+    def ifconfig(self, config=None):
+        if config is None:
+            return self._ifconfig
+        if config == 'dhcp':
+            self._static = None
+            return
+        self._static = tuple(config)
+        self._ifconfig = self._static
+
+    def config(self, *args, **kwargs):
+        if args:
+            if args[0] == 'channel':
+                return self._ap[2] if self._ap else 0
+            if args[0] == 'bssid' and self.interface_id == AP_IF:
+                return self._config['mac']
+            if args[0] not in self._config:
+                # e.g. the sta's bssid, the esp32 port cannot read it back
+                raise ValueError('unknown config param')
+            return self._config[args[0]]
+        self._config.update(kwargs)
@@ -0,0 +1,143 @@
+"""Host stand-in for MicroPython's uasyncio, see host.py.
+
+Wraps CPython asyncio with an event loop whose clock is the virtual clock:
+whenever the loop would block it advances virtual time instead, stopping
+at the next machine.Timer deadline so timer callbacks that wake tasks are
+seen at the right time.
+"""
+import asyncio as _asyncio
+import selectors
+import threading
+
+from host import clock
+
+CancelledError = _asyncio.CancelledError
+TimeoutError = _asyncio.TimeoutError
+Event = _asyncio.Event
+Lock = _asyncio.Lock
+create_task = _asyncio.create_task
+gather = _asyncio.gather
+sleep = _asyncio.sleep
+wait_for = _asyncio.wait_for
+current_task = _asyncio.current_task
+
+# virtual time the loop lets pass per wake when nothing is scheduled
+IDLE_STEP_US = 1000
+
+
+class _VirtualTimeSelector(selectors.DefaultSelector):
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            step_us = IDLE_STEP_US
+        else:
+            step_us = max(int(timeout * 1000000), 1)
+        next_due_us = clock.next_due_us()
+        if next_due_us is not None:
+            step_us = min(step_us, max(next_due_us - clock.now_us, 0))
+        clock.advance_us(step_us)
+        return super().select(0)
+
+
+class _VirtualTimeLoop(_asyncio.SelectorEventLoop):
+    def __init__(self):
+        super().__init__(_VirtualTimeSelector())
+
+    def time(self):
+        return clock.now_us / 1000000
+
+
+_loop = None
+
+
+def new_event_loop():
+    global _loop
+    if _loop is not None and not _loop.is_closed():
+        _loop.close()
+    _loop = _VirtualTimeLoop()
+    _asyncio.set_event_loop(_loop)
+    return _loop
+
+
+def get_event_loop():
+    if _loop is None or _loop.is_closed():
+        return new_event_loop()
+    return _loop
+
+
+def _cancel_all(loop):
+    tasks = [t for t in _asyncio.all_tasks(loop) if not t.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(
+            _asyncio.gather(*tasks, return_exceptions=True))
+
+
+def run(coro):
+    loop = get_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        _cancel_all(loop)
+        loop.close()
+
+
+def sleep_ms(delay_ms):
+    return _asyncio.sleep(delay_ms / 1000)
+
+
+def wait_for_ms(awaitable, timeout_ms):
+    return _asyncio.wait_for(awaitable, timeout_ms / 1000)
+
+
+class ThreadSafeFlag:
+    """set() may be called from timer callbacks and other threads."""
+
+    def __init__(self):
+        self._event = _asyncio.Event()
+
+    def set(self):
+        loop = _loop
+        if loop is None or loop.is_closed():
+            return
+        if threading.get_ident() == clock.driver:
+            self._event.set()
+        else:
+            loop.call_soon_threadsafe(self._event.set)
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        await self._event.wait()
+        self._event.clear()
+
+
+class StreamReader:
+    """Only the parts of Stream app.py uses on a machine.UART."""
+
+    def __init__(self, stream):
+        self.s = stream
+
+    async def readinto(self, buf):
+        while not self.s.any():
+            await sleep_ms(1)
+        return self.s.readinto(buf)
+
+    async def read(self, nbytes=-1):
+        while not self.s.any():
+            await sleep_ms(1)
+        return self.s.read(None if nbytes < 0 else nbytes)
+
+    def write(self, data):
+        self.s.write(data)
+
+    async def drain(self):
+        pass
+
+
+Stream = StreamReader
+StreamWriter = StreamReader
@@ -0,0 +1,9 @@
+"""Host stand-in for the webrepl module, see host.py."""
+
+
+def start(port=8266, password=None):
+    pass
+
+
+def stop():
+    pass
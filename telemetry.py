@@ -0,0 +1,170 @@
+import gc
+import struct
+import time
+from array import array
+from micropython import const
+import uasyncio as asyncio
+import cmd_ring
+import control_loop
+import outbox
+
+# /telemetry_ws binary frame, little-endian:
+#   header '<BBH'     version, sample count, frame seq
+#   sample '<IhhIHHH' ticks_ms, m1, m2, mem_free, queue depth,
+#                     max tick jitter us, tick overruns
+FRAME_VERSION = const(1)
+HEADER_FMT = '<BBH'
+SAMPLE_FMT = '<IhhIHHH'
+HEADER_LEN = const(4)
+SAMPLE_LEN = const(18)
+
+MAX_CLIENTS = const(4)
+MAX_RATE_HZ = const(50)
+MAX_BATCH = const(16)
+DEFAULT_RATE_HZ = const(10)
+DEFAULT_BATCH = const(5)
+
+# per client slot, two frame buffers sized to exactly one batch so a
+# frame can be sent whole: one is filled while the outbox may still hold
+# the other. Server threads only write _clients and the pending config,
+# everything else belongs to the telemetry task.
+_clients = [None] * MAX_CLIENTS
+_pending_rate = bytearray(MAX_CLIENTS)  # 0 when nothing is pending
+_pending_batch = bytearray(MAX_CLIENTS)
+_bufs = [None] * MAX_CLIENTS  # (bytearray, bytearray)
+_views = [None] * MAX_CLIENTS  # a memoryview of each, posted to the outbox
+_filling = bytearray(MAX_CLIENTS)  # which of the two is being filled
+_period_ms = array('H', [0] * MAX_CLIENTS)
+_batch = bytearray(MAX_CLIENTS)
+_count = bytearray(MAX_CLIENTS)
+_seq = array('H', [0] * MAX_CLIENTS)
+_next_ms = array('l', [0] * MAX_CLIENTS)
+_flag = asyncio.ThreadSafeFlag()
+
+# counters
+frames_sent = 0  # handed to the outbox, which drops them for slow peers
+send_failures = 0
+
+
+def _slot(websocket):
+    for idx in range(MAX_CLIENTS):
+        if _clients[idx] is websocket:
+            return idx
+    return -1
+
+
+def add_client(websocket):
+    # returns False when all slots are taken
+    idx = _slot(None)
+    if idx < 0:
+        return False
+    _clients[idx] = websocket
+    configure(websocket, DEFAULT_RATE_HZ, DEFAULT_BATCH)
+    return True
+
+
+def remove_client(websocket):
+    idx = _slot(websocket)
+    if idx >= 0:
+        _clients[idx] = None
+
+
+def configure(websocket, rate_hz, batch):
+    # applied by the telemetry task before its next sample
+    idx = _slot(websocket)
+    if idx < 0:
+        return False
+    _pending_batch[idx] = min(max(int(batch), 1), MAX_BATCH)
+    _pending_rate[idx] = min(max(int(rate_hz), 1), MAX_RATE_HZ)
+    _flag.set()
+    return True
+
+
+def _apply_config(idx, now_ms):
+    batch = _pending_batch[idx]
+    if _bufs[idx] is None or _batch[idx] != batch:
+        bufs = (bytearray(HEADER_LEN + batch * SAMPLE_LEN),
+                bytearray(HEADER_LEN + batch * SAMPLE_LEN))
+        _bufs[idx] = bufs
+        _views[idx] = (memoryview(bufs[0]), memoryview(bufs[1]))
+        _filling[idx] = 0
+    _period_ms[idx] = 1000 // _pending_rate[idx]
+    _batch[idx] = batch
+    _count[idx] = 0
+    _next_ms[idx] = now_ms
+    _pending_rate[idx] = 0
+
+
+def client_count():
+    count = 0
+    for websocket in _clients:
+        if websocket is not None:
+            count += 1
+    return count
+
+
+def _sample_into(idx, now_ms):
+    buf = _bufs[idx][_filling[idx]]
+    struct.pack_into(SAMPLE_FMT, buf, HEADER_LEN + _count[idx] * SAMPLE_LEN,
+                     now_ms,
+                     control_loop.applied[0],
+                     control_loop.applied[1],
+                     gc.mem_free(),
+                     cmd_ring.depth(),
+                     min(control_loop.max_jitter_us, 0xFFFF),
+                     control_loop.overruns & 0xFFFF)
+    _count[idx] += 1
+
+
+def _send(idx, websocket):
+    global frames_sent, send_failures
+    filling = _filling[idx]
+    struct.pack_into(HEADER_FMT, _bufs[idx][filling], 0,
+                     FRAME_VERSION, _count[idx], _seq[idx])
+    _seq[idx] = (_seq[idx] + 1) & 0xFFFF
+    _count[idx] = 0
+    # the next frame goes into the other buffer, by the time that one is
+    # posted the outbox has sent or dropped this one
+    _filling[idx] = filling ^ 1
+    if outbox.post_latest(websocket, _views[idx][filling]):
+        frames_sent += 1
+    else:
+        send_failures += 1
+
+
+def _service(now_ms):
+    # samples every due client, returns ms until the next one is due
+    wait_ms = -1
+    for idx in range(MAX_CLIENTS):
+        websocket = _clients[idx]
+        if websocket is None:
+            _bufs[idx] = None
+            _views[idx] = None
+            continue
+        if _pending_rate[idx]:
+            _apply_config(idx, now_ms)
+        due_ms = time.ticks_diff(_next_ms[idx], now_ms)
+        if due_ms <= 0:
+            _sample_into(idx, now_ms)
+            if _count[idx] >= _batch[idx]:
+                _send(idx, websocket)
+            _next_ms[idx] = time.ticks_add(_next_ms[idx], _period_ms[idx])
+            if time.ticks_diff(_next_ms[idx], now_ms) <= 0:
+                # fell behind, skip the missed samples
+                _next_ms[idx] = time.ticks_add(now_ms, _period_ms[idx])
+            due_ms = time.ticks_diff(_next_ms[idx], now_ms)
+        if wait_ms < 0 or due_ms < wait_ms:
+            wait_ms = due_ms
+    return wait_ms
+
+
+async def task():
+    while True:
+        wait_ms = _service(time.ticks_ms())
+        if wait_ms < 0:
+            await _flag.wait()
+        else:
+            try:
+                await asyncio.wait_for_ms(_flag.wait(), wait_ms)
+            except asyncio.TimeoutError:
+                pass
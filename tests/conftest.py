@@ -0,0 +1,10 @@
+# firmware modules run on the host through the sim stand-ins
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_DIR, 'sim'), REPO_DIR]
+
+import host  # noqa E402
+
+host.install()
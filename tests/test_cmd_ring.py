@@ -0,0 +1,84 @@
+import pytest
+
+import cmd_ring
+
+CAPACITY = 4
+
+
+def motion(param=None):
+    pass
+
+
+def other(param=None):
+    pass
+
+
+def drain():
+    entries = []
+    while cmd_ring.depth():
+        entries.append(cmd_ring.pop())
+    return entries
+
+
+@pytest.fixture(params=[cmd_ring.DROP_OLDEST, cmd_ring.DROP_NEWEST,
+                        cmd_ring.REJECT])
+def policy(request):
+    cmd_ring.init(CAPACITY, request.param)
+    yield request.param
+    cmd_ring.init()
+
+
+def test_coalesced_burst_keeps_newest(policy):
+    # more setpoints than slots, all but the newest are coalesced away
+    results = [cmd_ring.push(motion, idx, coalesce=True) for idx in range(6)]
+    assert results == [True] * 6
+    assert cmd_ring.depth() == 1
+    assert drain() == [(motion, 5, None)]
+    assert cmd_ring.pop() is None
+
+
+def test_coalesced_burst_in_a_full_queue(policy):
+    for idx in range(CAPACITY - 1):
+        assert cmd_ring.push(other, idx)
+    assert cmd_ring.push(motion, 0, coalesce=True)
+    # full now, but the setpoints only replace the pending one
+    for idx in range(1, 6):
+        assert cmd_ring.push(motion, idx, coalesce=True)
+    assert cmd_ring.depth() == CAPACITY
+    entries = drain()
+    assert entries[:-1] == [(other, idx, None) for idx in range(CAPACITY - 1)]
+    assert entries[-1] == (motion, 5, None)
+
+
+def test_overflow_after_a_coalesced_burst(policy):
+    for idx in range(6):
+        cmd_ring.push(motion, idx, coalesce=True)
+    for idx in range(CAPACITY - 1):
+        assert cmd_ring.push(other, idx)
+    pushed = cmd_ring.push(other, 99)
+    entries = drain()
+    if policy == cmd_ring.DROP_OLDEST:
+        # the oldest entry is the pending setpoint, nothing dead in its place
+        assert pushed
+        assert entries == [(other, idx, None) for idx in range(CAPACITY - 1)] \
+            + [(other, 99, None)]
+    else:
+        assert not pushed
+        assert entries == [(motion, 5, None)] + \
+            [(other, idx, None) for idx in range(CAPACITY - 1)]
+
+
+def test_setpoint_behind_another_command_is_not_coalesced(policy):
+    # robot_forward, robot_set_power(300), robot_forward: the second
+    # forward must run after the power change and reply after it
+    cmd_ring.push(motion, 1, coalesce=True, seq=1)
+    cmd_ring.push(other, 300, seq=2)
+    cmd_ring.push(motion, 3, coalesce=True, seq=3)
+    seqs = []
+    entries = []
+    while cmd_ring.depth():
+        entries.append(cmd_ring.pop())
+        seqs.append(cmd_ring.last_seq)
+    assert entries == [(motion, 1, None), (other, 300, None),
+                       (motion, 3, None)]
+    assert seqs == [1, 2, 3]
@@ -0,0 +1,33 @@
+import host
+
+import motion
+
+stops = []
+
+
+def setup_function():
+    stops.clear()
+    motion.init(lambda: stops.append(host.clock.now_us // 1000))
+    motion.cancel()
+
+
+def test_wait_keeps_the_stop_of_a_timed_motion():
+    start_ms = host.clock.now_us // 1000
+    motion.begin(500)  # e.g. robot_forward()
+    host.clock.advance_us(100000)
+    motion.begin(500, stop=False)  # robot_wait() from the next command
+    host.clock.advance_us(450000)
+    assert stops == [start_ms + 500]
+    # the wait runs once the motion stopped
+    assert motion.is_busy() and motion.remaining_ms() > 0
+    host.clock.advance_us(500000)
+    assert not motion.is_busy()
+    assert len(stops) == 1
+
+
+def test_motion_pre_empts_a_queued_wait():
+    motion.begin(500)
+    motion.begin(500, stop=False)
+    motion.begin(-1)  # e.g. robot_stop()
+    host.clock.advance_us(600000)
+    assert stops == [] and not motion.is_busy()
@@ -0,0 +1,37 @@
+import os
+import sys
+
+from motor_driver import MOTORS, MotorDriver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tools'))
+import motor_calibrate  # noqa E402
+
+CALIBRATION = {'m1': {'deadband': 0.25, 'curve': 1.5},
+               'm2': {'gain': 0.9, 'trim': -0.05}}
+
+
+def test_rebuild_swaps_in_whole_tables():
+    driver = MotorDriver((25, 26, 27, 14))
+    driver.apply(500, -500)
+    old_tables, old_writers = driver._mapping
+    old = [list(table) for table in old_tables]
+    driver.calibrate(CALIBRATION)
+    # a tick holding the old mapping still reads complete tables
+    assert [list(table) for table in old_tables] == old
+    tables, writers = driver._mapping
+    assert tables is not old_tables and writers is old_writers
+    for motor, table in zip(MOTORS, tables):
+        cal = motor_calibrate.motor_calibration(CALIBRATION, motor)
+        assert list(table) == motor_calibrate.build_table(cal)
+    driver.apply(500, -500)
+    assert driver.duties[1] == tables[0][500]
+    assert driver.duties[2] == tables[1][500]
+
+
+def test_bits_change_swaps_writers_with_tables():
+    driver = MotorDriver((25, 26, 27, 14))
+    driver.set_pwm(bits=12)
+    tables, writers = driver._mapping
+    assert tables[0][1023] == 65535
+    assert writers[0].__name__ == 'duty_u16'
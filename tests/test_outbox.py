@@ -0,0 +1,91 @@
+import time
+
+import host
+import uasyncio as asyncio
+from MicroWebSrv2 import WebSocket
+
+import latency
+import outbox
+
+
+class SlowWebSocket(WebSocket):
+    # every send blocks for longer than outbox.STALL_US
+    def SendTextMessage(self, msg):
+        host.clock.advance_us(outbox.STALL_US * 2)
+        return super().SendTextMessage(msg)
+
+
+def test_stalled_peer_does_not_hold_up_the_rest():
+    outbox.init()
+    slow = SlowWebSocket('/controller_ws', ('127.0.0.1', 50100))
+    fast = WebSocket('/motors_ws', ('127.0.0.1', 50101))
+    assert outbox.register(slow) and outbox.register(fast)
+    stalls = outbox.stalls
+    for idx in range(outbox.TEXT_QUEUE_LEN + 4):
+        outbox.post_text(slow, 'slow %d' % idx)
+        outbox.post_text(fast, 'fast %d' % idx)
+        outbox.service()
+    # the slow peer was sent to once and then skipped, its queue bounded
+    assert len(slow.sent) == 1
+    assert len(fast.sent) == outbox.TEXT_QUEUE_LEN + 4
+    assert outbox.stalls == stalls + 1
+    host.clock.advance_us(outbox.STALL_BACKOFF_MS * 1000)
+    outbox.service()
+    assert slow.sent[-1].split(outbox.SEPARATOR)[-1] == 'slow %d' % (
+        outbox.TEXT_QUEUE_LEN + 3)
+    outbox.unregister(slow)
+    outbox.unregister(fast)
+
+
+def test_task_skips_a_stalled_peer_too():
+    # the loop the firmware runs, not just service()
+    outbox.init()
+    slow = SlowWebSocket('/controller_ws', ('127.0.0.1', 50104))
+    fast = WebSocket('/motors_ws', ('127.0.0.1', 50105))
+    assert outbox.register(slow) and outbox.register(fast)
+
+    async def drive():
+        runner = asyncio.create_task(outbox.task())
+        for idx in range(outbox.TEXT_QUEUE_LEN + 4):
+            outbox.post_text(slow, 'slow %d' % idx)
+            outbox.post_text(fast, 'fast %d' % idx)
+            await asyncio.sleep_ms(1)
+        runner.cancel()
+
+    asyncio.run(drive())
+    assert len(slow.sent) == 1
+    assert len(fast.sent) == outbox.TEXT_QUEUE_LEN + 4
+    outbox.unregister(slow)
+    outbox.unregister(fast)
+
+
+def test_latest_frame_replaces_the_pending_one():
+    outbox.init()
+    websocket = WebSocket('/telemetry_ws', ('127.0.0.1', 50102))
+    outbox.register(websocket)
+    buf = bytearray(b'one')
+    outbox.post_latest(websocket, memoryview(buf))
+    outbox.post_latest(websocket, b'two')
+    outbox.service()
+    assert websocket.sent == [b'two']
+    outbox.unregister(websocket)
+
+
+def test_reply_latency_ends_at_the_send():
+    outbox.init()
+    websocket = WebSocket('/controller_ws', ('127.0.0.1', 50103))
+    outbox.register(websocket)
+    latency.reset()
+    recv_us = time.ticks_us()
+    host.clock.advance_us(1000)
+    outbox.post_text(websocket, 'reply', recv_us=recv_us,
+                     done_us=time.ticks_us())
+    outbox.post_text(websocket, 'untimed')
+    host.clock.advance_us(5000)
+    assert latency.counts[latency.RECV_TO_REPLY] == 0
+    outbox.service()
+    assert latency.counts[latency.RECV_TO_REPLY] == 1
+    assert latency.counts[latency.REPLY] == 1
+    assert latency.totals_us[latency.RECV_TO_REPLY] >= 6000
+    assert latency.totals_us[latency.REPLY] >= 5000
+    outbox.unregister(websocket)
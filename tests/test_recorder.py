@@ -0,0 +1,33 @@
+import recorder
+
+
+def read_log():
+    with open(recorder.FILE_NAMES[0], 'rb') as log_file:
+        recorder.read_header(log_file)
+        return [record[1:] for record in recorder.read_records(log_file)]
+
+
+def test_setpoint_from_a_timer_never_waits(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    recorder.init(['robot_forward'])
+    # a timer callback runs between bytecodes of whoever holds the lock
+    with recorder._lock:
+        recorder.setpoint(300, -300, True)
+    recorder.command(0, 500)
+    recorder.setpoint(0, 0)
+    recorder.flush()
+    assert read_log() == [
+        (recorder.BOOT, 0, 0, 0),
+        (recorder.SETPOINT, 1, 300, -300),
+        (recorder.COMMAND, 0, 500, 1),
+        (recorder.SETPOINT, 0, 0, 0),
+    ]
+
+
+def test_deferred_setpoint_is_flushed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    recorder.init([])
+    with recorder._lock:
+        recorder.setpoint(100, 100)
+    recorder.flush()
+    assert read_log()[-1] == (recorder.SETPOINT, 0, 100, 100)
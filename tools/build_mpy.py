@@ -0,0 +1,73 @@
+"""Cross-compile the firmware modules to .mpy bytecode.
+
+The esp32 then loads precompiled bytecode instead of compiling every
+module from source on each boot. boot.py and main.py stay as source (the
+firmware only runs those two as .py) and so does credentials.py, which is
+local to every robot.
+
+    python tools/build_mpy.py              # writes build/*.mpy
+    python tools/build_mpy.py --clean      # removes build/ first
+
+Upload build/*.mpy together with boot.py, main.py and credentials.py, and
+remove the matching .py files from the board, a .py shadows its .mpy.
+Needs mpy-cross matching the firmware version (pip install mpy-cross).
+"""
+import os
+import shutil
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUILD_DIR = os.path.join(REPO_DIR, 'build')
+KEEP_AS_SOURCE = ('boot.py', 'main.py', 'credentials.py', '__init__.py')
+
+
+def firmware_modules():
+    return sorted(name for name in os.listdir(REPO_DIR)
+                  if name.endswith('.py') and name not in KEEP_AS_SOURCE)
+
+
+def mpy_cross_command():
+    executable = shutil.which('mpy-cross')
+    if executable is not None:
+        return [executable]
+    try:
+        import mpy_cross  # noqa F401
+    except ImportError:
+        sys.exit('mpy-cross not found, pip install mpy-cross')
+    return [sys.executable, '-m', 'mpy_cross']
+
+
+def build(arch, clean):
+    if clean and os.path.isdir(BUILD_DIR):
+        shutil.rmtree(BUILD_DIR)
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    command = mpy_cross_command()
+    for name in firmware_modules():
+        source = os.path.join(REPO_DIR, name)
+        target = os.path.join(BUILD_DIR, name[:-3] + '.mpy')
+        args = command + ['-o', target, source]
+        if arch:
+            args.insert(len(command), f'-march={arch}')
+        subprocess.run(args, check=True)
+        print(f'{name} -> {os.path.relpath(target, REPO_DIR)} '
+              f'({os.path.getsize(source)} -> {os.path.getsize(target)} B)')
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--arch', '-a',
+        default='xtensawin',
+        help='mpy-cross -march, xtensawin for the esp32, empty for none')
+    parser.add_argument(
+        '--clean', '-c',
+        action='store_true',
+        help='Remove the build directory first')
+    vargs = vars(parser.parse_args())
+    build(vargs['arch'], vargs['clean'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Decode flight logs written by recorder.py.
+
+Copy them off the board first, e.g. with the webrepl or pymakr file
+download, then
+
+    python tools/flight_decode.py flight.1.bin flight.bin   # oldest first
+    python tools/flight_decode.py --csv flight.bin > flight.csv
+    python tools/flight_decode.py --summary flight.bin
+
+Times are ms since the start of each session, a session being everything
+recorded between two boots.
+"""
+import csv
+import struct
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+
+# keep in sync with recorder.py
+MAGIC = b'FREC'
+FILE_VERSION = 1
+HEADER = struct.Struct('<4sBBH')
+RECORD = struct.Struct('<IBBhh')
+BOOT, SETPOINT, COMMAND = 0, 1, 2
+TICKS_PERIOD = 1 << 30  # esp32 ticks_ms wraps here
+
+
+def read_log(path):
+    # returns the command names and the raw records of one file
+    with open(path, 'rb') as log_file:
+        data = log_file.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f'{path}: too short for a flight log')
+    magic, version, record_len, names_len = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FILE_VERSION or record_len != RECORD.size:
+        raise ValueError(f'{path}: not a version {FILE_VERSION} flight log')
+    pos = HEADER.size + names_len
+    names = data[HEADER.size:pos].decode().split('\n')
+    end = pos + (len(data) - pos) // RECORD.size * RECORD.size
+    return names, list(RECORD.iter_unpack(data[pos:end]))
+
+
+def decode(paths):
+    # yields (session, t_ms, kind, detail, a, b) across the files in order
+    session = 0
+    start = None
+    for path in paths:
+        names, records = read_log(path)
+        for ticks, kind, code, a, b in records:
+            if kind == BOOT:
+                session += 1
+                start = ticks
+                yield session, 0, 'boot', path, a, None
+                continue
+            if start is None:
+                start = ticks  # the file was rotated mid session
+            t_ms = (ticks - start) % TICKS_PERIOD
+            if kind == SETPOINT:
+                yield session, t_ms, 'setpoint', 'hold' if code else '', a, b
+            elif kind == COMMAND:
+                name = names[code] if code < len(names) else f'#{code}'
+                yield session, t_ms, 'command', name, a if b else None, None
+            else:
+                yield session, t_ms, f'kind{kind}', '', a, b
+
+
+def print_table(rows):
+    for session, t_ms, kind, detail, a, b in rows:
+        values = ' '.join(str(value) for value in (a, b) if value is not None)
+        print(f'{session:3d} {t_ms:10d} {kind:9s} {detail:24s} {values}')
+
+
+def print_csv(rows):
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['session', 't_ms', 'kind', 'detail', 'a', 'b'])
+    writer.writerows(rows)
+
+
+def print_summary(rows):
+    kinds = Counter()
+    commands = Counter()
+    sessions = {}
+    for session, t_ms, kind, detail, _, _ in rows:
+        kinds[kind] += 1
+        if kind == 'command':
+            commands[detail] += 1
+        sessions[session] = max(sessions.get(session, 0), t_ms)
+    for session, duration_ms in sessions.items():
+        print(f'session {session}: {duration_ms / 1000:.1f} s')
+    for kind, count in kinds.most_common():
+        print(f'{kind:9s} {count}')
+    for name, count in commands.most_common():
+        print(f'  {name:24s} {count}')
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='+',
+                        help='Flight logs, oldest first')
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--csv', '-c', action='store_true',
+                        help='Write csv to stdout')
+    output.add_argument('--summary', '-s', action='store_true',
+                        help='Only count records per session and command')
+    vargs = vars(parser.parse_args())
+    try:
+        rows = list(decode(vargs['paths']))
+    except (OSError, ValueError) as ex:
+        sys.exit(str(ex))
+    if vargs['csv']:
+        print_csv(rows)
+    elif vargs['summary']:
+        print_summary(rows)
+    else:
+        print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Fit the per motor calibration that motor_driver.py maps setpoints with.
+
+Measure on the robot with the calibration it has now, then fit and upload
+motor_cal.json next to app.py and run robot_load_calibration() (loadcal).
+
+    # smallest robot_set_motor_powers(m1, 0) / (0, m2) that turns each wheel
+    python tools/motor_calibrate.py fit --start 180,150
+    # heading change of one robot_forward(), positive when it veered left
+    python tools/motor_calibrate.py fit --drift-deg 12 --forward-m 0.4
+    python tools/motor_calibrate.py table --bits 16 --step 64
+
+fit updates motor_cal.json in place, so deadband and trim can be measured
+one after the other; repeat the drift run until it is straight enough, the
+wheels do not turn exactly in proportion to the duty past the deadband.
+m1 is the left wheel and m2 the right one, as in robot_rotate_left().
+"""
+import csv
+import json
+import math
+import os
+import sys
+from argparse import ArgumentParser
+
+# keep in sync with motor_driver.py
+SETPOINT_MAX = 1023
+TABLE_LEN = 1024
+DEFAULT_BITS = 10
+DEFAULT_CALIBRATION = dict(deadband=0.0, gain=1.0, trim=0.0, curve=1.0)
+MOTORS = ('m1', 'm2')
+DEFAULT_TRACK_M = 0.12  # trajectory_sim.py's default
+
+
+def motor_calibration(calibration, motor):
+    result = dict(DEFAULT_CALIBRATION)
+    result.update((calibration or {}).get(motor, {}))
+    return result
+
+
+def fraction(cal, level):
+    # duty as a fraction of full duty for a setpoint magnitude
+    if level == 0:
+        return 0.0
+    span = min(cal['gain'] * (1 + cal['trim']), 1) - cal['deadband']
+    value = cal['deadband'] + span * (level / SETPOINT_MAX) ** cal['curve']
+    return min(max(value, 0.0), 1.0)
+
+
+def build_table(cal, bits=DEFAULT_BITS):
+    # the duties MotorDriver writes for setpoints 0..SETPOINT_MAX
+    top = (1 << bits) - 1
+    scale = 1 if bits == DEFAULT_BITS else 65535 / top
+    return [int(int(fraction(cal, level) * top + 0.5) * scale + 0.5)
+            for level in range(TABLE_LEN)]
+
+
+def load(path):
+    if not os.path.exists(path):
+        return {motor: dict(DEFAULT_CALIBRATION) for motor in MOTORS}
+    with open(path) as cal_file:
+        calibration = json.load(cal_file)
+    return {motor: motor_calibration(calibration, motor) for motor in MOTORS}
+
+
+def track_from(robots_path, robot):
+    # the track trajectory_sim.py calibrate stored for this robot
+    with open(robots_path) as robots_file:
+        robots = json.load(robots_file)
+    if robot not in robots:
+        raise ValueError(f'{robot} not in {robots_path}')
+    return robots[robot]['track_m']
+
+
+def fit_deadband(calibration, starts):
+    # the duty that turned each wheel becomes where setpoint 1 lands
+    for motor, start in zip(MOTORS, starts):
+        cal = calibration[motor]
+        cal['deadband'] = round(fraction(cal, min(start, SETPOINT_MAX)), 4)
+
+
+def fit_trim(calibration, drift_deg, forward_m, track_m):
+    # the heading changed by (right - left) * t / track while the robot
+    # drove (right + left) / 2 * t, the faster wheel is slowed to match
+    ratio = math.radians(drift_deg) * track_m / (2 * forward_m)
+    if not -1 < ratio < 1:
+        raise ValueError('drift too large for that distance and track')
+    right_over_left = (1 + ratio) / (1 - ratio)
+    if right_over_left > 1:
+        motor, factor = 'm2', 1 / right_over_left
+    else:
+        motor, factor = 'm1', right_over_left
+    cal = calibration[motor]
+    cal['trim'] = round((1 + cal['trim']) * factor - 1, 4)
+
+
+def command_fit(vargs):
+    calibration = load(vargs['file'])
+    if vargs['start']:
+        starts = [int(value) for value in vargs['start'].split(',')]
+        if len(starts) != 2:
+            raise ValueError('--start takes m1,m2')
+        fit_deadband(calibration, starts)
+    if vargs['drift_deg'] is not None:
+        track_m = vargs['track_m']
+        if vargs['calibration']:
+            track_m = track_from(vargs['calibration'], vargs['robot'])
+        fit_trim(calibration, vargs['drift_deg'], vargs['forward_m'],
+                 track_m)
+    for key in ('gain', 'curve'):
+        if vargs[key] is not None:
+            for motor in MOTORS:
+                calibration[motor][key] = vargs[key]
+    print(json.dumps(calibration))
+    with open(vargs['file'], 'w') as cal_file:
+        json.dump(calibration, cal_file, indent=2)
+
+
+def command_table(vargs):
+    calibration = load(vargs['file'])
+    tables = [build_table(calibration[motor], vargs['bits'])
+              for motor in MOTORS]
+    levels = list(range(0, TABLE_LEN, vargs['step']))
+    if levels[-1] != SETPOINT_MAX:
+        levels.append(SETPOINT_MAX)
+    rows = [(level, tables[0][level], tables[1][level]) for level in levels]
+    if vargs['csv']:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['setpoint', 'm1', 'm2'])
+        writer.writerows(rows)
+        return
+    for level, duty1, duty2 in rows:
+        print(f'{level:5d} {duty1:6d} {duty2:6d}')
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--file', '-f', default='motor_cal.json',
+                        help='Calibration to update or show')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fit = commands.add_parser('fit', help='Fold measurements into the file')
+    fit.add_argument('--start', metavar='M1,M2',
+                     help='Smallest setpoint that turns each wheel')
+    fit.add_argument('--drift-deg', type=float,
+                     help='Heading change of one robot_forward(), + is left')
+    fit.add_argument('--forward-m', type=float, default=0.5,
+                     help='Distance that robot_forward() drove')
+    fit.add_argument('--track-m', type=float, default=DEFAULT_TRACK_M,
+                     help='Wheel to wheel')
+    fit.add_argument('--calibration', '-c',
+                     help='Take the track from a trajectory_sim.py file')
+    fit.add_argument('--robot', '-r', default='alpo',
+                     help='Robot in that file')
+    fit.add_argument('--gain', type=float,
+                     help='Duty of the largest setpoint for both motors')
+    fit.add_argument('--curve', type=float,
+                     help='Response exponent for both motors, 1 is linear')
+
+    table = commands.add_parser('table',
+                                help='Print the duty tables the robot builds')
+    table.add_argument('--bits', type=int, default=DEFAULT_BITS,
+                       help='MOTOR_PWM_BITS')
+    table.add_argument('--step', type=int, default=64,
+                       help='Print every STEP-th setpoint')
+    table.add_argument('--csv', action='store_true',
+                       help='Write csv to stdout')
+
+    vargs = vars(parser.parse_args())
+    handlers = {
+        'fit': command_fit,
+        'table': command_table,
+    }
+    try:
+        handlers[vargs['command']](vargs)
+    except (OSError, ValueError, KeyError) as ex:
+        sys.exit(str(ex))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,485 @@
+"""Predict where command scripts and setpoint streams take the robot.
+
+A differential drive model of the firmware: setpoints go through the same
+slew limited control tick as control_loop.py and the same duty tables as
+motor_driver.py, every wheel turns a duty into a speed past a deadband,
+and the pose is integrated per tick. All
+scripts of a batch are simulated at once with NumPy, so sweeps over power
+levels, durations or calibrations take seconds.
+
+    python tools/trajectory_sim.py run script.json
+    python tools/trajectory_sim.py sweep script.json \\
+        --power-range 400:1000:100 --rotate-range 100:400:20 \\
+        --target 0.5,0.2,90
+    python tools/trajectory_sim.py flight flight.1.bin flight.bin
+    python tools/trajectory_sim.py calibrate --forward-m 0.21 \\
+        --rotate-deg 75 --robot alpo --save robots.json
+    python tools/trajectory_sim.py run script.json -c robots.json -r alpo
+
+A script is the /controller_ws program format, a json list of
+[command, param, duration_ms] steps with param the step power (or the new
+power of robot_set_power) and the trailing items optional, or a list of
+[t_ms, m1, m2] setpoints as /motors_ws would receive them.
+Calibrations are kept per robot in a json file,
+{"alpo": {"track_m": 0.12, "left_mps": 0.5, "right_mps": 0.5,
+"deadband": 300}}, see the calibrate command. The setpoint to duty
+tables come from motor_cal.json if there is one (--motor-cal picks another
+file), as tools/motor_calibrate.py writes it for the robot.
+x is forward at the start, y to the left, the heading counter-clockwise.
+"""
+import json
+import math
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from flight_decode import decode  # noqa E402
+from motor_calibrate import MOTORS, build_table  # noqa E402
+from motor_calibrate import load as load_motor_calibration  # noqa E402
+
+# keep in sync with app.py and control_loop.py
+DUTY_MAX = 1023
+CONTROL_RATE_HZ = 100
+CONTROL_SLEW_PER_S = 5000
+STREAM_STALE_MS = 750
+DEFAULT_POWER = 1000
+DEFAULT_MOTION_DURATION_MS = 500
+DEFAULT_ROTATE_DURATION_MS = 200
+# motor directions in units of the power and the default duration kind
+PROGRAM_CMDS = {
+    'robot_stop': (0, 0, None),
+    'robot_forward': (1, 1, 'motion'),
+    'robot_backward': (-1, -1, 'motion'),
+    'robot_rotate_right': (1, -1, 'rotate'),
+    'robot_rotate_left': (-1, 1, 'rotate'),
+    'robot_turn_right': (1, 0, 'rotate'),
+    'robot_turn_left': (0, 1, 'rotate'),
+    'robot_wait': (0, 0, 'motion'),
+    'robot_wait_1s': (0, 0, 1000),
+    'robot_wait_5s': (0, 0, 5000),
+}
+# commands that never move the robot
+PASSIVE_PREFIXES = ('get_', 'robot_get_', 'print_', 'cancel_', 'replay_',
+                    'stop_replay')
+
+MOTOR_CALIBRATION_FILE = 'motor_cal.json'  # app.py's
+DEFAULT_CALIBRATION = dict(
+    track_m=0.12,  # wheel to wheel
+    left_mps=0.5,  # wheel speed at full duty
+    right_mps=0.5,
+    deadband=300,  # duty below which a wheel does not turn
+)
+
+
+def default_durations(motion_ms=DEFAULT_MOTION_DURATION_MS,
+                      rotate_ms=DEFAULT_ROTATE_DURATION_MS):
+    return {'motion': motion_ms, 'rotate': rotate_ms}
+
+
+def _duration(kind, durations):
+    if kind is None:
+        return 0
+    if isinstance(kind, int):
+        return kind
+    return durations[kind]
+
+
+def program_segments(steps, power=DEFAULT_POWER, durations=None):
+    # [(start_ms, m1, m2), ...] and the end, like app._compile_program
+    durations = durations or default_durations()
+    segments = []
+    at_ms = 0
+    for step in steps:
+        if isinstance(step, str):
+            step = [step]
+        name = step[0]
+        param = step[1] if len(step) > 1 else None
+        duration = step[2] if len(step) > 2 else None
+        if name == 'robot_set_power':
+            power = int(param)
+            continue
+        if name not in PROGRAM_CMDS:
+            raise ValueError(f'{name} not allowed in a program')
+        dir1, dir2, kind = PROGRAM_CMDS[name]
+        step_power = power if param is None else int(param)
+        if duration is None or isinstance(kind, int):
+            duration = _duration(kind, durations)
+        segments.append((at_ms, dir1 * step_power, dir2 * step_power))
+        at_ms += int(duration)
+    segments.append((at_ms, 0, 0))
+    return segments, at_ms
+
+
+def event_segments(events, power=DEFAULT_POWER, durations=None):
+    # events are (t_ms, 'setpoint', m1, m2, hold) or (t_ms, 'command', name,
+    # param) with the firmware's semantics: a command's param is its
+    # duration and a motion stops the motors when it ends, a setpoint does
+    # so after STREAM_STALE_MS unless it is held
+    durations = durations or default_durations()
+    segments = []
+    stop_at = None
+    end_ms = 0
+    for event in sorted(events, key=lambda event: event[0]):
+        t_ms = event[0]
+        if stop_at is not None and stop_at <= t_ms:
+            segments.append((stop_at, 0, 0))
+            stop_at = None
+        if event[1] == 'setpoint':
+            _, _, motor1, motor2, hold = event
+            segments.append((t_ms, motor1, motor2))
+            stop_at = None if hold else t_ms + STREAM_STALE_MS
+        else:
+            _, _, name, param = event
+            if name == 'robot_set_power':
+                power = int(param)
+            elif name == 'robot_stop':
+                segments.append((t_ms, 0, 0))
+                stop_at = None
+            elif name in ('robot_wait', 'robot_wait_1s', 'robot_wait_5s'):
+                stop_at = None  # replaces the pending stop, keeps duties
+            elif name in PROGRAM_CMDS:
+                dir1, dir2, kind = PROGRAM_CMDS[name]
+                duration = _duration(kind, durations) if param is None \
+                    else int(param)
+                segments.append((t_ms, dir1 * power, dir2 * power))
+                stop_at = t_ms + duration
+            elif not name.startswith(PASSIVE_PREFIXES):
+                raise ValueError(f'cannot simulate {name}')
+        end_ms = max(end_ms, t_ms)
+    if stop_at is not None:
+        segments.append((stop_at, 0, 0))
+        end_ms = max(end_ms, stop_at)
+    return segments, end_ms
+
+
+def stream_events(setpoints):
+    # [[t_ms, m1, m2], ...] as streamed to /motors_ws
+    return [(t_ms, 'setpoint', m1, m2, False) for t_ms, m1, m2 in setpoints]
+
+
+def load_script(path, power=DEFAULT_POWER, durations=None):
+    with open(path) as script_file:
+        script = json.load(script_file)
+    if isinstance(script, dict):
+        script = script['program']  # a /controller_ws message
+    if script and isinstance(script[0], list) and \
+            isinstance(script[0][0], (int, float)):
+        return event_segments(stream_events(script), power, durations)
+    return program_segments(script, power, durations)
+
+
+def targets(segment_lists, period_ms, ticks=None):
+    # per tick duty targets, shape (batch, ticks), 0 past every end
+    if ticks is None:
+        end_ms = max(segments[-1][0] for segments in segment_lists)
+        ticks = int(math.ceil(end_ms / period_ms)) + 1
+    tick_ms = np.arange(ticks) * period_ms
+    m1 = np.zeros((len(segment_lists), ticks))
+    m2 = np.zeros((len(segment_lists), ticks))
+    for row, segments in enumerate(segment_lists):
+        table = np.array(segments, dtype=float)
+        # the tick at a segment's start already sees it, like set_target
+        idx = np.searchsorted(table[:, 0], tick_ms, side='right') - 1
+        valid = idx >= 0
+        m1[row, valid] = table[idx[valid], 1]
+        m2[row, valid] = table[idx[valid], 2]
+    return m1, m2
+
+
+def slew(current, wanted, step):
+    # control_loop._step on whole arrays
+    if step == 0:
+        return wanted
+    current = np.where(current * wanted < 0, 0, current)
+    limited = np.where(wanted > current,
+                       np.minimum(wanted, current + step),
+                       np.maximum(wanted, current - step))
+    return np.where(np.abs(wanted) <= np.abs(current), wanted, limited)
+
+
+def duties(setpoint, table):
+    # motor_driver.py's lookup on whole arrays, None is the identity
+    if table is None:
+        return setpoint
+    level = np.minimum(np.abs(setpoint), DUTY_MAX).astype(int)
+    return np.sign(setpoint) * table[level]
+
+
+def wheel_speed(duty, full_mps, deadband):
+    fraction = (np.abs(duty) - deadband) / (DUTY_MAX - deadband)
+    return np.sign(duty) * full_mps * np.clip(fraction, 0, 1)
+
+
+def calibration_arrays(calibrations, batch):
+    # a single calibration for every row or one per row
+    if isinstance(calibrations, dict):
+        calibrations = [calibrations]
+    merged = [dict(DEFAULT_CALIBRATION, **calibration)
+              for calibration in calibrations]
+    result = {}
+    for key in DEFAULT_CALIBRATION:
+        values = np.array([calibration[key] for calibration in merged],
+                          dtype=float)
+        result[key] = np.broadcast_to(values, (batch,)) \
+            if len(values) == 1 else values
+    return result
+
+
+def simulate(m1, m2, calibrations=None, rate_hz=CONTROL_RATE_HZ,
+             slew_per_s=CONTROL_SLEW_PER_S, keep_path=False, tables=None):
+    # returns x, y and heading (m, m, rad) per row, shape (batch,), or
+    # (batch, ticks + 1) with keep_path; tables as load_motor_tables()
+    batch, ticks = m1.shape
+    cal = calibration_arrays(calibrations or {}, batch)
+    table1, table2 = tables if tables is not None else (None, None)
+    dt = 1 / rate_hz
+    step = slew_per_s // rate_hz
+    if slew_per_s and not step:
+        step = 1
+    x = np.zeros(batch)
+    y = np.zeros(batch)
+    heading = np.zeros(batch)
+    applied1 = np.zeros(batch)
+    applied2 = np.zeros(batch)
+    if keep_path:
+        path = np.zeros((3, batch, ticks + 1))
+    for tick in range(ticks):
+        applied1 = slew(applied1, m1[:, tick], step)
+        applied2 = slew(applied2, m2[:, tick], step)
+        left = wheel_speed(duties(applied1, table1), cal['left_mps'],
+                           cal['deadband'])
+        right = wheel_speed(duties(applied2, table2), cal['right_mps'],
+                            cal['deadband'])
+        speed = (left + right) / 2
+        turn = (right - left) / cal['track_m']
+        # heading at mid step, exact enough at 100 Hz
+        mid = heading + turn * dt / 2
+        x += speed * dt * np.cos(mid)
+        y += speed * dt * np.sin(mid)
+        heading += turn * dt
+        if keep_path:
+            path[:, :, tick + 1] = x, y, heading
+    if keep_path:
+        return path[0], path[1], path[2]
+    return x, y, heading
+
+
+def load_calibration(path, robot):
+    if path is None:
+        return dict(DEFAULT_CALIBRATION)
+    with open(path) as calibration_file:
+        robots = json.load(calibration_file)
+    if robot not in robots:
+        sys.exit(f'{robot} not in {path}, known: {", ".join(robots)}')
+    return dict(DEFAULT_CALIBRATION, **robots[robot])
+
+
+def load_motor_tables(path):
+    # the m1 and m2 tables motor_driver.py builds from a motor_cal.json,
+    # None without the default file, setpoints are then their own duty
+    if path is None:
+        if not os.path.exists(MOTOR_CALIBRATION_FILE):
+            return None
+        path = MOTOR_CALIBRATION_FILE
+    if not os.path.exists(path):
+        raise OSError(f'no motor calibration {path}')
+    calibration = load_motor_calibration(path)
+    return np.array([build_table(calibration[motor]) for motor in MOTORS],
+                    dtype=float)
+
+
+def parse_range(text):
+    # 'start:stop:step' inclusive of stop, or a single value
+    parts = [float(part) for part in text.split(':')]
+    if len(parts) == 1:
+        return np.array(parts)
+    start, stop, step = parts
+    return np.arange(start, stop + step / 2, step)
+
+
+def print_pose(label, x, y, heading):
+    print(f'{label}x={x:+.3f} m  y={y:+.3f} m  '
+          f'heading={math.degrees(heading):+.1f} deg')
+
+
+def command_run(vargs, calibration, tables):
+    durations = default_durations(vargs['motion_ms'], vargs['rotate_ms'])
+    segments, end_ms = load_script(vargs['script'], vargs['power'],
+                                   durations)
+    m1, m2 = targets([segments], 1000 / CONTROL_RATE_HZ)
+    x, y, heading = simulate(m1, m2, calibration, keep_path=True,
+                             tables=tables)
+    if vargs['path']:
+        every = max(int(vargs['path'] * CONTROL_RATE_HZ / 1000), 1)
+        for tick in range(0, x.shape[1], every):
+            print_pose(f'{tick * 1000 // CONTROL_RATE_HZ:7d} ms  ',
+                       x[0, tick], y[0, tick], heading[0, tick])
+    print_pose(f'after {end_ms} ms: ', x[0, -1], y[0, -1], heading[0, -1])
+
+
+def command_sweep(vargs, calibration, tables):
+    with open(vargs['script']) as script_file:
+        script = json.load(script_file)
+    if isinstance(script, dict):
+        script = script['program']
+    grid = np.array(np.meshgrid(parse_range(vargs['power_range']),
+                                parse_range(vargs['motion_range']),
+                                parse_range(vargs['rotate_range']),
+                                indexing='ij')).reshape(3, -1).T
+    start = time.perf_counter()
+    segment_lists = [
+        program_segments(script, int(power),
+                         default_durations(int(motion_ms), int(rotate_ms)))[0]
+        for power, motion_ms, rotate_ms in grid]
+    m1, m2 = targets(segment_lists, 1000 / CONTROL_RATE_HZ)
+    x, y, heading = simulate(m1, m2, calibration, tables=tables)
+    elapsed = time.perf_counter() - start
+    print(f'{len(grid)} variants x {m1.shape[1]} ticks in {elapsed:.2f} s')
+    order = np.arange(len(grid))
+    if vargs['target']:
+        tx, ty, tdeg = (float(value) for value in vargs['target'].split(','))
+        # heading error weighted as the arc it makes at a 0.1 m radius
+        angle = np.angle(np.exp(1j * (heading - math.radians(tdeg))))
+        error = np.hypot(x - tx, y - ty) + 0.1 * np.abs(angle)
+        order = np.argsort(error)
+    print('   power motion_ms rotate_ms        x        y  heading')
+    for idx in order[:vargs['top']]:
+        power, motion_ms, rotate_ms = grid[idx]
+        print(f'{power:8.0f} {motion_ms:9.0f} {rotate_ms:9.0f} '
+              f'{x[idx]:+8.3f} {y[idx]:+8.3f} '
+              f'{math.degrees(heading[idx]):+8.1f}')
+
+
+def command_flight(vargs, calibration, tables):
+    # every session of the recording separately, from its boot record on
+    sessions = {}
+    powers = {}
+    for session, t_ms, kind, detail, a, b in decode(vargs['paths']):
+        events = sessions.setdefault(session, [])
+        if kind == 'boot':
+            powers[session] = a
+        elif kind == 'setpoint':
+            events.append((t_ms, 'setpoint', a, b, detail == 'hold'))
+        elif kind == 'command':
+            events.append((t_ms, 'command', detail, a))
+    durations = default_durations(vargs['motion_ms'], vargs['rotate_ms'])
+    for session, events in sessions.items():
+        segments, end_ms = event_segments(
+            events, powers.get(session, DEFAULT_POWER), durations)
+        m1, m2 = targets([segments], 1000 / CONTROL_RATE_HZ)
+        x, y, heading = simulate(m1, m2, calibration, tables=tables)
+        print_pose(f'session {session}, {end_ms / 1000:.1f} s: ',
+                   x[0], y[0], heading[0])
+
+
+def command_calibrate(vargs, calibration, tables):
+    # distance and rotation scale with the wheel speed and the inverse of
+    # the track for a given deadband, so one unit run of each fits both
+    period_ms = 1000 / CONTROL_RATE_HZ
+    durations = default_durations(vargs['motion_ms'], vargs['rotate_ms'])
+    forward, _ = program_segments([['robot_forward']], vargs['power'],
+                                  durations)
+    rotate, _ = program_segments([['robot_rotate_left']], vargs['power'],
+                                 durations)
+    m1, m2 = targets([forward, rotate], period_ms)
+    unit = dict(calibration, left_mps=1.0, right_mps=1.0, track_m=1.0)
+    x, _, heading = simulate(m1, m2, unit, tables=tables)
+    speed = vargs['forward_m'] / x[0]
+    track = heading[1] * speed / math.radians(vargs['rotate_deg'])
+    fitted = dict(calibration, left_mps=round(speed, 4),
+                  right_mps=round(speed, 4), track_m=round(track, 4))
+    print(json.dumps(fitted))
+    if vargs['save']:
+        robots = {}
+        if os.path.exists(vargs['save']):
+            with open(vargs['save']) as calibration_file:
+                robots = json.load(calibration_file)
+        robots[vargs['robot']] = fitted
+        with open(vargs['save'], 'w') as calibration_file:
+            json.dump(robots, calibration_file, indent=2)
+
+
+def main():
+    # every command takes the robot and the firmware defaults
+    common = ArgumentParser(add_help=False)
+    common.add_argument('--calibration', '-c',
+                        help='json file of per robot calibrations')
+    common.add_argument('--robot', '-r', default='alpo',
+                        help='Robot in the calibration file')
+    common.add_argument('--motor-cal', metavar='FILE',
+                        help='motor_driver.py calibration, default '
+                        f'{MOTOR_CALIBRATION_FILE} if there is one')
+    common.add_argument('--power', '-p', type=int, default=DEFAULT_POWER,
+                        help='power_level the script starts with')
+    common.add_argument('--motion-ms', type=int,
+                        default=DEFAULT_MOTION_DURATION_MS,
+                        help='DEFAULT_MOTION_DURATION_MS')
+    common.add_argument('--rotate-ms', type=int,
+                        default=DEFAULT_ROTATE_DURATION_MS,
+                        help='DEFAULT_ROTATE_DURATION_MS')
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', parents=[common],
+                              help='Simulate one script')
+    run.add_argument('script')
+    run.add_argument('--path', type=int, default=0, metavar='MS',
+                     help='Also print the pose every MS ms')
+
+    sweep = commands.add_parser(
+        'sweep', parents=[common],
+        help='Simulate a script over a grid of parameters')
+    sweep.add_argument('script')
+    sweep.add_argument('--power-range', default=str(DEFAULT_POWER),
+                       help='start:stop:step of power_level')
+    sweep.add_argument('--motion-range',
+                       default=str(DEFAULT_MOTION_DURATION_MS),
+                       help='start:stop:step of DEFAULT_MOTION_DURATION_MS')
+    sweep.add_argument('--rotate-range',
+                       default=str(DEFAULT_ROTATE_DURATION_MS),
+                       help='start:stop:step of DEFAULT_ROTATE_DURATION_MS')
+    sweep.add_argument('--target', metavar='X,Y,DEG',
+                       help='Rank the variants by distance to this pose')
+    sweep.add_argument('--top', type=int, default=10)
+
+    flight = commands.add_parser('flight', parents=[common],
+                                 help='Simulate recorded flight logs')
+    flight.add_argument('paths', nargs='+', help='Flight logs, oldest first')
+
+    calibrate = commands.add_parser(
+        'calibrate', parents=[common],
+        help='Fit wheel speed and track from two measurements')
+    calibrate.add_argument('--forward-m', type=float, required=True,
+                           help='Distance one robot_forward() drove')
+    calibrate.add_argument('--rotate-deg', type=float, required=True,
+                           help='Angle one robot_rotate_left() turned')
+    calibrate.add_argument('--save', help='Store it in this json file')
+
+    vargs = vars(parser.parse_args())
+    if vargs['command'] == 'calibrate':
+        # the deadband comes from the robot's entry if there is one
+        calibration = dict(DEFAULT_CALIBRATION)
+        if vargs['calibration'] and os.path.exists(vargs['calibration']):
+            calibration = load_calibration(vargs['calibration'],
+                                           vargs['robot'])
+    else:
+        calibration = load_calibration(vargs['calibration'], vargs['robot'])
+    handlers = {
+        'run': command_run,
+        'sweep': command_sweep,
+        'flight': command_flight,
+        'calibrate': command_calibrate,
+    }
+    try:
+        tables = load_motor_tables(vargs['motor_cal'])
+        handlers[vargs['command']](vargs, calibration, tables)
+    except (OSError, ValueError) as ex:
+        sys.exit(str(ex))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,320 @@
+import os
 import time
+import json
 import network
+from micropython import const
+import uasyncio as asyncio
+
+# last good connection, reused on the next boot to skip the scan
+CACHE_FILE = 'wifi_cache.json'
+CACHED_CONNECT_TIMEOUT_MS = const(4000)  # then fall back to a full scan
+POLL_MS = const(50)
+# supervisor reconnect attempts, the wait between them doubles up to the max
+RECONNECT_ATTEMPT_MS = const(10000)
+RECONNECT_MIN_WAIT_MS = const(1000)
+RECONNECT_MAX_WAIT_MS = const(60000)
 
 wlan = None
+# per phase connect timings in ms, see begin_connect()/poll()
+timings = dict(
+    mode=None,  # 'cached' or 'scan'
+    activate_ms=0,
+    cached_ms=0,  # spent on a cached attempt, wasted if it fell back
+    scan_ms=0,
+    total_ms=0,
+    boot_ms=0,  # ticks_ms when the link came up, i.e. since boot
+    failures=0,
+)
 
+# link quality and outages, kept up to date by supervise_task()
+link = dict(
+    up=False,
+    rssi=None,
+    rssi_min=None,
+    outages=0,
+    outage_ms=0,  # running outage, else the last one
+    max_outage_ms=0,
+    total_outage_ms=0,
+    attempts=0,
+    reconnects=0,
+    reconnect_ms=0,  # last successful attempt, connect call to link up
+)
 
-def restart_wifi(ssid, key, hostname, timeout=None):
-    global wlan
-    if wlan is None:
+_ssid = None
+_key = None
+_hostname = None
+_reuse_ip = False
+_phase_start_ms = 0
+_begin_ms = 0
+_cache = None
+_need_bssid = False  # connected without knowing the bssid, see fill_cache()
+
+
+def _load_cache():
+    try:
+        with open(CACHE_FILE) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _scan_bssid(channel):
+    # the esp32 sta cannot report the bssid it joined, take the strongest
+    # access point of our ssid on its channel; blocks for seconds, timer
+    # callbacks included, so only fill_cache() calls it
+    ssid = _ssid.encode()
+    best = None
+    try:
+        for ap_ssid, bssid, ap_channel, rssi, _, _ in wlan.scan():
+            if ap_ssid != ssid or (channel and ap_channel != channel):
+                continue
+            if best is None or rssi > best[1]:
+                best = (bssid, rssi)
+    except OSError:
+        return None
+    return list(best[0]) if best is not None else None
+
+
+def _save_cache(bssid=None):
+    # never scans, without a bssid that is still good it leaves the cache
+    # alone and lets fill_cache() find one
+    global _cache, _need_bssid
+    cache = {'ssid': _ssid, 'channel': None, 'bssid': bssid, 'ifconfig': None}
+    try:
+        cache['channel'] = wlan.config('channel')
+    except (OSError, ValueError):
+        pass
+    if bssid is None and _cache is not None and \
+            _cache.get('ssid') == _ssid and _cache.get('bssid') and \
+            _cache.get('channel') == cache['channel']:
+        cache['bssid'] = _cache['bssid']  # same network as last time
+    _need_bssid = cache['bssid'] is None
+    if _need_bssid:
+        return  # a cache without the bssid would not skip the scan
+    if _reuse_ip:
+        cache['ifconfig'] = list(wlan.ifconfig())
+    if cache == _cache:
+        return
+    try:
+        with open(CACHE_FILE, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        _cache = cache
+    except OSError as ex:
+        print('wifi cache not saved: %s' % ex)
+
+
+def fill_cache():
+    # blocking scan for the bssid the cache still lacks, True if it did
+    # one; only call it while nothing moves, the control tick stalls too
+    if not _need_bssid or wlan is None or not wlan.isconnected():
         return False
-    wlan.active(False)
-    time.sleep(1)
+    try:
+        channel = wlan.config('channel')
+    except (OSError, ValueError):
+        channel = None
+    bssid = _scan_bssid(channel)
+    if bssid is not None:
+        _save_cache(bssid)
+    return True
+
+
+def forget_cache():
+    global _cache
+    _cache = None
+    try:
+        os.remove(CACHE_FILE)
+    except OSError:
+        pass
+
+
+def _connect_cached():
+    timings['mode'] = 'cached'
+    if _reuse_ip and _cache.get('ifconfig'):
+        wlan.ifconfig(tuple(_cache['ifconfig']))
+    if _cache.get('channel'):
+        try:
+            wlan.config(channel=_cache['channel'])
+        except (OSError, ValueError, TypeError):
+            pass
+    if _cache.get('bssid'):
+        wlan.connect(_ssid, _key, bssid=bytes(_cache['bssid']))
+    else:
+        wlan.connect(_ssid, _key)
+
+
+def _connect_scan():
+    timings['mode'] = 'scan'
+    wlan.connect(_ssid, _key)
+
+
+def begin_connect(ssid, key, hostname, reuse_ip=False):
+    # starts connecting and returns at once, poll() or connect_task() finish
+    # the job; reuse_ip also caches the dhcp lease and sets it statically
+    global wlan, _ssid, _key, _hostname, _reuse_ip, _cache
+    global _begin_ms, _phase_start_ms
+    _ssid = ssid
+    _key = key
+    _hostname = hostname
+    _reuse_ip = reuse_ip
+    _begin_ms = time.ticks_ms()
+    wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
-    wlan.connect(ssid, key)
-    start_time = time.time()
     wlan.config(dhcp_hostname=hostname)
-    while not wlan.isconnected():
-        if timeout is not None:
-            if time.time()-start_time > timeout:
-                return False
+    timings['activate_ms'] = time.ticks_diff(time.ticks_ms(), _begin_ms)
+    timings['cached_ms'] = 0
+    timings['scan_ms'] = 0
+    _phase_start_ms = time.ticks_ms()
+    _cache = _load_cache()
+    if wlan.isconnected():
+        timings['mode'] = 'up'
+        return
+    if _cache is not None and _cache.get('ssid') == ssid:
+        _connect_cached()
+    else:
+        _connect_scan()
+
+
+def _fall_back():
+    global _phase_start_ms
+    timings['cached_ms'] = time.ticks_diff(time.ticks_ms(), _phase_start_ms)
+    print('cached wifi parameters failed, scanning')
+    wlan.disconnect()
+    if _reuse_ip:
+        try:
+            wlan.ifconfig('dhcp')
+        except (OSError, ValueError, TypeError):
+            pass
+    _phase_start_ms = time.ticks_ms()
+    _connect_scan()
+
+
+def poll():
+    # returns True once connected, never blocks
+    if wlan.isconnected():
+        if timings['mode'] == 'cached':
+            timings['cached_ms'] = time.ticks_diff(time.ticks_ms(),
+                                                   _phase_start_ms)
+        elif timings['mode'] == 'scan':
+            timings['scan_ms'] = time.ticks_diff(time.ticks_ms(),
+                                                 _phase_start_ms)
+        return True
+    if timings['mode'] != 'cached':
+        return False
+    status = wlan.status()
+    if status == network.STAT_CONNECTING and \
+            time.ticks_diff(time.ticks_ms(), _phase_start_ms) < \
+            CACHED_CONNECT_TIMEOUT_MS:
+        return False
+    _fall_back()
+    return False
+
+
+def _connected():
+    now = time.ticks_ms()
+    timings['total_ms'] = time.ticks_diff(now, _begin_ms)
+    timings['boot_ms'] = now
+    _save_cache()
     print('network config:', wlan.ifconfig())
     print('dhcp hostname', wlan.config('dhcp_hostname'))
+    print('wifi up in %d ms (%s)' % (timings['total_ms'], timings['mode']))
+
+
+async def connect_task(timeout_ms=None):
+    # yields between polls so the rest of the firmware keeps running
+    while not poll():
+        if timeout_ms is not None and \
+                time.ticks_diff(time.ticks_ms(), _begin_ms) > timeout_ms:
+            timings['failures'] += 1
+            return False
+        await asyncio.sleep_ms(POLL_MS)
+    _connected()
     return True
 
 
-def init_wifi(ssid, key, hostname, timeout=300):
-    global wlan
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
+def _wait(timeout):
+    # blocking variant of connect_task for the repl
     start_time = time.time()
-    cur_time = time.time()
-    while wlan.status() != network.STAT_IDLE and cur_time-start_time < timeout:
-        print('Waiting ifup for wlan'.format(wlan.status()))
-        cur_time = time.time()
-        time.sleep(1)
-    if wlan.status() == network.STAT_IDLE and cur_time-start_time >= timeout:
-        wlan.active(False)
+    while not poll():
+        if timeout is not None and time.time() - start_time > timeout:
+            timings['failures'] += 1
+            return False
+        time.sleep_ms(POLL_MS)
+    _connected()
+    return True
+
+
+def restart_wifi(ssid, key, hostname, timeout=None):
+    if wlan is None:
         return False
-    wlan.config(dhcp_hostname=hostname)
-    if not wlan.isconnected():
-        print('connecting to network...')
-        wlan.connect(ssid, key)
-        while not wlan.isconnected():
-            if time.time()-start_time > timeout:
-                return False
-    print('network config:', wlan.ifconfig())
-    print('dhcp hostname', wlan.config('dhcp_hostname'))
-    return True
\ No newline at end of file
+    wlan.active(False)
+    begin_connect(ssid, key, hostname, _reuse_ip)
+    return _wait(timeout)
+
+
+def init_wifi(ssid, key, hostname, timeout=300):
+    begin_connect(ssid, key, hostname)
+    return _wait(timeout)
+
+
+def _sample_rssi():
+    try:
+        rssi = wlan.status('rssi')
+    except (OSError, ValueError, TypeError):
+        return
+    link['rssi'] = rssi
+    if link['rssi_min'] is None or rssi < link['rssi_min']:
+        link['rssi_min'] = rssi
+
+
+async def _reconnect(down_ms):
+    # one attempt in the background, True once the link is back
+    link['attempts'] += 1
+    wlan.disconnect()
+    begin_connect(_ssid, _key, _hostname, _reuse_ip)
+    while not poll():
+        link['outage_ms'] = time.ticks_diff(time.ticks_ms(), down_ms)
+        if time.ticks_diff(time.ticks_ms(), _begin_ms) > RECONNECT_ATTEMPT_MS:
+            timings['failures'] += 1
+            return False
+        await asyncio.sleep_ms(POLL_MS)
+    _connected()
+    return True
+
+
+async def supervise_task(period_ms, on_down=None, on_up=None, is_idle=None):
+    # checks the link every period_ms, reconnects with exponential backoff
+    # when it is gone; on_down()/on_up() are called on every transition,
+    # fill_cache() runs once is_idle() says a stalled loop harms nothing
+    link['up'] = wlan.isconnected()
+    if link['up']:
+        _sample_rssi()
+    while True:
+        if link['up']:
+            await asyncio.sleep_ms(period_ms)
+            if wlan.isconnected():
+                _sample_rssi()
+                if _need_bssid and is_idle is not None and is_idle():
+                    fill_cache()
+                continue
+            link['up'] = False
+            link['outages'] += 1
+            link['rssi'] = None
+            print('wifi link lost')
+            if on_down is not None:
+                on_down()
+        down_ms = time.ticks_ms()
+        wait_ms = RECONNECT_MIN_WAIT_MS
+        while not await _reconnect(down_ms):
+            await asyncio.sleep_ms(wait_ms)
+            wait_ms = min(wait_ms * 2, RECONNECT_MAX_WAIT_MS)
+        link['up'] = True
+        link['reconnects'] += 1
+        link['reconnect_ms'] = timings['total_ms']
+        outage_ms = time.ticks_diff(time.ticks_ms(), down_ms)
+        link['outage_ms'] = outage_ms
+        link['total_outage_ms'] += outage_ms
+        if outage_ms > link['max_outage_ms']:
+            link['max_outage_ms'] = outage_ms
+        _sample_rssi()
+        if on_up is not None:
+            on_up()